@@ -0,0 +1,73 @@
+"""
+Compare two benchmark result files and fail on throughput regressions.
+
+    python benchmarks/compare.py base.json new.json --threshold 0.15
+
+Exits with status 1 when any case present in both files got slower by
+more than the threshold. Cases are compared on their fastest repeat.
+With ``--filter``, only the matching cases gate; the rest are listed for
+information.
+"""
+import argparse
+import fnmatch
+import json
+import sys
+
+
+def compare(baseline, current, threshold, pattern="*"):
+    """Pair up the cases of two result dicts.
+
+    Returns:
+        list: One dict per shared case with ``name``, ``base``, ``new``,
+        ``change`` (relative, positive is slower), ``gated`` (matches
+        ``pattern``) and ``regressed`` (gated and over the threshold)
+    """
+    rows = []
+    for name, stats in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        gated = fnmatch.fnmatch(name, pattern)
+        change = stats["ns_per_ua"] / base["ns_per_ua"] - 1.0
+        rows.append({
+            "name": name,
+            "base": base["ns_per_ua"],
+            "new": stats["ns_per_ua"],
+            "change": change,
+            "gated": gated,
+            "regressed": gated and change > threshold,
+        })
+    return rows
+
+
+def print_comparison(rows, threshold):
+    print(f"{'Case':<32}{'base ns':>10}{'new ns':>10}{'change':>9}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regressed"] else "" if row["gated"] else "  (not gated)"
+        print(f"{row['name']:<32}{row['base']:>10.1f}{row['new']:>10.1f}"
+              f"{row['change'] * 100:>+8.1f}%{flag}")
+    regressions = sum(row["regressed"] for row in rows)
+    gated = sum(row["gated"] for row in rows)
+    print(f"{regressions} of {gated} gated cases slower than the {threshold:.0%} threshold")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline", help="JSON results of the reference build")
+    parser.add_argument("current", help="JSON results of the build under test")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown (default: 0.10 = 10%%)")
+    parser.add_argument("--filter", default="*", help="only gate cases matching this glob")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold, args.filter)
+    print_comparison(rows, args.threshold)
+    return 1 if any(row["regressed"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""A weighted User-Agent corpus for the benchmarks.
+
+The weights approximate the mix an image CDN sees: mostly current
+Chromium, Safari and Firefox builds, a tail of outdated browsers, a
+noticeable share of bots and tools, and a few pathological inputs (very
+long User-Agents from toolbars and in-app browsers, non-ASCII device
+names). ``build_corpus`` samples it deterministically, so runs with the
+same seed time the same inputs.
+"""
+
+import random
+
+# (category, weight, User-Agent)
+ENTRIES = [
+    # Current browsers: every rule the scan meets is a hit
+    ("hit", 30, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"),
+    ("hit", 12, "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Mobile Safari/537.36"),
+    ("hit", 12, "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1"),
+    ("hit", 6, "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Safari/605.1.15"),
+    ("hit", 6, "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0"),
+    ("hit", 5, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0"),
+    ("hit", 2, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 OPR/109.0.0.0"),
+    ("hit", 2, "Mozilla/5.0 (Linux; Android 13; SAMSUNG SM-S911B) AppleWebKit/537.36 (KHTML, like Gecko) SamsungBrowser/24.0 Chrome/117.0.0.0 Mobile Safari/537.36"),
+    # Outdated browsers: tokens match, versions are too old
+    ("miss", 3, "Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.112 Safari/537.36"),
+    ("miss", 2, "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.2 Safari/605.1.15"),
+    ("miss", 1, "Mozilla/5.0 (Windows NT 6.1; rv:60.0) Gecko/20100101 Firefox/60.0"),
+    ("miss", 1, "Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; Trident/6.0)"),
+    # Bots and tools: no rule token at all
+    ("bot", 5, "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"),
+    ("bot", 3, "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)"),
+    ("bot", 2, "curl/8.4.0"),
+    ("bot", 1, "python-requests/2.31.0"),
+    ("bot", 1, "Go-http-client/1.1"),
+    # Non-ASCII device names and locales
+    ("non_ascii", 2, "Mozilla/5.0 (Linux; Android 12; 小米 12 Pro) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.6099.144 Mobile Safari/537.36"),
+    ("non_ascii", 1, "Mozilla/5.0 (Linux; U; Android 11; ru-ru; Смартфон Redmi) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/89.0 Mobile Safari/537.36"),
+    ("non_ascii", 1, "Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 Instagram 300.0 (iPhone14,5; iOS 16_0; ja_JP; ja-JP; ✨)"),
+]
+
+
+def _long_user_agents():
+    # In-app browsers and toolbars append dozens of product tokens
+    products = " ".join(f"Product{i}/{i}.{i * 7 % 10}" for i in range(60))
+    return [
+        ("long", 1, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                    f"{products} Chrome/124.0.0.0 Safari/537.36"),
+        ("long", 1, "Mozilla/5.0 (Linux; Android 13; Pixel 7) " + "(extension; " * 80 + "Bot/1.0"),
+    ]
+
+
+ENTRIES += _long_user_agents()
+
+CATEGORIES = sorted({category for category, _, _ in ENTRIES})
+
+
+def build_corpus(size=10000, seed=20240601, category=None):
+    """Sample ``size`` User-Agents by weight.
+
+    Args:
+        size: Number of User-Agents to draw
+        seed: Seed for the sampler
+        category: Restrict the draw to one category, or None for all
+
+    Returns:
+        list: The sampled User-Agents as ``str``
+    """
+    entries = [entry for entry in ENTRIES if category is None or entry[0] == category]
+    sampler = random.Random(seed)
+    return sampler.choices([ua for _, _, ua in entries], weights=[w for _, w, _ in entries], k=size)
@@ -0,0 +1,295 @@
+"""
+Benchmark suite for modern-image-support.
+
+Each public entry point is timed separately over the weighted corpus in
+``corpus.py``. A case runs a whole pass over the corpus per loop, the loop
+count is calibrated so one repeat takes at least 0.2 s, and the fastest
+repeat is the reported figure (as with ``timeit``), with the median and
+spread alongside. Times are nanoseconds per User-Agent and include the
+Python loop around each call.
+
+    python benchmarks/run.py                        # print a table
+    python benchmarks/run.py --output new.json      # also save the results
+    python benchmarks/run.py --compare base.json    # fail on regressions
+    python benchmarks/run.py --filter 'core/*'      # a subset
+    python benchmarks/run.py --threads 1,2,4,8      # add thread scaling cases
+    python benchmarks/run.py --backend python       # the pure-Python fallback
+
+The ``threads/*`` cases split each pass across that many threads, so their
+time per User-Agent is wall time: on a free-threaded build it falls as
+threads are added, while with the GIL it stays flat at best.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import corpus  # noqa: E402
+from compare import compare, print_comparison  # noqa: E402
+
+SEC_CH_UA = b'"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"'
+ACCEPT = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+
+
+def _each(func, items):
+    def run():
+        for item in items:
+            func(item)
+    return run
+
+
+def _threaded(func, items, threads):
+    parts = [items[i::threads] for i in range(threads)]
+
+    def run():
+        workers = [threading.Thread(target=_each(func, part)) for part in parts]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return run
+
+
+def _cases(lib, size, seed, threads=()):
+    """Yield ``(name, required API, items, make_runner, setup, teardown)``."""
+    texts = corpus.build_corpus(size, seed)
+    raw = [ua.encode("utf-8") for ua in texts]
+
+    for name in ("webp_supported", "avif_supported", "best_format", "capabilities"):
+        yield f"single/{name}/bytes", (name,), raw, lambda f=name: _each(getattr(lib, f), raw), None, None
+    for name in ("webp_supported", "best_format"):
+        yield f"single/{name}/str", (name,), texts, lambda f=name: _each(getattr(lib, f), texts), None, None
+
+    def negotiate_runner(name):
+        negotiate = getattr(lib, name)
+
+        def run():
+            for ua in raw:
+                negotiate(ACCEPT, ua)
+        return run
+    # A capability class must cost no more than the negotiation it wraps
+    for name in ("negotiate", "capability_class"):
+        yield f"single/{name}/bytes", (name,), raw, lambda f=name: negotiate_runner(f), None, None
+
+    # Client Hints decide without a User-Agent scan, which must keep the
+    # combined call within the cost of webp_supported
+    def client_hints_runner():
+        negotiated = lib.negotiated_capabilities
+
+        def run():
+            for ua in raw:
+                negotiated(None, ua, SEC_CH_UA)
+        return run
+    yield "single/negotiate/client_hints", ("negotiated_capabilities",), raw, client_hints_runner, None, None
+
+    def cache_on():
+        lib.configure_cache(4096)
+
+    def cache_off():
+        lib.configure_cache(0)
+    yield ("cached/best_format/bytes", ("best_format", "configure_cache"), raw,
+           lambda: _each(lib.best_format, raw), cache_on, cache_off)
+
+    # Compare with single/webp_supported/bytes: counting reads the whole scan
+    # window, so that each detection is credited to the family parse()
+    # reports, where webp_supported() alone may stop at the first WebP match
+    def stats_on():
+        lib.configure_stats(True, 64)
+
+    def stats_off():
+        lib.configure_stats(False)
+    yield ("stats/webp_supported/bytes", ("webp_supported", "configure_stats"), raw,
+           lambda: _each(lib.webp_supported, raw), stats_on, stats_off)
+
+    for name, items in (("best_format_many", raw), ("capabilities_many", texts)):
+        kind = "bytes" if items is raw else "str"
+        yield (f"batch/{name}/{kind}", (name,), items,
+               lambda f=name, i=items: (lambda: getattr(lib, f)(i)), None, None)
+
+    # Columnar input, when the optional libraries are installed
+    columns = []
+    try:
+        import numpy
+        columns.append(("numpy", numpy.array(raw)))
+    except ImportError:
+        pass
+    try:
+        import pyarrow
+        columns.append(("arrow", pyarrow.array(texts)))
+    except ImportError:
+        pass
+    for kind, column in columns:
+        yield (f"batch/capabilities_column/{kind}", ("capabilities_column",), raw,
+               lambda c=column: (lambda: lib.capabilities_column(c)), None, None)
+
+    # The detection core per kind of input; these are the cases CI gates on
+    for category in corpus.CATEGORIES:
+        items = [ua.encode("utf-8") for ua in corpus.build_corpus(size, seed, category)]
+        yield (f"core/{category}", ("best_format",), items,
+               lambda i=items: _each(lib.best_format, i), None, None)
+
+    # The same pass with each token scanner this CPU has
+    select = getattr(lib, "_scan_level", None)
+    if select is not None:
+        fastest = select()
+        vector = "neon" if platform.machine().lower() in ("arm64", "aarch64") else "sse2"
+        for level, scanner in enumerate(("scalar", vector, "avx2")[:fastest + 1]):
+            yield (f"scanner/{scanner}", ("best_format",), raw,
+                   lambda: _each(lib.best_format, raw),
+                   lambda n=level: select(n), lambda n=fastest: select(n))
+
+    for count in threads:
+        yield (f"threads/best_format/{count}", ("best_format",), raw,
+               lambda n=count: _threaded(lib.best_format, raw, n), None, None)
+        yield (f"threads/cached/best_format/{count}", ("best_format", "configure_cache"), raw,
+               lambda n=count: _threaded(lib.best_format, raw, n), cache_on, cache_off)
+
+    log = b"".join(
+        b'10.0.0.1 - - [01/Jun/2024:00:00:00 +0000] "GET /img/%d.jpg HTTP/1.1" 200 512 "-" "%s"\n'
+        % (i, ua) for i, ua in enumerate(raw))
+    scan = getattr(lib, "_scan_log", None)
+    yield "scan/combined_log", ("_scan_log",), raw, lambda: (lambda: scan(log)), None, None
+
+
+def _measure(run, count, repeat, min_time):
+    timer = timeit.Timer(run)
+    loops, elapsed = 1, 0.0
+    while True:
+        elapsed = timer.timeit(loops)
+        if elapsed >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9)) + 1)
+    samples = [elapsed] + timer.repeat(repeat - 1, loops)
+    per_item = [sample / loops / count * 1e9 for sample in samples]
+    return {
+        "ns_per_ua": round(min(per_item), 3),
+        "median": round(statistics.median(per_item), 3),
+        "stdev": round(statistics.stdev(per_item), 3) if len(per_item) > 1 else 0.0,
+        "loops": loops,
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(lib, size=10000, seed=20240601, repeat=7, min_time=0.2, pattern="*",
+                   threads=()):
+    """Time every case whose name matches ``pattern``.
+
+    ``threads`` lists the thread counts of the ``threads/*`` cases.
+
+    Returns:
+        dict: ``{"meta": ..., "results": {name: stats}}``; cases whose API
+        the library does not have are left out
+    """
+    results = {}
+    for name, needs, items, make_runner, setup, teardown in _cases(lib, size, seed, threads):
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        if any(getattr(lib, attr, None) is None for attr in needs):
+            continue
+        if setup is not None:
+            setup()
+        try:
+            results[name] = _measure(make_runner(), len(items), repeat, min_time)
+        finally:
+            if teardown is not None:
+                teardown()
+    return {
+        "meta": {
+            "library_version": getattr(lib, "__version__", None),
+            "backend": getattr(lib, "backend", None),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "gil_enabled": getattr(sys, "_is_gil_enabled", lambda: True)(),
+            "corpus_size": size,
+            "seed": seed,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown against the baseline (default: 0.10 = 10%%)")
+    parser.add_argument("--filter", default="*", help="only run cases matching this glob")
+    parser.add_argument("--size", type=int, default=10000, help="User-Agents in the corpus")
+    parser.add_argument("--seed", type=int, default=20240601, help="corpus sampling seed")
+    parser.add_argument("--repeat", type=int, default=7, help="timed repeats per case")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--threads", default="",
+                        help="comma-separated thread counts for the scaling cases, "
+                             "such as 1,2,4,8 (default: none)")
+    parser.add_argument("--backend", choices=("auto", "python"), default="auto",
+                        help="time the backend the package picks at import, or the "
+                             "pure-Python fallback (default: auto)")
+    parser.add_argument("--import-path", default=os.path.dirname(HERE),
+                        help="directory to import modern_image_support from "
+                             "(default: this checkout)")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.import_path))
+    import modern_image_support
+    try:
+        from modern_image_support import modern_image_support as extension
+    except ImportError:
+        extension = None
+
+    # Public names plus the private log scanner behind the CLI and the
+    # scanner switch of whichever backend serves best_format()
+    lib = type(sys)("benchmarked")
+    lib.__dict__.update(vars(modern_image_support))
+    if args.backend == "python":
+        from modern_image_support import _python
+        lib.__dict__.update({name: getattr(_python, name) for name in modern_image_support.__all__
+                             if hasattr(_python, name)})
+        lib.backend = "python"
+    lib._scan_log = getattr(extension, "_scan_log", None)
+    backend = sys.modules[modern_image_support.best_format.__module__]
+    lib._scan_level = getattr(backend, "_scan_level", None)
+
+    threads = [int(count) for count in args.threads.split(",") if count]
+    report = run_benchmarks(lib, args.size, args.seed, args.repeat, args.min_time, args.filter,
+                            threads)
+    print(f"modern-image-support {report['meta']['library_version']} "
+          f"({report['meta']['backend']} backend) on "
+          f"{report['meta']['implementation']} {report['meta']['python']}, "
+          f"{args.size:,} User-Agents"
+          f"{'' if report['meta']['gil_enabled'] else ', free-threaded'}")
+    print(f"{'Case':<32}{'ns/UA':>10}{'median':>10}{'stdev':>9}{'M UA/s':>9}")
+    for name, stats in report["results"].items():
+        print(f"{name:<32}{stats['ns_per_ua']:>10.1f}{stats['median']:>10.1f}"
+              f"{stats['stdev']:>9.1f}{1e3 / stats['ns_per_ua']:>9.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(baseline, report, args.threshold)
+        print()
+        print_comparison(rows, args.threshold)
+        if any(row["regressed"] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
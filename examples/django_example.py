@@ -3,41 +3,28 @@ Django view example using modern-image-support.
 """
 from django.http import HttpResponse, FileResponse, JsonResponse
 from django.shortcuts import render
-from modern_image_support import webp_supported, avif_supported
-import os
+from modern_image_support import webp_supported, avif_supported, best_format
 
-# Assume we have these image files
-IMAGE_FILES = {
-    'avif': 'static/sample.avif',
-    'webp': 'static/sample.webp',
-    'jpeg': 'static/sample.jpg'
-}
+# Add to settings.py:
+#
+#     MIDDLEWARE = [..., "modern_image_support.django.ImageFormatMiddleware"]
+#     MODERN_IMAGE_SUPPORT = {"VARIANT_ROOT": BASE_DIR / "static", "VARIANT_POLL_INTERVAL": 30}
+#
+# The middleware negotiates once per request and indexes which of
+# static/sample.{avif,webp,jxl,jpg} exist, so views never stat the disk.
 
 def serve_optimized_image(request):
     """Serve the best supported image format based on user agent."""
-    user_agent = request.META.get('HTTP_USER_AGENT', '').encode('utf-8')
+    choice = request.image_choice
+    variant = request.image_variants.resolve('sample', choice)
     
-    # Choose the best format
-    if avif_supported(user_agent):
-        format_choice = 'avif'
-        content_type = 'image/avif'
-    elif webp_supported(user_agent):
-        format_choice = 'webp'
-        content_type = 'image/webp'
-    else:
-        format_choice = 'jpeg'
-        content_type = 'image/jpeg'
-    
-    # In a real application, check if file exists
-    image_path = IMAGE_FILES[format_choice]
-    
-    print(f"Serving {format_choice.upper()} format for user agent: {user_agent.decode('utf-8')[:50]}...")
+    print(f"Serving {choice.format or 'fallback'} for user agent: {request.META.get('HTTP_USER_AGENT', '')[:50]}...")
     
-    # Return the appropriate image
-    if os.path.exists(image_path):
-        return FileResponse(open(image_path, 'rb'), content_type=content_type)
+    # Return the appropriate image; Vary: Accept, User-Agent, Sec-CH-UA is added by the middleware
+    if variant is not None:
+        return FileResponse(open(variant.path, 'rb'), content_type=variant.mime_type)
     else:
-        return HttpResponse(f"Would serve: {image_path} with content_type: {content_type}")
+        return HttpResponse(f"Would serve: sample.{choice.format or 'jpg'}")
 
 def index(request):
     """Simple index page with image."""
@@ -59,17 +46,13 @@ def index(request):
 
 def check_support_api(request):
     """API endpoint to check format support."""
-    user_agent = request.META.get('HTTP_USER_AGENT', '').encode('utf-8')
+    user_agent = request.META.get('HTTP_USER_AGENT', '')
     
     return JsonResponse({
-        "user_agent": user_agent.decode('utf-8'),
+        "user_agent": user_agent,
         "webp_supported": webp_supported(user_agent),
         "avif_supported": avif_supported(user_agent),
-        "recommended_format": (
-            "avif" if avif_supported(user_agent) 
-            else "webp" if webp_supported(user_agent) 
-            else "jpeg"
-        )
+        "recommended_format": best_format(user_agent) or "jpeg"
     })
 
 # Example URLs configuration (add to your urls.py):
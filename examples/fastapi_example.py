@@ -3,44 +3,29 @@ FastAPI web server example using modern-image-support.
 """
 from fastapi import FastAPI, Request
 from fastapi.responses import FileResponse, HTMLResponse
-from modern_image_support import webp_supported, avif_supported
-import os
+from modern_image_support import webp_supported, avif_supported, best_format
+from modern_image_support.asgi import ImageFormatMiddleware
 
 app = FastAPI(title="Modern Image Support Demo", version="1.0.0")
 
-# Assume we have these image files
-IMAGE_FILES = {
-    'avif': 'static/sample.avif',
-    'webp': 'static/sample.webp',
-    'jpeg': 'static/sample.jpg'
-}
+# Negotiates the format once per request from the raw header bytes, caches
+# the result per worker and adds Vary: Accept, User-Agent, Sec-CH-UA to
+# image responses.
+# static/ is indexed once and polled every 30 seconds, so requests never
+# stat the disk
+app.add_middleware(ImageFormatMiddleware, variant_root='static', poll_interval=30)
 
 @app.get("/image")
 async def serve_optimized_image(request: Request):
     """Serve the best supported image format based on user agent."""
-    user_agent = request.headers.get('user-agent', '').encode('utf-8')
+    # Resolved by ImageFormatMiddleware, no detection or stat needed here
+    choice = request.state.image_choice
+    variant = request.state.image_variants.resolve('sample', choice)
     
-    # Choose the best format
-    if avif_supported(user_agent):
-        format_choice = 'avif'
-        media_type = 'image/avif'
-    elif webp_supported(user_agent):
-        format_choice = 'webp'
-        media_type = 'image/webp'
+    if variant is not None:
+        return FileResponse(variant.path, media_type=variant.mime_type)
     else:
-        format_choice = 'jpeg'
-        media_type = 'image/jpeg'
-    
-    # In a real application, check if file exists
-    image_path = IMAGE_FILES[format_choice]
-    
-    print(f"Serving {format_choice.upper()} format for user agent: {user_agent.decode('utf-8')[:50]}...")
-    
-    # Return the appropriate image
-    if os.path.exists(image_path):
-        return FileResponse(image_path, media_type=media_type)
-    else:
-        return {"message": f"Would serve: {image_path} with media_type: {media_type}"}
+        return {"message": f"Would serve: sample.{choice.format or 'jpg'}"}
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -64,17 +49,13 @@ async def index():
 @app.get("/api/check-support")
 async def check_support(request: Request):
     """API endpoint to check format support."""
-    user_agent = request.headers.get('user-agent', '').encode('utf-8')
+    user_agent = request.headers.get('user-agent', '')
     
     return {
-        "user_agent": user_agent.decode('utf-8'),
+        "user_agent": user_agent,
         "webp_supported": webp_supported(user_agent),
         "avif_supported": avif_supported(user_agent),
-        "recommended_format": (
-            "avif" if avif_supported(user_agent) 
-            else "webp" if webp_supported(user_agent) 
-            else "jpeg"
-        )
+        "recommended_format": best_format(user_agent) or "jpeg"
     }
 
 if __name__ == '__main__':
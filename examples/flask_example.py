@@ -2,44 +2,28 @@
 Flask web server example using modern-image-support.
 """
 from flask import Flask, request, send_file
-from modern_image_support import webp_supported, avif_supported
-import os
+from modern_image_support.wsgi import ImageFormatMiddleware
 
 app = Flask(__name__)
 
-# Assume we have these image files
-IMAGE_FILES = {
-    'avif': 'static/sample.avif',
-    'webp': 'static/sample.webp',
-    'jpeg': 'static/sample.jpg'
-}
+# Negotiates once per request and indexes which of
+# static/sample.{avif,webp,jxl,jpg} exist, so views never stat the disk;
+# the index picks up new files every 30 seconds
+app.wsgi_app = ImageFormatMiddleware(app.wsgi_app, variant_root='static', poll_interval=30)
 
 @app.route('/image')
 def serve_optimized_image():
     """Serve the best supported image format based on user agent."""
-    user_agent = request.headers.get('User-Agent', '').encode('utf-8')
+    choice = request.environ['modern_image_support.choice']
+    variant = request.environ['modern_image_support.variants'].resolve('sample', choice)
     
-    # Choose the best format
-    if avif_supported(user_agent):
-        format_choice = 'avif'
-        mimetype = 'image/avif'
-    elif webp_supported(user_agent):
-        format_choice = 'webp'
-        mimetype = 'image/webp'
-    else:
-        format_choice = 'jpeg'
-        mimetype = 'image/jpeg'
-    
-    # In a real application, check if file exists
-    image_path = IMAGE_FILES[format_choice]
-    
-    print(f"Serving {format_choice.upper()} format for user agent: {user_agent.decode('utf-8')[:50]}...")
+    print(f"Serving {choice.format or 'fallback'} for user agent: {request.headers.get('User-Agent', '')[:50]}...")
     
-    # Return the appropriate image
-    if os.path.exists(image_path):
-        return send_file(image_path, mimetype=mimetype)
+    # Return the appropriate image; Vary: Accept, User-Agent, Sec-CH-UA is added by the middleware
+    if variant is not None:
+        return send_file(variant.path, mimetype=variant.mime_type)
     else:
-        return f"Would serve: {image_path} with mimetype: {mimetype}", 200
+        return f"Would serve: sample.{choice.format or 'jpg'}", 200
 
 @app.route('/')
 def index():
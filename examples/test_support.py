@@ -3,6 +3,17 @@
 Simple test script to verify WebP and AVIF support detection.
 """
 
+def _shared_cache_child(path, name, ua):
+    # Runs in a spawned process, which attaches to the cache by name
+    import sys
+    sys.path.insert(0, path)
+    from modern_image_support import open_shared_cache, close_shared_cache, shared_cache_info, best_format
+    open_shared_cache(name)
+    choice = best_format(ua)
+    info = shared_cache_info()
+    close_shared_cache()
+    return choice, info.hits, info.misses
+
 def test_library():
     # Test User-Agent strings
     test_cases = [
@@ -29,7 +40,16 @@ def test_library():
         import sys
         import os
         sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        from modern_image_support import webp_supported, avif_supported
+        from modern_image_support import (
+            WEBP, AVIF, webp_supported, avif_supported, capabilities, best_format,
+            configure_cache, cache_info, cache_clear, set_max_scan_length, get_max_scan_length,
+            capabilities_many, webp_supported_many, avif_supported_many, best_format_many,
+            capabilities_column, negotiate, negotiated_capabilities, capability_class, class_header, CLASS_HEADER, load_rules, reset_rules, ImageFormat, parse, BrowserInfo,
+            open_shared_cache, close_shared_cache, shared_cache_info, configure_stats, stats, reset_stats
+        )
+        from modern_image_support.asgi import ImageFormatMiddleware
+        from modern_image_support import wsgi
+        from modern_image_support._scan import scan_files
         
         print("Testing WebP and AVIF support detection...")
         print("=" * 60)
@@ -46,6 +66,16 @@ def test_library():
             if webp_result != expected_webp or avif_result != expected_avif:
                 all_passed = False
             
+            # The single-pass API must agree with the per-format checks
+            expected_mask = (WEBP if expected_webp else 0) | (AVIF if expected_avif else 0)
+            expected_best = 'avif' if expected_avif else 'webp' if expected_webp else None
+            if capabilities(ua) != expected_mask or best_format(ua) != expected_best:
+                all_passed = False
+            # str and other buffers are read in place and must agree with bytes
+            for variant in (ua.decode('utf-8'), bytearray(ua), memoryview(ua)):
+                if best_format(variant) != expected_best:
+                    all_passed = False
+            
             # Extract browser name for display
             ua_str = ua.decode('utf-8')
             if 'Chrome' in ua_str and 'Edge' not in ua_str:
@@ -62,8 +92,608 @@ def test_library():
             print(f"Test {i}: {browser}")
             print(f"  WebP: {webp_status} Expected: {expected_webp}, Got: {webp_result}")
             print(f"  AVIF: {avif_status} Expected: {expected_avif}, Got: {avif_result}")
+            print(f"  Best: {best_format(ua)}")
             print()
         
+        # Cached results must match uncached ones
+        configure_cache(16)
+        for _ in range(2):
+            for ua, expected_webp, expected_avif in test_cases:
+                if webp_supported(ua) != expected_webp or avif_supported(ua) != expected_avif:
+                    all_passed = False
+        info = cache_info()
+        print(f"Cache: {info}")
+        if info.misses != len(test_cases) or info.currsize != len(test_cases):
+            all_passed = False
+        cache_clear()
+        if cache_info().currsize != 0:
+            all_passed = False
+        configure_cache(0)
+
+        # Detection statistics: one count per detection, under the first
+        # matched rule in table order, and every detection timed here
+        configure_stats(True, sample_every=1)
+        reset_stats()
+        for ua, _, _ in test_cases:
+            capabilities(ua)
+        webp_supported(b"curl/8.4.0")
+        configure_cache(16)
+        for _ in range(2):
+            capabilities(test_cases[0][0])
+        configure_cache(0)
+        configure_stats(False)
+        best_format(test_cases[0][0])
+        current = stats()
+        print(f"Stats: {current.calls} calls, {current.latency_count} timed")
+        decided = {token: count for token, count in current.rules.items() if count}
+        if decided != {"Chrome": 3, "Firefox": 2, "Version": 1, "Edge": 1}:
+            all_passed = False
+        if (current.calls, current.unmatched, current.cached, current.shared_cached) != (9, 1, 1, 0):
+            all_passed = False
+        if current.latency_count != 9 or current.latency[-1] != (float("inf"), 9) or current.latency_sum <= 0:
+            all_passed = False
+        if [count for _, count in current.latency] != sorted(count for _, count in current.latency):
+            all_passed = False
+        reset_stats()
+        if stats().calls != 0 or stats().latency_count != 0:
+            all_passed = False
+        # The credited rule depends on the User-Agent, not on the function:
+        # a scan that could stop early for WebP alone must still credit OPR
+        opera = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                 "Chrome/124.0.0.0 Safari/537.36 OPR/110.0.0.0")
+        entry_points = [webp_supported, avif_supported, capabilities, best_format,
+                        lambda ua: negotiate(None, ua), lambda ua: negotiated_capabilities(None, ua),
+                        lambda ua: capability_class(None, ua), lambda ua: class_header(None, ua)]
+        configure_stats(True, sample_every=0)
+        for ua in (opera, "Version/17.1 Safari/605.1.15 OPR/110"):
+            for entry_point in entry_points:
+                reset_stats()
+                entry_point(ua)
+                credited = {token for token, count in stats().rules.items() if count}
+                if credited != {"OPR"}:
+                    print(f"Stats credited {credited} for {ua[-20:]!r}")
+                    all_passed = False
+        configure_stats(False)
+        reset_stats()
+
+        # Threads detecting while another one reconfigures; on free-threaded
+        # builds the import must also have left the GIL disabled
+        import sysconfig
+        import threading
+        if sysconfig.get_config_var("Py_GIL_DISABLED") and sys._is_gil_enabled():
+            all_passed = False
+        rules_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser_rules.json")
+        mismatches = []
+
+        def detect_concurrently():
+            for _ in range(500):
+                for ua, expected_webp, expected_avif in test_cases:
+                    if webp_supported(ua) != expected_webp or avif_supported(ua) != expected_avif:
+                        mismatches.append(ua)
+
+        workers = [threading.Thread(target=detect_concurrently) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for size in (64, 0, 16, 256) * 10:
+            configure_cache(size)
+            load_rules(rules_path)
+            cache_clear()
+            reset_rules()
+        for worker in workers:
+            worker.join()
+        configure_cache(0)
+        if mismatches:
+            all_passed = False
+
+        # Hostile input: tokens past the scan window are ignored, versions
+        # must follow their token, and the scan never reads past the window
+        chrome_120 = b"Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+        if get_max_scan_length() != 2048 or best_format(b"x" * 3000 + chrome_120) is not None:
+            all_passed = False
+        set_max_scan_length(0)
+        if best_format(b"x" * 3000 + chrome_120) != "avif":
+            all_passed = False
+        set_max_scan_length(2048)
+
+        # Every token scanner this CPU has (scalar, SSE2/NEON, AVX2) agrees,
+        # including tokens that straddle or end a 16/32-byte block
+        backend = sys.modules[capabilities.__module__]
+        fastest = backend._scan_level()
+        sample = [ua for ua, _, _ in test_cases]
+        sample += [b"x" * pad + chrome_120[:cut] for pad in (0, 9, 13, 30) for cut in (40, 66, 71, 77)]
+        by_level = []
+        for level in range(fastest + 1):
+            backend._scan_level(level)
+            by_level.append([capabilities(ua) for ua in sample] + [parse(ua) for ua in sample])
+        backend._scan_level(fastest)
+        print(f"Scanner levels 0-{fastest} agree: {by_level.count(by_level[0]) == len(by_level)}")
+        if by_level.count(by_level[0]) != len(by_level):
+            all_passed = False
+
+        # The shared cache is seen by other processes and reseeded by new rules
+        import multiprocessing
+        name = open_shared_cache(f"mis_test_{os.getpid()}", slots=1024)
+        try:
+            if best_format(chrome_120) != "avif" or shared_cache_info().misses != 1:
+                all_passed = False
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+                if pool.apply(_shared_cache_child, (repo, name, chrome_120)) != ("avif", 1, 0):
+                    all_passed = False
+            load_rules([{"browser": "Chrome", "format": "webp", "min_version": 32}])
+            if best_format(chrome_120) != "webp" or shared_cache_info().misses != 2:
+                all_passed = False
+            reset_rules()
+            print(f"Shared cache: {shared_cache_info()}")
+        finally:
+            reset_rules()
+            close_shared_cache(unlink=True)
+        if shared_cache_info() is not None:
+            all_passed = False
+        if best_format(b"Chrome" + b" " * 20 + b"120") is not None:
+            all_passed = False
+        # The scan stops at the window: nothing past it changes the result,
+        # and a token or version cut by its end is not read
+        window = get_max_scan_length()
+        hostile = b"OPR SamsungBrowser Edge Firefox Chrome Version AppleWebKit " * 2000
+        for tail in (b"", chrome_120, b"OPR/110 Version/17.1 Edg/124 " * 100, bytes(range(256)) * 10):
+            if parse(hostile[:window] + tail) != parse(hostile[:window]):
+                print(f"Bytes past the scan window changed the result: {tail[:20]!r}")
+                all_passed = False
+        edge = b"x" * (window - len(b"Chr")) + b"Chrome/120.0"
+        if parse(edge).family is not None:
+            print(f"Token cut by the scan window was matched: {parse(edge)!r}")
+            all_passed = False
+        edge = b"x" * (window - len(b"Chrome/")) + b"Chrome/120.0"
+        if (parse(edge).family, parse(edge).major) != ("Chrome", None) or best_format(edge) is not None:
+            print(f"Version past the scan window was read: {parse(edge)!r}")
+            all_passed = False
+        
+        # parse(): one pass yields family, versions and the capability mask;
+        # tokens added on top of Chrome's or Safari's decide the family
+        safari_17_ua = "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1"
+        chrome_base = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.6367.91 Safari/537.36"
+        parse_cases = [
+            (chrome_base, ("Chrome", 124, 0, "Blink", 124)),
+            (chrome_base + " Edg/124.0.2478.51", ("Edge", 124, 0, "Blink", 124)),
+            (chrome_base + " OPR/109.0.0.0", ("Opera", 109, 0, "Blink", 124)),
+            (chrome_base.replace("Chrome/", "SamsungBrowser/24.0 Chrome/"), ("Samsung Internet", 24, 0, "Blink", 124)),
+            (safari_17_ua, ("Safari", 17, 4, "WebKit", 605)),
+            ("Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0", ("Firefox", 125, 0, "Gecko", 125)),
+            ("curl/8.0", (None, None, None, None, None)),
+        ]
+        for ua, expected in parse_cases:
+            info = parse(ua)
+            got = (info.family, info.major, info.minor, info.engine, info.engine_version)
+            if got != expected or info.capabilities != capabilities(ua) or info.best_format != best_format(ua):
+                print(f"parse failed for {ua[:40]!r}: {info!r}")
+                all_passed = False
+        info = parse(safari_17_ua.encode())
+        if not (info.webp and info.avif and info.jxl) or not isinstance(info, BrowserInfo):
+            all_passed = False
+        import pickle
+        if pickle.loads(pickle.dumps(info)) != info or hasattr(info, "__dict__"):
+            all_passed = False
+        
+        # Batch results must match the single-call API
+        uas = [ua for ua, _, _ in test_cases]
+        expected_caps = bytes(capabilities(ua) for ua in uas)
+        if (capabilities_many(uas) != expected_caps
+                or webp_supported_many(uas) != bytes(int(w) for _, w, _ in test_cases)
+                or avif_supported_many(uas) != bytes(int(a) for _, _, a in test_cases)
+                or best_format_many(uas) != bytes(AVIF if c & AVIF else c & WEBP for c in expected_caps)):
+            all_passed = False
+        if best_format_many(uas * 10000, workers=4) != best_format_many(uas * 10000):
+            all_passed = False
+        print(f"Batch: {best_format_many(uas)!r}")
+        
+        # Columnar input, for whichever of NumPy, pyarrow and polars is installed
+        column_uas = [ua.decode() for ua in uas] * 3000 + [None]
+        column_caps = expected_caps * 3000 + b"\0"
+        columns = []
+        try:
+            import numpy
+            columns.append((numpy.array(uas * 3000 + [b""]), column_caps))
+        except ImportError:
+            pass
+        try:
+            import pyarrow
+            for kind in (pyarrow.string(), pyarrow.large_string(), pyarrow.string_view()):
+                columns.append((pyarrow.array(column_uas, kind), column_caps))
+            columns.append((pyarrow.array(column_uas)[5:], column_caps[5:]))
+            columns.append((pyarrow.chunked_array([column_uas[:7], column_uas[7:]]), column_caps))
+        except ImportError:
+            pass
+        try:
+            import polars
+            columns.append((polars.Series(column_uas)[3:], column_caps[3:]))
+        except ImportError:
+            pass
+        for column, expected in columns:
+            for workers in (1, 4):
+                result = capabilities_column(column, workers=workers)
+                if bytes(result.to_pylist() if hasattr(result, "to_pylist") else result) != expected:
+                    print(f"capabilities_column failed for {type(column).__name__}")
+                    all_passed = False
+        try:
+            capabilities_column(["Chrome/120"])
+            all_passed = False
+        except TypeError:
+            pass
+        print(f"Columnar input: {len(columns)} column kinds")
+        
+        # Accept negotiation: (accept, user_agent, expected format)
+        chrome_91, firefox_89 = test_cases[0][0], test_cases[1][0]
+        negotiate_cases = [
+            (None, chrome_91, 'avif'),
+            (None, firefox_89, 'webp'),
+            ("image/avif,image/webp,*/*", firefox_89, 'avif'),
+            ("image/webp,image/*;q=0.8", chrome_91, 'avif'),
+            ("image/avif;q=0,image/webp", chrome_91, 'webp'),
+            ("image/png,image/jpeg", chrome_91, None),
+            ("*/*;q=0", chrome_91, None),
+            ("IMAGE/WEBP ; Q=0.5", None, 'webp'),
+            ("", firefox_89, 'webp'),
+        ]
+        for accept, ua, expected in negotiate_cases:
+            chosen, mime = negotiate(accept, ua)
+            if chosen != expected or mime != (expected and f"image/{expected}"):
+                print(f"Negotiate failed for Accept {accept!r}: got {chosen}")
+                all_passed = False
+        
+        # Capability classes: few, stable, and driven by the same negotiation
+        classes = {capability_class(None, ua) for ua, _, _ in test_cases}
+        if {(c.id, c.key) for c in classes} != {(0, "none"), (1, "webp"), (3, "webp+avif")}:
+            all_passed = False
+        if capability_class("image/avif;q=0,image/webp", chrome_91).key != "webp":
+            all_passed = False
+        if capability_class(None, chrome_91, formats=WEBP) != (WEBP, "webp"):
+            all_passed = False
+        if class_header(None, firefox_89) != (CLASS_HEADER, "webp"):
+            all_passed = False
+        try:
+            capability_class(None, chrome_91, formats=0x100)
+            all_passed = False
+        except ValueError:
+            pass
+        
+        # Every format comes out of the same scan; Safari 17 gets JPEG XL
+        safari_17 = (b"Mozilla/5.0 (Macintosh; Intel Mac OS X 14_1) AppleWebKit/605.1.15 "
+                     b"(KHTML, like Gecko) Version/17.1 Safari/605.1.15")
+        every_format = (ImageFormat.WEBP | ImageFormat.AVIF | ImageFormat.JXL
+                        | ImageFormat.HEIC | ImageFormat.ANIMATED_AVIF)
+        if capabilities(safari_17) != every_format:
+            all_passed = False
+        if capabilities(chrome_91) != ImageFormat.WEBP | ImageFormat.AVIF:
+            all_passed = False
+        if negotiate("image/avif;q=0,image/webp", safari_17) != ("webp", "image/webp"):
+            all_passed = False
+
+        # Client hints: the Sec-CH-UA brand versions beat a frozen User-Agent,
+        # GREASE-only or malformed hints fall back to it, Accept still wins
+        frozen_chrome = b"Mozilla/5.0 (Windows NT 10.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.0.0 Safari/537.36"
+        hints = b'"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"'
+        client_hint_cases = [
+            (None, hints, every_format & ~(ImageFormat.JXL | ImageFormat.HEIC)),
+            (None, b'"Not-A.Brand";v="99"', WEBP),
+            (None, b'"Chromium"', WEBP),
+            (None, '"Chro\\"mium";v="124"', WEBP),
+            (None, b'"Chromium";x="a,b";v="124"', WEBP | AVIF | ImageFormat.ANIMATED_AVIF),
+            (None, b'"Microsoft Edge";v="121"', WEBP | AVIF | ImageFormat.ANIMATED_AVIF),
+            (None, b'"Opera";v="70"', WEBP),
+            ("image/avif;q=0,*/*", hints, WEBP),
+        ]
+        for accept, sec_ch_ua, expected in client_hint_cases:
+            if negotiated_capabilities(accept, frozen_chrome, sec_ch_ua) != expected:
+                print(f"Client hints failed for {sec_ch_ua!r}")
+                all_passed = False
+        if negotiate(None, frozen_chrome, hints) != ("avif", "image/avif"):
+            all_passed = False
+        if capability_class(None, None, sec_ch_ua=hints).key != "webp+avif":
+            all_passed = False
+
+        # The shipped rules file reproduces the built-in table, and a
+        # runtime table takes effect immediately
+        load_rules(os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser_rules.json"))
+        for ua, expected_webp, expected_avif in test_cases:
+            if webp_supported(ua) != expected_webp or avif_supported(ua) != expected_avif:
+                all_passed = False
+        for ua, _ in parse_cases:
+            reset_rules()
+            builtin = parse(ua)
+            load_rules(os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser_rules.json"))
+            if parse(ua) != builtin:
+                all_passed = False
+        load_rules([{"browser": "Firefox", "format": "avif", "min_version": 80}])
+        if not avif_supported(firefox_89) or webp_supported(chrome_91):
+            all_passed = False
+        try:
+            load_rules([{"browser": "Firefox", "format": "gif", "min_version": 1}])
+            all_passed = False
+        except ValueError:
+            pass
+        # Beyond nine digits no version can reach the minimum
+        try:
+            load_rules([{"browser": "Firefox", "format": "avif", "min_version": 80},
+                        {"browser": "Chrome", "format": "avif", "min_version": 2**40}])
+            all_passed = False
+        except ValueError as e:
+            if not str(e).startswith("rule 1:"):
+                all_passed = False
+        reset_rules()
+        if not avif_supported(chrome_91):
+            all_passed = False
+
+        # The pure-Python backend, imported only when the extension is
+        # missing, agrees with the compiled one on every case above
+        import modern_image_support
+        if modern_image_support.backend != "python" and "modern_image_support._python" in sys.modules:
+            all_passed = False
+        from modern_image_support import _python
+        fields = lambda info: (info.family, info.major, info.minor, info.engine,
+                               info.engine_version, info.capabilities)
+        for ua, _ in parse_cases:
+            if fields(_python.parse(ua)) != fields(parse(ua)) or _python.best_format(ua) != best_format(ua):
+                print(f"Python backend failed for {ua[:40]!r}")
+                all_passed = False
+        for accept, ua, _ in negotiate_cases:
+            if _python.negotiate(accept, ua) != negotiate(accept, ua):
+                all_passed = False
+        for accept, sec_ch_ua, _ in client_hint_cases:
+            if (_python.negotiated_capabilities(accept, frozen_chrome, sec_ch_ua)
+                    != negotiated_capabilities(accept, frozen_chrome, sec_ch_ua)):
+                all_passed = False
+        if _python.best_format_many(uas) != best_format_many(uas):
+            all_passed = False
+        for column, expected in columns[:1]:
+            if bytes(_python.capabilities_column(column)) != expected:
+                all_passed = False
+        # Repeated User-Agents are answered from the memo, until it is disabled
+        _python.cache_clear()
+        for ua in uas * 2:
+            _python.capabilities(ua)
+        if _python.cache_info()[:2] != (len(uas), len(uas)):
+            all_passed = False
+        _python.configure_cache(0)
+        _python.capabilities(chrome_91)
+        if _python.cache_info().currsize != 0:
+            all_passed = False
+        _python.configure_cache(4096)
+        _python.load_rules([{"browser": "Firefox", "format": "avif", "min_version": 80}])
+        if not _python.avif_supported(firefox_89) or _python.webp_supported(chrome_91):
+            all_passed = False
+        _python.reset_rules()
+        print(f"Backend: {modern_image_support.backend}")
+
+        # ASGI middleware: one negotiation per request, merged Vary header
+        import asyncio
+        choices, sent = [], []
+        
+        async def image_app(scope, receive, send):
+            choices.append(scope["state"]["image_choice"])
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"image/webp"), (b"vary", b"accept")]})
+        
+        async def collect(message):
+            sent.append(message)
+        
+        middleware = ImageFormatMiddleware(image_app)
+        scope = {"type": "http", "headers": [(b"user-agent", firefox_89), (b"accept", b"image/avif,*/*")]}
+        asyncio.run(middleware(scope, None, collect))
+        # The choice depends on Sec-CH-UA too, so caches must vary on it
+        if choices[0].format != "avif" or (b"vary", b"accept, User-Agent, Sec-CH-UA") not in sent[0]["headers"]:
+            print(f"ASGI Vary failed: {sent[0]['headers']!r}")
+            all_passed = False
+        try:
+            import django
+            from django.conf import settings
+        except ImportError:
+            pass
+        else:
+            from django.http import HttpRequest, HttpResponse
+            from modern_image_support import django as django_middleware
+            if not settings.configured:
+                settings.configure()
+            django_response = django_middleware.ImageFormatMiddleware(
+                lambda request: HttpResponse(b"", content_type="image/webp"))(HttpRequest())
+            if django_response["Vary"] != "Accept, User-Agent, Sec-CH-UA":
+                print(f"Django Vary failed: {django_response['Vary']!r}")
+                all_passed = False
+        # WSGI str headers and raw ASGI headers go through the same merge
+        from modern_image_support._middleware import vary_headers
+        for headers, expected in (
+                ([("Content-Type", "IMAGE/avif")], [("Content-Type", "IMAGE/avif"), ("Vary", "Accept, User-Agent")]),
+                ([("Content-Type", "image/png"), ("Vary", "*")], [("Content-Type", "image/png"), ("Vary", "*")]),
+                ([("Content-Type", "text/html")], [("Content-Type", "text/html")])):
+            raw = [(name.lower().encode(), value.encode()) for name, value in headers]
+            raw_expected = [(name.lower().encode(), value.encode()) for name, value in expected]
+            if (vary_headers(headers, ("Accept", "User-Agent")) != expected
+                    or vary_headers(raw, ("Accept", "User-Agent"), raw=True) != raw_expected):
+                print(f"vary_headers failed for {headers!r}")
+                all_passed = False
+
+        # WSGI middleware: cached choice, indexed variants, Vary on images only
+        import tempfile
+        with tempfile.TemporaryDirectory() as root:
+            for name in ("sample.webp", "sample.jpg"):
+                open(os.path.join(root, name), "wb").close()
+            wsgi_seen, wsgi_headers = [], []
+            
+            def wsgi_app(environ, start_response):
+                choice = environ[wsgi.CHOICE_KEY]
+                wsgi_seen.append(environ[wsgi.VARIANTS_KEY].resolve("sample", choice))
+                start_response("200 OK", [("Content-Type", "image/webp")])
+                return [b""]
+            
+            app = wsgi.ImageFormatMiddleware(wsgi_app, variant_root=root)
+            for accept in ("image/avif,image/webp,*/*", "image/avif,image/webp,*/*", "*/*"):
+                environ = {"HTTP_USER_AGENT": firefox_89.decode(), "HTTP_ACCEPT": accept}
+                app(environ, lambda status, headers, exc_info=None: wsgi_headers.append(headers))
+            open(os.path.join(root, "sample.avif"), "wb").close()
+            # Indexed until refreshed, then the new AVIF variant wins
+            if app.variants.resolve("sample", AVIF | WEBP).format != "webp":
+                all_passed = False
+            app.variants.refresh()
+            if app.variants.resolve("sample", AVIF | WEBP).format != "avif":
+                all_passed = False
+            if [variant.format for variant in wsgi_seen] != ["webp", "webp", "webp"]:
+                all_passed = False
+            if app.variants.resolve("sample", 0).format != "jpg":
+                all_passed = False
+            if app.variants.resolve("../sample", AVIF) is not None:
+                all_passed = False
+            if len(app.cache) != 2 or ("Vary", "Accept, User-Agent, Sec-CH-UA") not in wsgi_headers[0]:
+                print(f"WSGI Vary failed: {wsgi_headers[0]!r}")
+                all_passed = False
+            # Sec-CH-UA is part of the cached request key
+            environ = {"HTTP_USER_AGENT": frozen_chrome.decode(), "HTTP_ACCEPT": "*/*",
+                       "HTTP_SEC_CH_UA": hints.decode()}
+            app(environ, lambda status, headers, exc_info=None: None)
+            if environ[wsgi.CHOICE_KEY].format != "avif" or len(app.cache) != 3:
+                all_passed = False
+            # One cache serves all of a worker's threads, evicting on every insert
+            from modern_image_support._middleware import ChoiceCache
+            choice_cache, variant_cache = ChoiceCache(maxsize=1), wsgi.VariantCache(root, maxsize=1)
+            cache_errors = []
+
+            def use_caches(worker):
+                try:
+                    for i in range(2000):
+                        choice_cache.resolve(f"Firefox/{worker}.{i}", "*/*")
+                        variant_cache.resolve(f"sample{i % 7}", AVIF | WEBP)
+                except Exception as error:
+                    cache_errors.append(error)
+
+            switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+            try:
+                cache_users = [threading.Thread(target=use_caches, args=(n,)) for n in range(8)]
+                for worker in cache_users:
+                    worker.start()
+                for worker in cache_users:
+                    worker.join()
+            finally:
+                sys.setswitchinterval(switch_interval)
+            if cache_errors or len(choice_cache) != 1 or len(variant_cache._resolved) != 1:
+                print(f"Shared middleware caches failed: {cache_errors[:1]}")
+                all_passed = False
+
+            # VariantResolver: nested names, sizes, incremental and polled refreshes
+            from modern_image_support.variants import VariantResolver
+            photos = os.path.join(root, "photos")
+            os.mkdir(photos)
+            for name, data in (("cat.jxl", b"x" * 7), ("cat.PNG", b"x" * 9)):
+                with open(os.path.join(photos, name), "wb") as image:
+                    image.write(data)
+            resolver = VariantResolver(root)
+            variant = resolver.resolve("photos/cat", ImageFormat.JXL | WEBP)
+            if (variant.format, variant.mime_type, variant.size) != ("jxl", "image/jxl", 7):
+                print(f"VariantResolver failed for a nested name: {variant!r}")
+                all_passed = False
+            if resolver.resolve("photos/cat", WEBP).format != "png" or "photos/cat" not in resolver:
+                print(f"VariantResolver fallback failed: {resolver.resolve('photos/cat', WEBP)!r}")
+                all_passed = False
+            # A directory whose mtime is unchanged is not listed again
+            os.utime(photos, (1e9, 1e9))
+            resolver.refresh()
+            open(os.path.join(photos, "cat.webp"), "wb").close()
+            os.utime(photos, (1e9, 1e9))
+            resolver.refresh()
+            if resolver.resolve("photos/cat", WEBP).format != "png":
+                print("VariantResolver listed a directory whose mtime is unchanged")
+                all_passed = False
+            resolver.refresh(full=True)
+            if resolver.resolve("photos/cat", WEBP).format != "webp":
+                print("VariantResolver full refresh missed a new variant")
+                all_passed = False
+            os.remove(os.path.join(root, "sample.avif"))
+            for name in os.listdir(photos):
+                os.remove(os.path.join(photos, name))
+            os.rmdir(photos)
+            resolver.refresh()
+            if "photos/cat" in resolver or resolver.resolve("sample", AVIF | WEBP).format != "webp":
+                print(f"VariantResolver kept removed variants: {resolver.resolve('sample', AVIF | WEBP)!r}")
+                all_passed = False
+            # Polling: each tick of the poller is a refresh, driven here by a
+            # stand-in for its stop event that lets exactly one tick through
+            class OneTick:
+                def __init__(self):
+                    self.ticks = 1
+
+                def wait(self, timeout):
+                    self.ticks -= 1
+                    return self.ticks < 0
+
+            polled = VariantResolver(root)
+            polled.resolve("sample", AVIF)
+            open(os.path.join(root, "sample.avif"), "wb").close()
+            polled._poll(OneTick())
+            if polled.resolve("sample", AVIF | WEBP).format != "avif":
+                print(f"VariantResolver poll tick missed a new variant: {polled.resolve('sample', AVIF | WEBP)!r}")
+                all_passed = False
+            # With an interval, the first resolve() starts the poller, and
+            # close() stops it
+            running = set(threading.enumerate())
+            polled = VariantResolver(root, poll_interval=3600)
+            polled.resolve("sample", AVIF)
+            pollers = [thread for thread in threading.enumerate()
+                       if thread.name == "VariantResolver" and thread not in running]
+            polled.close()
+            for thread in pollers:
+                thread.join(timeout=10)
+            if len(pollers) != 1 or pollers[0].is_alive():
+                print(f"VariantResolver poller did not start and stop: {pollers!r}")
+                all_passed = False
+            
+            # Log scan: sharded, streamed and JSON scans agree
+            import gzip, json
+            log_uas = [chrome_91.decode(), firefox_89.decode(), "curl/7.68.0", "-"]
+            combined_path = os.path.join(root, "access.log")
+            json_path = os.path.join(root, "access.jsonl.gz")
+            with open(combined_path, "w") as combined, gzip.open(json_path, "wt") as jsonl:
+                for i in range(400):
+                    ua = log_uas[i % 3 if i % 10 else 3]
+                    combined.write(f'10.0.0.1 - - [10/Oct/2024:13:55:36 +0000] "GET /{i} HTTP/1.1" 200 512 "-" "{ua}"\n')
+                    jsonl.write(json.dumps({"status": 200, "user_agent": ua}) + "\n")
+            whole = scan_files([combined_path], workers=1)
+            sharded = scan_files([combined_path], workers=2, shard_size=4096)
+            streamed = scan_files([json_path])
+            for report in (sharded, streamed):
+                if (report.lines, report.missing, report.families, report.unmatched) != \
+                        (whole.lines, whole.missing, whole.families, whole.unmatched):
+                    all_passed = False
+            if whole.lines != 400 or whole.missing != 40 or whole.unmatched["curl/7.68.0".encode()] != 120:
+                all_passed = False
+            if whole.families.get("Chrome") != [120, 120, 120, 0, 0, 0]:
+                all_passed = False
+            print(f"Scan: {whole.families}")
+            # The CLI on the pure-Python backend, the extension hidden from
+            # a child interpreter
+            import subprocess
+            forced = subprocess.run([sys.executable, "-c", (
+                "import sys, importlib.abc\n"
+                "class Hide(importlib.abc.MetaPathFinder):\n"
+                "    def find_spec(self, name, path, target=None):\n"
+                "        if name in ('modern_image_support.modern_image_support', 'modern_image_support._native'):\n"
+                "            raise ImportError(name)\n"
+                "sys.meta_path.insert(0, Hide())\n"
+                "import modern_image_support, modern_image_support.__main__ as cli\n"
+                "assert modern_image_support.backend == 'python', modern_image_support.backend\n"
+                "sys.exit(cli.main(sys.argv[1:]))\n"),
+                "scan", combined_path, json_path, "--json", "--workers", "1"],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            if forced.returncode != 0:
+                print(f"Scan CLI failed on the Python backend: {forced.stderr}")
+                all_passed = False
+            else:
+                result = json.loads(forced.stdout)
+                if (result["lines"], result["missing_user_agent"], result["top_unmatched"]) != \
+                        (800, 80, [["curl/7.68.0", 240]]) or \
+                        [result["families"][family]["requests"] for family in ("Chrome", "Firefox")] != [240, 240] or \
+                        result["families"]["Chrome"]["avif"] != 240 or result["families"]["Firefox"]["avif"] != 0:
+                    print(f"Scan CLI on the Python backend: {result}")
+                    all_passed = False
+        
         if all_passed:
             print("🎉 All tests passed!")
             return True
@@ -81,4 +711,5 @@ def test_library():
         return False
 
 if __name__ == "__main__":
-    test_library()
+    import sys
+    sys.exit(0 if test_library() else 1)
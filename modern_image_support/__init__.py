@@ -1,17 +1,187 @@
 """Modern Image Support - WebP and AVIF detection from User-Agent strings.
 
 This package provides fast, efficient detection of WebP and AVIF image format
-support based on browser User-Agent strings.
+support (plus JPEG XL, HEIC and animated AVIF) based on browser User-Agent
+strings.
 """
 
 __version__ = "0.4.0"
 __author__ = "bymoye"
 __email__ = "s3moye@gmail.com"
 
-from .modern_image_support import webp_supported, avif_supported
+import sys
+
+from ._formats import ImageFormat
+
+# The compiled extension when it could be built, else the pure-Python
+# port of the same detection; ``backend`` names the one in use
+try:
+    from .modern_image_support import (
+        WEBP,
+        AVIF,
+        JXL,
+        HEIC,
+        ANIMATED_AVIF,
+        webp_supported,
+        avif_supported,
+        capabilities,
+        best_format,
+        BrowserInfo,
+        parse,
+        negotiate,
+        negotiated_capabilities,
+        CLASS_HEADER,
+        CapabilityClass,
+        capability_class,
+        class_header,
+        load_rules,
+        reset_rules,
+        capabilities_many,
+        webp_supported_many,
+        avif_supported_many,
+        best_format_many,
+        capabilities_column,
+        CacheInfo,
+        configure_cache,
+        cache_info,
+        cache_clear,
+        set_max_scan_length,
+        get_max_scan_length,
+        SharedCacheInfo,
+        open_shared_cache,
+        close_shared_cache,
+        shared_cache_info,
+        DetectionStats,
+        configure_stats,
+        stats,
+        reset_stats,
+    )
+except ImportError:
+    from ._python import (
+        WEBP,
+        AVIF,
+        JXL,
+        HEIC,
+        ANIMATED_AVIF,
+        webp_supported,
+        avif_supported,
+        capabilities,
+        best_format,
+        BrowserInfo,
+        parse,
+        negotiate,
+        negotiated_capabilities,
+        CLASS_HEADER,
+        CapabilityClass,
+        capability_class,
+        class_header,
+        load_rules,
+        reset_rules,
+        capabilities_many,
+        webp_supported_many,
+        avif_supported_many,
+        best_format_many,
+        capabilities_column,
+        CacheInfo,
+        configure_cache,
+        cache_info,
+        cache_clear,
+        set_max_scan_length,
+        get_max_scan_length,
+        SharedCacheInfo,
+        open_shared_cache,
+        close_shared_cache,
+        shared_cache_info,
+        DetectionStats,
+        configure_stats,
+        stats,
+        reset_stats,
+    )
+
+    backend = "python"
+else:
+    backend = "cython"
+
+# On PyPy the Cython module is reached through cpyext; the cffi build of
+# the same C code serves the per-request calls at native speed
+if sys.implementation.name == "pypy" and backend == "cython":
+    try:
+        from ._cffi import (
+            webp_supported,
+            avif_supported,
+            capabilities,
+            best_format,
+            negotiate,
+            negotiated_capabilities,
+            capability_class,
+            class_header,
+            load_rules,
+            reset_rules,
+            capabilities_many,
+            webp_supported_many,
+            avif_supported_many,
+            best_format_many,
+            configure_cache,
+            cache_info,
+            cache_clear,
+            set_max_scan_length,
+            get_max_scan_length,
+            open_shared_cache,
+            close_shared_cache,
+            shared_cache_info,
+            configure_stats,
+            stats,
+            reset_stats,
+        )
+    except ImportError:  # built without cffi
+        pass
+    else:
+        backend = "cffi"
 
 # 保留向后兼容的别名
 is_webp_supported = webp_supported
 is_avif_supported = avif_supported
 
-__all__ = ["webp_supported", "avif_supported", "is_webp_supported", "is_avif_supported"]
\ No newline at end of file
+__all__ = [
+    "ImageFormat",
+    "WEBP",
+    "AVIF",
+    "JXL",
+    "HEIC",
+    "ANIMATED_AVIF",
+    "webp_supported",
+    "avif_supported",
+    "capabilities",
+    "best_format",
+    "BrowserInfo",
+    "parse",
+    "negotiate",
+    "negotiated_capabilities",
+    "CLASS_HEADER",
+    "CapabilityClass",
+    "capability_class",
+    "class_header",
+    "load_rules",
+    "reset_rules",
+    "capabilities_many",
+    "webp_supported_many",
+    "avif_supported_many",
+    "best_format_many",
+    "capabilities_column",
+    "CacheInfo",
+    "configure_cache",
+    "cache_info",
+    "cache_clear",
+    "set_max_scan_length",
+    "get_max_scan_length",
+    "SharedCacheInfo",
+    "open_shared_cache",
+    "close_shared_cache",
+    "shared_cache_info",
+    "DetectionStats",
+    "configure_stats",
+    "stats",
+    "reset_stats",
+    "is_webp_supported",
+    "is_avif_supported",
+]
@@ -0,0 +1,120 @@
+"""Command line tools.
+
+``python -m modern_image_support scan access.log [more.log.gz ...]`` reports
+what share of the logged traffic supports each image format, per browser
+family, and the most frequent User-Agents that no rule matched.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from . import load_rules
+from ._formats import FORMAT_NAMES
+from ._scan import scan_files
+
+_HEADINGS = {
+    "webp": "WebP",
+    "avif": "AVIF",
+    "jxl": "JXL",
+    "heic": "HEIC",
+    "animated_avif": "Anim. AVIF",
+}
+
+
+def _percent(count, total):
+    return f"{100.0 * count / total:.1f}%" if total else "-"
+
+
+def _report_dict(report, seconds, top):
+    def counts(row):
+        return {"requests": row[0], **dict(zip(FORMAT_NAMES, row[1:]))}
+
+    return {
+        "lines": report.lines,
+        "missing_user_agent": report.missing,
+        "bytes": report.bytes,
+        "seconds": round(seconds, 3),
+        "totals": counts(report.totals()),
+        "families": {family: counts(row) for family, row in report.families.items()},
+        "unmatched_requests": sum(report.unmatched.values()),
+        "top_unmatched": [
+            [user_agent.decode("utf-8", "replace"), count]
+            for user_agent, count in report.unmatched.most_common(top)
+        ],
+    }
+
+
+def _print_report(report, seconds, top, out):
+    rate = report.bytes / seconds / 1e6 if seconds > 0 else 0.0
+    print(f"Scanned {report.lines:,} lines ({report.bytes / 1e6:,.1f} MB) in {seconds:.2f} s "
+          f"({rate:,.1f} MB/s); {report.missing:,} without a User-Agent", file=out)
+    print(file=out)
+
+    total = report.requests
+    headings = [_HEADINGS[name] for name in FORMAT_NAMES]
+    print(f"{'Browser':<16}{'Requests':>14}{'Share':>8}"
+          + "".join(f"{heading:>12}" for heading in headings), file=out)
+
+    def row(label, counts):
+        print(f"{label:<16}{counts[0]:>14,}{_percent(counts[0], total):>8}"
+              + "".join(f"{_percent(count, counts[0]):>12}" for count in counts[1:]), file=out)
+
+    for family, counts in sorted(report.families.items(), key=lambda item: -item[1][0]):
+        row(family, counts)
+    unmatched = sum(report.unmatched.values())
+    if unmatched:
+        row("(unmatched)", [unmatched] + [0] * len(FORMAT_NAMES))
+    row("All", report.totals())
+
+    if top and report.unmatched:
+        print(file=out)
+        print(f"Top {top} unmatched User-Agents:", file=out)
+        for user_agent, count in report.unmatched.most_common(top):
+            print(f"{count:>14,}  {user_agent.decode('utf-8', 'replace')}", file=out)
+
+
+def main(argv=None, out=None):
+    """Run the command line interface; returns the exit status."""
+    out = sys.stdout if out is None else out
+    parser = argparse.ArgumentParser(prog="python -m modern_image_support")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan = commands.add_parser(
+        "scan", help="report image format support across access logs",
+        description="Report image format support per browser family across access logs. "
+                    "Plain files are memory-mapped and sharded across processes; gzip "
+                    "files and standard input (-) are streamed.")
+    scan.add_argument("paths", nargs="+", metavar="LOG", help="log file, .gz file or - for stdin")
+    scan.add_argument("--format", choices=("auto", "combined", "json"), default="auto",
+                      help="combined: User-Agent is the last quoted field; json: one object "
+                           "per line (default: guess from the first line)")
+    scan.add_argument("--key", default="user_agent", help="User-Agent key of JSON lines")
+    scan.add_argument("--workers", type=int, default=None,
+                      help="processes to shard plain files across (default: CPU count)")
+    scan.add_argument("--rules", default=None, help="browser rules .json/.toml file to use")
+    scan.add_argument("--top", type=int, default=20, help="unmatched User-Agents to list")
+    scan.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    args = parser.parse_args(argv)
+    try:
+        if args.rules is not None:
+            load_rules(args.rules)
+        started = time.perf_counter()
+        report = scan_files(args.paths, args.format, args.key, args.workers, args.rules)
+        seconds = time.perf_counter() - started
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+
+    if args.json:
+        json.dump(_report_dict(report, seconds, args.top), out, indent=2)
+        out.write("\n")
+    else:
+        _print_report(report, seconds, args.top, out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""PyPy backend: the detection hot path through cffi.
+
+The Cython module works on PyPy, but only through cpyext, which emulates
+the CPython object layout for every argument and return value. Here the
+same C functions are called through cffi, which the PyPy JIT turns into
+direct calls.
+
+The cffi module is a second compilation of ``modern_image_support_c.h``
+with its own copy of the rule table, scan bound and caches. The calls that
+change them are applied to both modules, so functions still served by the
+Cython module (``parse``, the log scanner) see the same configuration.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import _rules
+from . import modern_image_support as _cython
+from ._formats import FORMAT_NAMES
+from ._native import ffi, lib
+
+CacheInfo = _cython.CacheInfo
+SharedCacheInfo = _cython.SharedCacheInfo
+DetectionStats = _cython.DetectionStats
+CapabilityClass = _cython.CapabilityClass
+CLASS_HEADER = _cython.CLASS_HEADER
+_CLASSES = _cython._CLASSES
+
+WEBP = lib.FORMAT_WEBP
+AVIF = lib.FORMAT_AVIF
+FORMAT_ALL = lib.FORMAT_ALL
+
+_CHOICES = {
+    AVIF: ("avif", "image/avif"),
+    WEBP: ("webp", "image/webp"),
+    0: (None, None),
+}
+
+# Matches enum batch_mode
+_BATCH_CAPABILITIES, _BATCH_WEBP, _BATCH_AVIF, _BATCH_BEST = range(4)
+_MIN_CHUNK = 16384
+
+lib.modern_image_support_init()
+
+# cffi releases the GIL around every call, so detection runs concurrently
+# with reconfiguration in both modules: replaced tables and shared memory
+# are retired instead of freed, as on free-threaded builds
+_cython._retire_replaced = True
+_retired = []
+_config_lock = threading.RLock()
+
+
+class _NativeTable:
+    """A rule table compiled into a matcher of the cffi module."""
+
+    def __init__(self, rules):
+        index = {name: i for i, (name, _, _) in enumerate(rules)}
+        # The C structs only point at these, so they live with the table
+        self._strings = []
+        self.rules = ffi.new("struct browser_version[]", max(len(rules), 1))
+        for i, (token, minimums, (family, engine, engine_token)) in enumerate(rules):
+            rule = self.rules[i]
+            rule.name = self._string(token.encode("ascii"))
+            rule.name_len = len(token)
+            for j, name in enumerate(FORMAT_NAMES):
+                rule.min_versions[j] = minimums.get(name, 0)
+            rule.family = self._string(family.encode("utf-8"))
+            rule.engine = ffi.NULL if engine is None else self._string(engine.encode("utf-8"))
+            rule.engine_rule = -1 if engine_token is None else index[engine_token]
+        self.matcher = ffi.new("struct browser_matcher *")
+        if not lib.matcher_build(self.matcher, self.rules, len(rules)):
+            raise ValueError("a rule table can hold at most 256 browser tokens")
+
+    def _string(self, value):
+        string = ffi.new("char[]", value)
+        self._strings.append(string)
+        return string
+
+
+# Keeps the loaded table alive while lib.active_matcher points into it
+_active_table = None
+_shared_buffer = None
+
+
+def _data(value):
+    # bytes go to C as they are; str is encoded like the Cython module
+    # does, and other buffers are passed without a copy
+    if type(value) is bytes:
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return ffi.from_buffer("char[]", value)
+
+
+def _detect(user_agent, wanted):
+    data = _data(user_agent)
+    return lib.cached_capabilities(data, len(data), wanted)
+
+
+def _reseed_shared_cache():
+    lib.shared_cache.seed = lib.matcher_fingerprint(lib.active_matcher, lib.max_scan_length)
+
+
+def webp_supported(user_agent):
+    """Check if the browser supports WebP format based on User-Agent string."""
+    return _detect(user_agent, WEBP) != 0
+
+
+def avif_supported(user_agent):
+    """Check if the browser supports AVIF format based on User-Agent string."""
+    return _detect(user_agent, AVIF) != 0
+
+
+def capabilities(user_agent):
+    """Detect every supported format in a single pass over the User-Agent."""
+    return _detect(user_agent, FORMAT_ALL)
+
+
+def best_format(user_agent):
+    """Return the best image format supported by the browser."""
+    return _CHOICES[lib.best_format_of(_detect(user_agent, FORMAT_ALL))][0]
+
+
+def negotiated_capabilities(accept=None, user_agent=None, sec_ch_ua=None):
+    """Like ``negotiate``, but return every acceptable format as a bitmask."""
+    accept_data = ffi.NULL if accept is None else _data(accept)
+    ua_data = ffi.NULL if user_agent is None else _data(user_agent)
+    hints_data = ffi.NULL if sec_ch_ua is None else _data(sec_ch_ua)
+    accept_length = 0 if accept is None else len(accept_data)
+    ua_length = 0 if user_agent is None else len(ua_data)
+    hints_length = 0 if sec_ch_ua is None else len(hints_data)
+    return lib.negotiate_capabilities(accept_data, accept_length, ua_data, ua_length,
+                                      hints_data, hints_length)
+
+
+def negotiate(accept=None, user_agent=None, sec_ch_ua=None):
+    """Choose an image format from the Accept header and User-Agent."""
+    return _CHOICES[lib.best_format_of(negotiated_capabilities(accept, user_agent, sec_ch_ua))]
+
+
+def capability_class(accept=None, user_agent=None, formats=WEBP | AVIF, sec_ch_ua=None):
+    """Map a request to a small, stable capability class."""
+    if formats & ~FORMAT_ALL:
+        raise ValueError(f"unknown format bits in {formats:#x}")
+    return _CLASSES[negotiated_capabilities(accept, user_agent, sec_ch_ua) & formats]
+
+
+def class_header(accept=None, user_agent=None, formats=WEBP | AVIF, sec_ch_ua=None):
+    """Return the ``(name, value)`` request header to normalize on."""
+    return (CLASS_HEADER, capability_class(accept, user_agent, formats, sec_ch_ua).key)
+
+
+def _run_many(user_agents, mode, workers):
+    matcher = lib.active_matcher
+    items = [ffi.from_buffer("char[]", _data(user_agent)) for user_agent in user_agents]
+    count = len(items)
+    pointers = ffi.new("const char *[]", items) if count else ffi.NULL
+    lengths = ffi.new("size_t[]", [len(item) for item in items]) if count else ffi.NULL
+    result = bytearray(count)
+    out = ffi.from_buffer("unsigned char[]", result)
+
+    def run(start, stop):
+        lib.detect_many(matcher, pointers + start, lengths + start, stop - start, mode, out + start)
+
+    threads = (os.cpu_count() or 1) if workers is None else workers
+    threads = min(threads, count // _MIN_CHUNK)
+    if threads <= 1:
+        if count:
+            run(0, count)
+    else:
+        step = (count + threads - 1) // threads
+        with ThreadPoolExecutor(threads) as pool:
+            futures = [pool.submit(run, start, min(start + step, count))
+                       for start in range(0, count, step)]
+            for future in futures:
+                future.result()
+    # The strings were only reachable from C until here
+    del items
+    return bytes(result)
+
+
+def capabilities_many(user_agents, workers=1):
+    """Detect the capabilities of many User-Agents in one native call."""
+    return _run_many(user_agents, _BATCH_CAPABILITIES, workers)
+
+
+def webp_supported_many(user_agents, workers=1):
+    """Check WebP support for many User-Agents in one native call."""
+    return _run_many(user_agents, _BATCH_WEBP, workers)
+
+
+def avif_supported_many(user_agents, workers=1):
+    """Check AVIF support for many User-Agents in one native call."""
+    return _run_many(user_agents, _BATCH_AVIF, workers)
+
+
+def best_format_many(user_agents, workers=1):
+    """Pick the best format for many User-Agents in one native call."""
+    return _run_many(user_agents, _BATCH_BEST, workers)
+
+
+def configure_cache(maxsize):
+    """Enable, resize or disable the detection result cache."""
+    if maxsize < 0:
+        raise OverflowError("can't convert negative value to size_t")
+    if not lib.cache_configure(ffi.addressof(lib, "default_cache"), maxsize):
+        raise MemoryError()
+
+
+def cache_info():
+    """Report cache statistics, like ``functools.lru_cache``."""
+    cache = lib.default_cache
+    return CacheInfo(cache.hits, cache.misses, cache.maxsize, cache.currsize)
+
+
+def cache_clear():
+    """Drop all cached results and reset the statistics."""
+    lib.cache_clear(ffi.addressof(lib, "default_cache"))
+
+
+def configure_stats(enabled=True, sample_every=64):
+    """Turn the detection counters read by ``stats()`` on or off."""
+    with _config_lock:
+        _cython.configure_stats(enabled, sample_every)
+        lib.stats_configure(enabled, sample_every)
+
+
+def stats():
+    """Report the detection counters of this process."""
+    with _config_lock:
+        matcher = lib.active_matcher
+        names = [ffi.string(matcher.rules[i].name, matcher.rules[i].name_len).decode("ascii")
+                 for i in range(matcher.count)]
+        counts = lib.detection_stats.counts
+        outcomes = [counts[lib.STATS_UNMATCHED], counts[lib.STATS_CACHED], counts[lib.STATS_SHARED_CACHED]]
+        return _cython._stats_result(names, list(counts[0:matcher.count]), outcomes,
+                                     list(lib.detection_stats.latency), lib.detection_stats.latency_ticks)
+
+
+def reset_stats():
+    """Zero the detection counters and latency histogram."""
+    lib.stats_reset()
+
+
+def set_max_scan_length(length):
+    """Bound how many leading bytes of a User-Agent detection reads."""
+    with _config_lock:
+        _cython.set_max_scan_length(length)
+        lib.max_scan_length = length
+        lib.cache_clear(ffi.addressof(lib, "default_cache"))
+        _reseed_shared_cache()
+
+
+def get_max_scan_length():
+    """Return the current scan bound set by ``set_max_scan_length``."""
+    return lib.max_scan_length
+
+
+def _scan_level(level=None):
+    """Return the token scanner in use, after switching to ``level``."""
+    if level is not None:
+        _cython._scan_level(level)
+        lib.scan_level_select(level)
+    return lib.scan_level
+
+
+def load_rules(source):
+    """Replace the browser support table at runtime."""
+    global _active_table
+    rules = _rules.read_rules(source)
+    table = _NativeTable(rules)
+    with _config_lock:
+        _cython._install_rules(rules)
+        if _active_table is not None:
+            _retired.append(_active_table)
+        _active_table = table
+        lib.active_matcher = table.matcher
+        lib.cache_clear(ffi.addressof(lib, "default_cache"))
+        _reseed_shared_cache()
+        lib.stats_reset()
+
+
+def reset_rules():
+    """Switch back to the browser support table built into the extension."""
+    global _active_table
+    with _config_lock:
+        _cython.reset_rules()
+        lib.active_matcher = ffi.addressof(lib, "default_matcher")
+        if _active_table is not None:
+            _retired.append(_active_table)
+        _active_table = None
+        lib.cache_clear(ffi.addressof(lib, "default_cache"))
+        _reseed_shared_cache()
+        lib.stats_reset()
+
+
+def open_shared_cache(name=None, slots=65536):
+    """Attach a detection cache shared by every process on the host."""
+    global _shared_buffer
+    with _config_lock:
+        close_shared_cache()
+        name = _cython.open_shared_cache(name, slots)
+        memory = _cython._shared_cache_memory()
+        _shared_buffer = ffi.from_buffer(memory.buf)
+        lib.shared_cache_attach(ffi.addressof(lib, "shared_cache"), _shared_buffer, memory.size)
+        return name
+
+
+def close_shared_cache(unlink=False):
+    """Detach this process from the shared cache."""
+    global _shared_buffer
+    with _config_lock:
+        lib.shared_cache_detach(ffi.addressof(lib, "shared_cache"))
+        if _shared_buffer is not None:
+            _retired.append(_shared_buffer)
+            _shared_buffer = None
+        _cython.close_shared_cache(unlink)
+
+
+def shared_cache_info():
+    """Report the shared cache statistics of this process."""
+    cache = lib.shared_cache
+    if cache.slots == ffi.NULL:
+        return None
+    memory = _cython._shared_cache_memory()
+    return SharedCacheInfo(cache.hits, cache.misses, cache.mask + 1,
+                           lib.shared_cache_used(ffi.addressof(lib, "shared_cache")), memory.name)
+
+
+def _reset_shared_stats():
+    lib.shared_cache.hits = 0
+    lib.shared_cache.misses = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_shared_stats)
+    os.register_at_fork(after_in_child=reset_stats)
@@ -0,0 +1,106 @@
+"""cffi builder for the PyPy backend.
+
+Compiles ``modern_image_support_c.h`` into ``modern_image_support._native``
+in cffi API mode. On PyPy, cffi calls are compiled by the JIT into direct C
+calls, while the Cython module has to go through the cpyext emulation
+layer for every argument and return value. ``setup.py`` only builds this
+module on PyPy; ``_cffi.py`` wraps it.
+"""
+import os
+import sys
+
+from cffi import FFI
+
+CDEF = """
+#define FORMAT_COUNT 5
+#define FORMAT_WEBP 1
+#define FORMAT_AVIF 2
+#define FORMAT_ALL 31
+
+struct browser_version {
+    const char *name;
+    size_t name_len;
+    int min_versions[5];
+    const char *family;
+    const char *engine;
+    int engine_rule;
+};
+
+struct browser_matcher {
+    const struct browser_version *rules;
+    size_t count;
+    ...;
+};
+
+struct result_cache {
+    size_t maxsize;
+    size_t currsize;
+    uint64_t hits;
+    uint64_t misses;
+    ...;
+};
+
+struct shared_cache {
+    uint64_t *slots;
+    size_t mask;
+    uint64_t seed;
+    uint64_t hits;
+    uint64_t misses;
+};
+
+struct detection_stats {
+    uint64_t counts[...];
+    uint64_t latency[...];
+    uint64_t latency_ticks;
+};
+
+#define STATS_UNMATCHED ...
+#define STATS_CACHED ...
+#define STATS_SHARED_CACHED ...
+
+struct browser_matcher default_matcher;
+struct result_cache default_cache;
+struct shared_cache shared_cache;
+struct detection_stats detection_stats;
+bool stats_enabled;
+const struct browser_matcher *active_matcher;
+size_t max_scan_length;
+int scan_level;
+
+void modern_image_support_init(void);
+int scan_level_select(int level);
+bool matcher_build(struct browser_matcher *matcher, const struct browser_version *rules, size_t count);
+int cached_capabilities(const char *user_agent, size_t length, int wanted);
+int best_format_of(int capabilities);
+bool cache_configure(struct result_cache *cache, size_t maxsize);
+void cache_clear(struct result_cache *cache);
+uint64_t matcher_fingerprint(const struct browser_matcher *matcher, size_t window);
+bool shared_cache_attach(struct shared_cache *cache, void *memory, size_t size);
+void shared_cache_detach(struct shared_cache *cache);
+size_t shared_cache_used(const struct shared_cache *cache);
+void detect_many(const struct browser_matcher *matcher, const char *const *user_agents,
+                 const size_t *lengths, size_t count, int mode, unsigned char *out);
+void stats_configure(bool enabled, uint32_t sample_every);
+void stats_reset(void);
+uint64_t stats_ticks(void);
+int negotiate_capabilities(const char *accept, size_t accept_length,
+                           const char *user_agent, size_t ua_length,
+                           const char *client_hints, size_t hints_length);
+"""
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+ffi = FFI()
+ffi.cdef(CDEF)
+ffi.set_source(
+    "modern_image_support._native",
+    '#include "modern_image_support_c.h"',
+    include_dirs=[here],
+    extra_compile_args=[] if sys.platform == "win32" else ["-O3"],
+    # Like the Cython extension: without a compiler, setup.py warns and
+    # installs the pure-Python backend
+    optional=True,
+)
+
+if __name__ == "__main__":
+    ffi.compile(tmpdir=os.path.dirname(here), verbose=True)
@@ -0,0 +1,29 @@
+"""Image formats known to the detection tables."""
+
+import enum
+
+
+class ImageFormat(enum.IntFlag):
+    """Capability bits returned by ``capabilities()`` and friends.
+
+    The values match the bit order of the browser-to-format matrix in
+    ``modern_image_support_c.h``.
+    """
+
+    WEBP = 0x01
+    AVIF = 0x02
+    JXL = 0x04
+    HEIC = 0x08
+    ANIMATED_AVIF = 0x10
+
+
+# Format names as used in rule files, in bit order
+FORMAT_NAMES = ("webp", "avif", "jxl", "heic", "animated_avif")
+
+MIME_TYPES = {
+    "webp": "image/webp",
+    "avif": "image/avif",
+    "jxl": "image/jxl",
+    "heic": "image/heic",
+    "animated_avif": "image/avif",
+}
@@ -0,0 +1,239 @@
+"""Pieces shared by the web framework middleware."""
+
+import os
+import threading
+from typing import NamedTuple, Optional
+
+from . import negotiated_capabilities
+from ._formats import ImageFormat
+
+
+class FormatChoice(NamedTuple):
+    """The image format negotiated for one request.
+
+    ``format`` and ``mime_type`` are None when neither AVIF nor WebP can be
+    served; ``capabilities`` holds every acceptable format as
+    ``ImageFormat`` bits.
+    """
+
+    format: Optional[str]
+    mime_type: Optional[str]
+    capabilities: int
+
+
+def choice_for(capabilities):
+    """Build the ``FormatChoice`` for a capability bitmask."""
+    if capabilities & ImageFormat.AVIF:
+        return FormatChoice("avif", "image/avif", capabilities)
+    if capabilities & ImageFormat.WEBP:
+        return FormatChoice("webp", "image/webp", capabilities)
+    return FormatChoice(None, None, capabilities)
+
+
+class Variant(NamedTuple):
+    """An existing file to serve for a negotiated format.
+
+    ``size`` and ``mtime`` are filled in by ``VariantResolver`` from its
+    index, and are None from ``VariantCache``.
+    """
+
+    path: str
+    format: str
+    mime_type: str
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+
+
+_FORMAT_BITS = {
+    "avif": ImageFormat.AVIF,
+    "webp": ImageFormat.WEBP,
+    "jxl": ImageFormat.JXL,
+    "heic": ImageFormat.HEIC,
+}
+
+# Headers a negotiated choice depends on: the choice cache is keyed by all
+# three, and Sec-CH-UA brands override the User-Agent
+DEFAULT_VARY = ("Accept", "User-Agent", "Sec-CH-UA")
+
+# Tried in order when no modern format applies or exists
+FALLBACK_VARIANTS = (
+    ("jpg", "image/jpeg"),
+    ("jpeg", "image/jpeg"),
+    ("png", "image/png"),
+    ("gif", "image/gif"),
+)
+
+
+class ChoiceCache:
+    """Per-worker ``(user_agent, accept, sec_ch_ua) -> FormatChoice`` cache.
+
+    Bounded to ``maxsize`` entries with first-in-first-out eviction, which
+    for a skewed User-Agent distribution keeps the hot entries resident at
+    the cost of a single dict lookup per hit. Hits take no lock; inserts
+    are serialized, since the WSGI and Django middleware share one cache
+    between the worker's threads.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, user_agent, accept, sec_ch_ua=None):
+        key = (user_agent, accept, sec_ch_ua)
+        choice = self._entries.get(key)
+        if choice is None:
+            choice = choice_for(negotiated_capabilities(accept, user_agent, sec_ch_ua))
+            if self.maxsize > 0:
+                with self._lock:
+                    if len(self._entries) >= self.maxsize:
+                        # dicts keep insertion order, so this drops the oldest entry
+                        del self._entries[next(iter(self._entries))]
+                    self._entries[key] = choice
+        return choice
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def merge_vary(existing, names):
+    """Merge header ``names`` into an existing Vary value, case-insensitively.
+
+    Args:
+        existing: The current Vary value, or None
+        names: Header names that the response depends on
+
+    Returns:
+        str: The combined Vary value; ``*`` is left untouched
+    """
+    if existing is None or not existing.strip():
+        return ", ".join(names)
+    values = [value.strip() for value in existing.split(",") if value.strip()]
+    if "*" in values:
+        return "*"
+    seen = {value.lower() for value in values}
+    for name in names:
+        if name.lower() not in seen:
+            values.append(name)
+            seen.add(name.lower())
+    return ", ".join(values)
+
+
+# Header literals of WSGI-style str headers and of raw ASGI headers, whose
+# names are lowercase bytes: content type and Vary names, the image type
+# prefix, the name a new Vary header gets, and the value encoding
+_STR_HEADERS = ("content-type", "vary", "image/", "Vary", None)
+_RAW_HEADERS = (b"content-type", b"vary", b"image/", b"vary", "latin-1")
+
+
+def vary_headers(headers, names, raw=False):
+    """Merge ``names`` into the Vary header of an image response.
+
+    Args:
+        headers: List of ``(name, value)`` pairs, str for WSGI, or bytes
+            for ASGI when ``raw`` is true
+        names: Header names that the response depends on
+        raw: Whether ``headers`` are raw ASGI byte pairs
+
+    Returns:
+        list: ``headers`` with Vary merged in, or unchanged when the
+        response is not an image
+    """
+    content_type, vary, image, vary_name, encoding = _RAW_HEADERS if raw else _STR_HEADERS
+    vary_index = None
+    is_image = False
+    for index, (name, value) in enumerate(headers):
+        name = name.lower()
+        if name == content_type:
+            is_image = value[:6].lower() == image
+        elif name == vary:
+            vary_index = index
+    if not is_image:
+        return headers
+    headers = list(headers)
+    if vary_index is None:
+        merged = merge_vary(None, names)
+        headers.append((vary_name, merged if encoding is None else merged.encode(encoding)))
+    else:
+        name, value = headers[vary_index]
+        merged = merge_vary(value if encoding is None else value.decode(encoding), names)
+        headers[vary_index] = (name, merged if encoding is None else merged.encode(encoding))
+    return headers
+
+
+class VariantCache:
+    """Per-process memo of which image variants exist on disk.
+
+    Superseded by ``VariantResolver``, which the middleware uses; kept for
+    code that constructs it directly.
+
+    ``resolve("photos/cat", choice)`` looks for ``photos/cat.avif``,
+    ``photos/cat.webp`` and so on under ``root``, in the order of
+    ``formats`` restricted to what the client accepts, then for the
+    ``FALLBACK_VARIANTS``. The answer is remembered per name and
+    capability set, so each combination is stat'ed once per process;
+    call ``clear()`` after changing the files.
+
+    Args:
+        root: Directory the variant names are relative to
+        formats: Preferred formats, best first
+        maxsize: Remembered answers; the oldest is dropped beyond that
+    """
+
+    def __init__(self, root, formats=("avif", "webp"), maxsize=65536):
+        for image_format in formats:
+            if image_format not in _FORMAT_BITS:
+                raise ValueError(f"unknown image format {image_format!r}")
+        self.root = os.path.abspath(root)
+        self.formats = tuple(formats)
+        self.maxsize = maxsize
+        self._mask = 0
+        for image_format in self.formats:
+            self._mask |= _FORMAT_BITS[image_format]
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, name, choice):
+        """Return the best existing ``Variant`` for ``name``, or None.
+
+        Args:
+            name: Path relative to ``root``, without extension
+            choice: A ``FormatChoice`` or a capability bitmask
+        """
+        capabilities = choice.capabilities if isinstance(choice, FormatChoice) else choice
+        key = (name, capabilities & self._mask)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+
+        base = os.path.normpath(os.path.join(self.root, name))
+        variant = None
+        if base.startswith(self.root + os.sep):
+            for image_format in self.formats:
+                path = f"{base}.{image_format}"
+                if capabilities & _FORMAT_BITS[image_format] and os.path.isfile(path):
+                    variant = Variant(path, image_format, f"image/{image_format}")
+                    break
+            else:
+                for extension, mime_type in FALLBACK_VARIANTS:
+                    path = f"{base}.{extension}"
+                    if os.path.isfile(path):
+                        variant = Variant(path, extension, mime_type)
+                        break
+
+        if self.maxsize > 0:
+            # Serialized, as the middleware shares the cache between threads
+            with self._lock:
+                if len(self._resolved) >= self.maxsize:
+                    del self._resolved[next(iter(self._resolved))]
+                self._resolved[key] = variant
+        return variant
+
+    def clear(self):
+        with self._lock:
+            self._resolved.clear()
@@ -0,0 +1,818 @@
+"""Pure-Python backend, used when the extension could not be built.
+
+Detection follows ``modern_image_support_c.h`` rule for rule: the tokens
+of the rule table are compiled into one regular expression that finds
+every token and the version after it in a single pass. Results are
+remembered per User-Agent, and parsed Accept and Sec-CH-UA headers per
+header, so the repeated values that make up most traffic cost a dict
+lookup. The cache is on by default here; see ``configure_cache()``.
+
+Functions that need the native code raise ``RuntimeError``: the shared
+cache and, without pyarrow, Arrow columns.
+"""
+import mmap
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from . import _rules
+from ._formats import FORMAT_NAMES
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+SharedCacheInfo = namedtuple("SharedCacheInfo", ["hits", "misses", "slots", "used", "name"])
+DetectionStats = namedtuple("DetectionStats", ["calls", "rules", "unmatched", "cached", "shared_cached",
+                                               "latency", "latency_count", "latency_sum"])
+
+WEBP = 0x01
+AVIF = 0x02
+JXL = 0x04
+HEIC = 0x08
+ANIMATED_AVIF = 0x10
+FORMAT_ALL = 0x1f
+
+_CHOICES = {
+    AVIF: ("avif", "image/avif"),
+    WEBP: ("webp", "image/webp"),
+    0: (None, None),
+}
+
+# Mirrors browser_versions in modern_image_support_c.h
+_BUILTIN_RULES = [
+    ("OPR", {"webp": 19, "avif": 71, "animated_avif": 80}, ("Opera", "Blink", "Chrome")),
+    ("SamsungBrowser", {"webp": 4, "avif": 14, "animated_avif": 17}, ("Samsung Internet", "Blink", "Chrome")),
+    ("UCBrowser", {"webp": 12}, ("UC Browser", "Blink", "Chrome")),
+    ("QQBrowser", {"webp": 10}, ("QQ Browser", "Blink", "Chrome")),
+    ("Edge", {"webp": 18, "avif": 85, "animated_avif": 121}, ("Edge", "EdgeHTML", "Edge")),
+    ("Edg", {"webp": 79, "avif": 121, "animated_avif": 121}, ("Edge", "Blink", "Chrome")),
+    ("Firefox", {"webp": 65, "avif": 93, "animated_avif": 113}, ("Firefox", "Gecko", "Firefox")),
+    ("Chrome", {"webp": 32, "avif": 85, "animated_avif": 94}, ("Chrome", "Blink", "Chrome")),
+    ("Version", {"webp": 14, "avif": 16, "jxl": 17, "heic": 17, "animated_avif": 17},
+     ("Safari", "WebKit", "AppleWebKit")),
+    ("AppleWebKit", {"webp": 605, "avif": 612}, ("WebKit", "WebKit", "AppleWebKit")),
+]
+
+# Mirrors client_hint_brands: Sec-CH-UA brand -> rule token
+_CLIENT_HINT_BRANDS = {
+    b"Chromium": "Chrome",
+    b"Google Chrome": "Chrome",
+    b"Microsoft Edge": "Edg",
+    b"Opera": "OPR",
+    b"Samsung Internet": "SamsungBrowser",
+}
+
+# MAX_VERSION_GAP and MAX_VERSION_DIGITS: the digits start within 8 bytes
+# of the token and at most 9 of them are read. A lookahead, so the bytes
+# after a token are still searched for the next one.
+_VERSION_AFTER = rb"(?:(?=[^0-9]{0,7}([0-9]{1,9})(?:\.([0-9]{1,9}))?))?"
+# Grouped as in the token expression, for reading a version on its own
+_VERSION = re.compile(b"()" + _VERSION_AFTER)
+_HINT_VERSION = re.compile(rb"[0-9]{1,9}")
+# The rest of a quoted string, backslash escapes included
+_STRING_END = re.compile(rb'(?:[^"\\]|\\.)*"', re.S)
+_MEDIA_RANGE = re.compile(rb"[ \t]*([^;, \t]*)([^,]*)")
+_Q_VALUE = re.compile(rb";[ \t]*[qQ]=([0-9.]*)")
+_NONZERO = re.compile(rb"[1-9]")
+
+# Entries of the parse record, SCAN_RECORD_MAX
+_RECORD_MAX = 16
+# Detection statistics slots after the rule indexes, as enum stats_slot
+_MAX_RULES = 256
+_UNMATCHED, _CACHED, _SHARED_CACHED = _MAX_RULES, _MAX_RULES + 1, _MAX_RULES + 2
+_LATENCY_BUCKETS = 32
+
+
+def _overlapping(tokens):
+    # Whether an occurrence of one token can start inside another's
+    for outer in tokens:
+        for offset in range(1, len(outer)):
+            rest = outer[offset:]
+            if any(rest.startswith(inner) or inner.startswith(rest) for inner in tokens):
+                return True
+    return False
+
+
+class _RuleTable:
+    """A rule table compiled into one expression matching all its tokens.
+
+    Each match of the expression is a token with the version after it.
+    Tokens matching at the same position are prefixes of the longest one,
+    which the expression prefers, so one match stands for all of them.
+    """
+
+    def __init__(self, rules):
+        if len(rules) > _MAX_RULES:
+            raise ValueError("a rule table can hold at most 256 browser tokens")
+        index = {token: i for i, (token, _, _) in enumerate(rules)}
+        self.tokens = [token for token, _, _ in rules]
+        self.families = [details[0] for _, _, details in rules]
+        self.engines = [details[1] for _, _, details in rules]
+        self.engine_rules = [-1 if details[2] is None else index[details[2]] for _, _, details in rules]
+        # Capability bits each rule grants: [(bit, min_version)]
+        self.minimums = [[(1 << i, minimums[name]) for i, name in enumerate(FORMAT_NAMES) if name in minimums]
+                         for _, minimums, _ in rules]
+        self.hint_rules = {brand: index[token] for brand, token in _CLIENT_HINT_BRANDS.items() if token in index}
+        # Parsed Sec-CH-UA headers, which depend on the table
+        self.hint_memo = {}
+        encoded = sorted((token.encode("ascii") for token in self.tokens), key=len, reverse=True)
+        pattern = b"(" + b"|".join(re.escape(token) for token in encoded) + b")" + _VERSION_AFTER
+        # Matches never overlap, so with tokens such as "AB" and "BC" every
+        # position has to be tried on its own
+        if _overlapping(encoded):
+            pattern = b"(?=" + pattern + b")"
+        self.pattern = re.compile(pattern)
+        # Per matched token, the rules it stands for, how much further from
+        # the version each one ends, and for a prefix whose rest holds a
+        # digit, None: its version is read on its own
+        self.matching = {}
+        for token in encoded:
+            self.matching[token] = [
+                (index[other.decode("ascii")], len(other),
+                 None if re.search(rb"[0-9]", token[len(other):]) else len(token) - len(other))
+                for other in encoded if token.startswith(other)]
+
+    def version_capabilities(self, rule, version):
+        capabilities = 0
+        for bit, min_version in self.minimums[rule]:
+            if version >= min_version:
+                capabilities |= bit
+        return capabilities
+
+    def scan(self, data, record=None):
+        """Return the capabilities and the first matched rule, or -1.
+
+        With ``record``, also appends ``(rule, major, minor)`` for each
+        matched rule, versions being -1 when absent.
+        """
+        capabilities = 0
+        family = _MAX_RULES
+        seen = set()
+        for match in self.pattern.finditer(data):
+            for rule, length, extra in self.matching[match.group(1)]:
+                if rule in seen:
+                    continue
+                seen.add(rule)
+                if rule < family:
+                    family = rule
+                version = match
+                if extra is None:
+                    version = _VERSION.match(data, match.start(1) + length)
+                elif extra and version.start(2) - version.end(1) + extra >= 8:
+                    version = None
+                major = None if version is None else version.group(2)
+                if record is not None and len(record) < _RECORD_MAX:
+                    minor = None if major is None else version.group(3)
+                    record.append((rule, -1 if major is None else int(major), -1 if minor is None else int(minor)))
+                if major is not None:
+                    capabilities |= self.version_capabilities(rule, int(major))
+        return capabilities, (family if family != _MAX_RULES else -1)
+
+
+_builtin_table = _RuleTable(_BUILTIN_RULES)
+_active_table = _builtin_table
+_max_scan_length = 2048
+_config_lock = threading.RLock()
+
+
+def _data(user_agent):
+    # The bytes detection reads; str is encoded like the extension does
+    if type(user_agent) is bytes:
+        data = user_agent
+    elif isinstance(user_agent, str):
+        data = user_agent.encode("utf-8")
+    else:
+        data = bytes(memoryview(user_agent))
+    if _max_scan_length and len(data) > _max_scan_length:
+        data = data[:_max_scan_length]
+    return data
+
+
+# Capabilities per User-Agent object (str or bytes), evicted first in,
+# first out; str keys are interned, so a User-Agent is stored once
+_memo = {}
+_memo_size = 4096
+_memo_hits = 0
+_memo_misses = 0
+
+
+def _remember(user_agent, capabilities):
+    global _memo_misses
+    if _memo_size == 0:
+        return
+    _memo_misses += 1
+    if type(user_agent) is str:
+        user_agent = sys.intern(user_agent)
+    elif type(user_agent) is not bytes:
+        return
+    if len(_memo) >= _memo_size:
+        # dicts keep insertion order, so this drops the oldest entry,
+        # unless another thread changes the memo meanwhile
+        try:
+            del _memo[next(iter(_memo))]
+        except (StopIteration, RuntimeError, KeyError):
+            pass
+    _memo[user_agent] = capabilities
+
+
+def _lookup(user_agent):
+    # Called when the memo has no entry for the User-Agent
+    capabilities, _ = _active_table.scan(_data(user_agent))
+    _remember(user_agent, capabilities)
+    return capabilities
+
+
+def _detect(user_agent):
+    global _memo_hits
+    if _counting:
+        return _counted(user_agent)
+    try:
+        capabilities = _memo[user_agent]
+    except (KeyError, TypeError):
+        return _lookup(user_agent)
+    _memo_hits += 1
+    return capabilities
+
+
+def webp_supported(user_agent):
+    """Check if the browser supports WebP format based on User-Agent string."""
+    return _detect(user_agent) & WEBP != 0
+
+
+def avif_supported(user_agent):
+    """Check if the browser supports AVIF format based on User-Agent string."""
+    return _detect(user_agent) & AVIF != 0
+
+
+def capabilities(user_agent):
+    """Detect every supported format in a single pass over the User-Agent."""
+    return _detect(user_agent)
+
+
+def best_format(user_agent):
+    """Return the best image format supported by the browser."""
+    return _CHOICES[_best_format_of(_detect(user_agent))][0]
+
+
+def _best_format_of(capabilities):
+    if capabilities & AVIF:
+        return AVIF
+    if capabilities & WEBP:
+        return WEBP
+    return 0
+
+
+class BrowserInfo:
+    """The browser family, versions and capabilities of one User-Agent.
+
+    Returned by ``parse()``. Versions are None when the User-Agent does not
+    carry them; ``family`` is None when no rule matched. The format
+    properties read the precomputed ``capabilities`` mask.
+    """
+
+    __slots__ = ("family", "major", "minor", "engine", "engine_version", "capabilities")
+
+    def __init__(self, family, major, minor, engine, engine_version, capabilities):
+        self.family = family
+        self.major = major
+        self.minor = minor
+        self.engine = engine
+        self.engine_version = engine_version
+        self.capabilities = capabilities
+
+    @property
+    def webp(self):
+        return self.capabilities & WEBP != 0
+
+    @property
+    def avif(self):
+        return self.capabilities & AVIF != 0
+
+    @property
+    def jxl(self):
+        return self.capabilities & JXL != 0
+
+    @property
+    def heic(self):
+        return self.capabilities & HEIC != 0
+
+    @property
+    def animated_avif(self):
+        return self.capabilities & ANIMATED_AVIF != 0
+
+    @property
+    def best_format(self):
+        return _CHOICES[_best_format_of(self.capabilities)][0]
+
+    def _fields(self):
+        return (self.family, self.major, self.minor, self.engine,
+                self.engine_version, self.capabilities)
+
+    def __eq__(self, other):
+        if not isinstance(other, BrowserInfo):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __reduce__(self):
+        return BrowserInfo, self._fields()
+
+    def __repr__(self):
+        return (f"BrowserInfo(family={self.family!r}, major={self.major!r}, "
+                f"minor={self.minor!r}, engine={self.engine!r}, "
+                f"engine_version={self.engine_version!r}, "
+                f"capabilities={self.capabilities:#x})")
+
+
+def _version(value):
+    return None if value < 0 else value
+
+
+def parse(user_agent):
+    """Parse the browser family, versions and capabilities in one pass."""
+    table = _active_table
+    record = []
+    capabilities, family = table.scan(_data(user_agent), record)
+    if family < 0:
+        return BrowserInfo(None, None, None, None, None, capabilities)
+    major = minor = engine_version = -1
+    for rule, rule_major, rule_minor in record:
+        if rule == family:
+            major, minor = rule_major, rule_minor
+        if rule == table.engine_rules[family]:
+            engine_version = rule_major
+    return BrowserInfo(table.families[family], _version(major), _version(minor),
+                       table.engines[family], _version(engine_version), capabilities)
+
+
+def _header(value):
+    if type(value) is bytes:
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return bytes(memoryview(value))
+
+
+def _accept_scan(accept):
+    # Mirrors accept_scan(): (accepted, refused), or None for a blank header
+    explicit_ok = explicit_zero = 0
+    image_wildcard = any_wildcard = 0  # 0 absent, 1 q>0, 2 q=0
+    any_range = False
+    for member in accept.split(b","):
+        media_range, parameters = _MEDIA_RANGE.match(member).groups()
+        if not media_range:
+            continue
+        any_range = True
+        zero = False
+        for q_value in _Q_VALUE.finditer(parameters):
+            zero = _NONZERO.search(q_value.group(1)) is None
+        media_range = media_range.lower()
+        if media_range == b"image/*":
+            image_wildcard = 2 if zero else 1
+        elif media_range == b"*/*":
+            any_wildcard = 2 if zero else 1
+        elif media_range in _MIME_FORMATS:
+            if zero:
+                explicit_zero |= _MIME_FORMATS[media_range]
+            else:
+                explicit_ok |= _MIME_FORMATS[media_range]
+    if not any_range:
+        return None
+    wildcard = image_wildcard if image_wildcard != 0 else any_wildcard
+    accepted = explicit_ok
+    refused = explicit_zero & ~explicit_ok
+    if wildcard != 1:
+        refused |= _FORMAT_WITH_MIME & ~(explicit_ok | explicit_zero)
+    if refused & AVIF:
+        refused |= ANIMATED_AVIF
+    return accepted, refused
+
+
+_MIME_FORMATS = {b"image/webp": WEBP, b"image/avif": AVIF, b"image/jxl": JXL, b"image/heic": HEIC}
+_FORMAT_WITH_MIME = WEBP | AVIF | JXL | HEIC
+
+
+def _client_hint_capabilities(table, header):
+    # Mirrors client_hint_capabilities(): -1 when no known brand is named
+    capabilities = -1
+    rule = -1
+    position = 0
+    while True:
+        opening = header.find(b'"', position)
+        if opening < 0:
+            break
+        closing = _STRING_END.match(header, opening + 1)
+        if closing is None:
+            break
+        close = closing.end() - 1
+        if opening == 0 or header[opening - 1] != 0x3d:  # '=': a brand
+            rule = table.hint_rules.get(header[opening + 1:close], -1)
+        elif rule >= 0 and opening >= 3 and header[opening - 2] == 0x76 and header[opening - 3] in b"; ":
+            version = _HINT_VERSION.match(header, opening + 1, close)
+            if version is not None:
+                capabilities = max(capabilities, 0) | table.version_capabilities(rule, int(version.group()))
+            rule = -1
+        position = close + 1
+    return capabilities
+
+
+# Parsed Accept and Sec-CH-UA headers, which a site sees few variants of;
+# emptied when full rather than evicting one by one
+_HEADER_MEMO_SIZE = 256
+_accept_memo = {}
+
+
+def _remember_header(memo, header, result):
+    if _memo_size and type(header) in (str, bytes):
+        if len(memo) >= _HEADER_MEMO_SIZE:
+            memo.clear()
+        memo[header] = result
+    return result
+
+
+def negotiated_capabilities(accept=None, user_agent=None, sec_ch_ua=None):
+    """Like ``negotiate``, but return every acceptable format as a bitmask."""
+    accepted = refused = 0
+    if accept is not None:
+        try:
+            decided = _accept_memo[accept]
+        except (KeyError, TypeError):
+            decided = _remember_header(_accept_memo, accept, _accept_scan(_header(accept)))
+        if decided is not None:
+            accepted, refused = decided
+    undecided = FORMAT_ALL & ~(accepted | refused)
+    if undecided and sec_ch_ua is not None:
+        table = _active_table
+        try:
+            hinted = table.hint_memo[sec_ch_ua]
+        except (KeyError, TypeError):
+            hinted = _remember_header(table.hint_memo, sec_ch_ua,
+                                      _client_hint_capabilities(table, _header(sec_ch_ua)))
+        if hinted >= 0:
+            accepted |= hinted & undecided
+            undecided = 0
+    if undecided and user_agent is not None:
+        accepted |= _detect(user_agent) & undecided
+    return accepted
+
+
+def negotiate(accept=None, user_agent=None, sec_ch_ua=None):
+    """Choose an image format from the Accept header and User-Agent."""
+    return _CHOICES[_best_format_of(negotiated_capabilities(accept, user_agent, sec_ch_ua))]
+
+
+CLASS_HEADER = "X-Image-Class"
+
+
+class CapabilityClass(namedtuple("CapabilityClass", ["id", "key"])):
+    """The capability class of a client.
+
+    ``id`` is the negotiated ``ImageFormat`` mask restricted to the formats
+    a site serves, and ``key`` names it for cache keys and headers, such as
+    ``'webp+avif'``, or ``'none'`` for clients with none of the formats.
+    """
+    __slots__ = ()
+
+
+def _class_key(capabilities):
+    names = [name for i, name in enumerate(FORMAT_NAMES) if capabilities & (1 << i)]
+    return "+".join(names) if names else "none"
+
+
+_CLASSES = tuple(CapabilityClass(i, _class_key(i)) for i in range(FORMAT_ALL + 1))
+
+
+def capability_class(accept=None, user_agent=None, formats=WEBP | AVIF, sec_ch_ua=None):
+    """Map a request to a small, stable capability class."""
+    if formats & ~FORMAT_ALL:
+        raise ValueError(f"unknown format bits in {formats:#x}")
+    return _CLASSES[negotiated_capabilities(accept, user_agent, sec_ch_ua) & formats]
+
+
+def class_header(accept=None, user_agent=None, formats=WEBP | AVIF, sec_ch_ua=None):
+    """Return the ``(name, value)`` request header to normalize on."""
+    return (CLASS_HEADER, capability_class(accept, user_agent, formats, sec_ch_ua).key)
+
+
+def capabilities_many(user_agents, workers=1):
+    """Detect the capabilities of many User-Agents; ``workers`` is ignored."""
+    scan = _active_table.scan
+    return bytes([scan(_data(user_agent))[0] for user_agent in user_agents])
+
+
+def webp_supported_many(user_agents, workers=1):
+    """Check WebP support for many User-Agents; ``workers`` is ignored."""
+    return bytes([value & WEBP != 0 for value in capabilities_many(user_agents)])
+
+
+def avif_supported_many(user_agents, workers=1):
+    """Check AVIF support for many User-Agents; ``workers`` is ignored."""
+    return bytes([value & AVIF != 0 for value in capabilities_many(user_agents)])
+
+
+def best_format_many(user_agents, workers=1):
+    """Pick the best format for many User-Agents; ``workers`` is ignored."""
+    return bytes([_best_format_of(value) for value in capabilities_many(user_agents)])
+
+
+def capabilities_column(column, workers=1):
+    """Detect the capabilities of a whole column of User-Agents.
+
+    Arrow columns are read through pyarrow, one Python object per value.
+    Returns the same types as the extension.
+    """
+    arrow = hasattr(column, "__arrow_c_array__") or hasattr(column, "__arrow_c_stream__")
+    if arrow:
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError("reading Arrow columns without the compiled extension "
+                               "requires pyarrow") from None
+        if hasattr(column, "__arrow_c_array__"):
+            values = pyarrow.array(column)
+        else:
+            values = pyarrow.chunked_array(column)
+        if not (pyarrow.types.is_string(values.type) or pyarrow.types.is_large_string(values.type)
+                or pyarrow.types.is_binary(values.type) or pyarrow.types.is_large_binary(values.type)
+                or values.type in (getattr(pyarrow, "string_view", lambda: None)(),
+                                   getattr(pyarrow, "binary_view", lambda: None)())):
+            raise TypeError(f"expected an Arrow string, binary or view array, got type {values.type}")
+        values = values.to_pylist()
+    else:
+        try:
+            view = memoryview(column)
+        except TypeError:
+            raise TypeError(f"expected an Arrow array or a NumPy bytes array, "
+                            f"got {type(column).__name__}") from None
+        if view.ndim != 1 or not view.format.endswith("s"):
+            raise TypeError(f"expected a one-dimensional bytes array (NumPy dtype 'S'), "
+                            f"got buffer format {view.format!r}")
+        width = view.itemsize
+        raw = view.tobytes()
+        # Fixed-width values end at their first NUL byte
+        values = [raw[start:start + width].split(b"\0", 1)[0] for start in range(0, len(raw), width)]
+    scan = _active_table.scan
+    result = bytearray(0 if value is None else scan(_data(value))[0] for value in values)
+    if arrow:
+        return pyarrow.array(result, type=pyarrow.uint8())
+    try:
+        import numpy
+    except ImportError:
+        return bytes(result)
+    return numpy.frombuffer(result, dtype=numpy.uint8)
+
+
+def _combined_user_agent(line, key):
+    # The last quoted field, as combined_user_agent()
+    line = line.rstrip(b" \t\r")
+    if not line.endswith(b'"'):
+        return None
+    close = p = len(line) - 1
+    while p > 0:
+        p = line.rfind(b'"', 0, p)
+        if p < 0:
+            return None
+        if p == 0 or line[p - 1] != 0x5c:
+            return line[p + 1:close]
+    return None
+
+
+def _json_user_agent(line, key):
+    # The raw string value of "key":, as json_user_agent()
+    p = line.find(b'"')
+    while p >= 0:
+        p += 1
+        if line.startswith(key + b'"', p):
+            q = p + len(key) + 1
+            while line[q:q + 1] in (b" ", b"\t"):
+                q += 1
+            if line[q:q + 1] == b":":
+                q += 1
+                while line[q:q + 1] in (b" ", b"\t"):
+                    q += 1
+                if line[q:q + 1] != b'"':
+                    return None
+                end = _STRING_END.match(line, q + 1)
+                return None if end is None else line[q + 1:end.end() - 1]
+        p = line.find(b'"', p)
+    return None
+
+
+_LOG_FORMATS = {"combined": _combined_user_agent, "json": _json_user_agent}
+
+
+def _scan_log(data, start=0, stop=None, format="combined", key="user_agent"):
+    """Tally the User-Agents of the log lines that start in ``data[start:stop]``.
+
+    Finds the User-Agent field like the extension and classifies each
+    distinct value once; returns ``(lines, missing, families, unmatched)``.
+    """
+    field = _LOG_FORMATS[format]
+    key = key.encode("utf-8")
+    if not isinstance(data, (bytes, bytearray, mmap.mmap)):
+        data = bytes(memoryview(data))
+    length = len(data)
+    end = length if stop is None else min(stop, length)
+    table = _active_table
+    families = {}
+    unmatched = {}
+    if start >= end:
+        return 0, 0, families, unmatched
+    line = start
+    if start > 0 and data[start - 1:start] != b"\n":
+        newline = data.find(b"\n", start)
+        line = newline + 1 if newline >= 0 else length
+
+    lines = missing = 0
+    counts = {}
+    while line < end:
+        newline = data.find(b"\n", line)
+        line_end = newline if newline >= 0 else length
+        text = data[line:line_end]
+        line = line_end + 1
+        if text == b"" or text == b"\r":
+            continue
+        lines += 1
+        user_agent = field(text, key)
+        if not user_agent or user_agent == b"-":
+            missing += 1
+            continue
+        counts[user_agent] = counts.get(user_agent, 0) + 1
+
+    for user_agent, count in counts.items():
+        capabilities, family = table.scan(_data(user_agent))
+        if family < 0:
+            unmatched[user_agent] = count
+            continue
+        row = families.setdefault(table.families[family], [0] * (len(FORMAT_NAMES) + 1))
+        row[0] += count
+        for i in range(len(FORMAT_NAMES)):
+            if capabilities & (1 << i):
+                row[i + 1] += count
+    return lines, missing, families, unmatched
+
+
+def configure_cache(maxsize):
+    """Resize or disable the result cache, which is on by default here.
+
+    Without the native scanner, detection is only fast for User-Agents
+    already seen, so this backend starts with 4096 entries. Resizing drops
+    all cached results and statistics; 0 disables the cache.
+    """
+    global _memo_size
+    if maxsize < 0:
+        raise OverflowError("can't convert negative value to size_t")
+    with _config_lock:
+        _memo_size = maxsize
+        cache_clear()
+
+
+def cache_info():
+    """Report cache statistics, like ``functools.lru_cache``."""
+    return CacheInfo(_memo_hits, _memo_misses, _memo_size, len(_memo))
+
+
+def cache_clear():
+    """Drop all cached results and reset the statistics."""
+    global _memo_hits, _memo_misses
+    _memo.clear()
+    _accept_memo.clear()
+    _active_table.hint_memo.clear()
+    _memo_hits = _memo_misses = 0
+
+
+def set_max_scan_length(length):
+    """Bound how many leading bytes of a User-Agent detection reads."""
+    global _max_scan_length
+    if length < 0:
+        raise OverflowError("can't convert negative value to size_t")
+    with _config_lock:
+        _max_scan_length = length
+        _memo.clear()
+
+
+def get_max_scan_length():
+    """Return the current scan bound set by ``set_max_scan_length``."""
+    return _max_scan_length
+
+
+def _scan_level(level=None):
+    """Return the token scanner in use: 0, the regular expression here."""
+    return 0
+
+
+def load_rules(source):
+    """Replace the browser support table at runtime."""
+    global _active_table
+    table = _RuleTable(_rules.read_rules(source))
+    with _config_lock:
+        _active_table = table
+        _memo.clear()
+        reset_stats()
+
+
+def reset_rules():
+    """Switch back to the browser support table built into the package."""
+    global _active_table
+    with _config_lock:
+        _active_table = _builtin_table
+        _memo.clear()
+        reset_stats()
+
+
+def open_shared_cache(name=None, slots=65536):
+    """Not available without the compiled extension."""
+    raise RuntimeError("the shared cache requires the compiled extension")
+
+
+def close_shared_cache(unlink=False):
+    """Do nothing; no shared cache can be open without the extension."""
+
+
+def shared_cache_info():
+    """Return None; no shared cache can be open without the extension."""
+    return None
+
+
+_counting = False
+_sample_every = 0
+_countdown = 0
+_counts = [0] * (_MAX_RULES + 3)
+_latency = [0] * _LATENCY_BUCKETS
+_latency_ns = 0
+
+
+def _counted(user_agent):
+    # _detect() with the detection counted, and one in _sample_every timed
+    global _countdown, _latency_ns, _memo_hits
+    timed = _sample_every != 0 and _countdown == 0
+    if _sample_every != 0:
+        _countdown = _sample_every - 1 if timed else _countdown - 1
+    if timed:
+        start = time.perf_counter_ns()
+    try:
+        capabilities = _memo[user_agent]
+        _memo_hits += 1
+        slot = _CACHED
+    except (KeyError, TypeError):
+        capabilities, family = _active_table.scan(_data(user_agent))
+        _remember(user_agent, capabilities)
+        slot = family if family >= 0 else _UNMATCHED
+    _counts[slot] += 1
+    if timed:
+        elapsed = time.perf_counter_ns() - start
+        _latency[min(max(elapsed.bit_length() - 1, 0), _LATENCY_BUCKETS - 1)] += 1
+        _latency_ns += elapsed
+    return capabilities
+
+
+def configure_stats(enabled=True, sample_every=64):
+    """Turn the detection counters read by ``stats()`` on or off.
+
+    Here detections are timed in nanoseconds and the result cache counts
+    as ``cached``.
+    """
+    global _counting, _sample_every, _countdown
+    if sample_every < 0:
+        raise OverflowError("can't convert negative value to unsigned int")
+    with _config_lock:
+        _sample_every = sample_every
+        _countdown = 0
+        _counting = bool(enabled)
+
+
+def stats():
+    """Report the detection counters of this process."""
+    table = _active_table
+    counts = _counts[:len(table.tokens)]
+    buckets = []
+    total = 0
+    for bucket, count in enumerate(_latency):
+        total += count
+        upper = 2 ** (bucket + 1) / 1e9 if bucket + 1 < _LATENCY_BUCKETS else float("inf")
+        buckets.append((upper, total))
+    outcomes = [_counts[_UNMATCHED], _counts[_CACHED], _counts[_SHARED_CACHED]]
+    return DetectionStats(sum(counts) + sum(outcomes), dict(zip(table.tokens, counts)), *outcomes,
+                          tuple(buckets), total, _latency_ns / 1e9)
+
+
+def reset_stats():
+    """Zero the detection counters and latency histogram."""
+    global _latency_ns
+    _counts[:] = [0] * len(_counts)
+    _latency[:] = [0] * len(_latency)
+    _latency_ns = 0
+
+
+def _reset_process_stats():
+    global _memo_hits, _memo_misses
+    _memo_hits = _memo_misses = 0
+    reset_stats()
+
+
+if hasattr(os, "register_at_fork"):
+    # Forked workers report their own statistics, not the master's
+    os.register_at_fork(after_in_child=_reset_process_stats)
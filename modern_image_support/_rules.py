@@ -0,0 +1,136 @@
+"""Reading browser support rules from JSON/TOML files or Python data.
+
+A rule file holds a flat list of ``(browser token, format, minimum
+version)`` entries::
+
+    {"rules": [
+        {"browser": "Chrome", "format": "avif", "min_version": 85},
+        {"browser": "Chrome", "format": "webp", "min_version": 32}
+    ]}
+
+or the TOML equivalent using ``[[rules]]`` tables. Entries for the same
+token are merged into one rule, in order of first appearance.
+
+An optional ``browsers`` mapping describes tokens for ``parse()``::
+
+    {"browsers": {
+        "OPR": {"family": "Opera", "engine": "Blink", "engine_token": "Chrome"}
+    }}
+
+``family`` defaults to the token itself. ``engine_token`` names the rule
+whose version is reported as the engine version and defaults to the token
+itself when ``engine`` is given.
+"""
+
+import json
+import os
+
+from ._formats import FORMAT_NAMES
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Tokens are matched byte for byte, so keep them short printable ASCII
+MAX_TOKEN_LENGTH = 64
+# Versions are read as at most MAX_VERSION_DIGITS (9) digits, so no
+# version reaches a larger minimum
+MAX_VERSION = 999_999_999
+
+
+def _load_file(path):
+    path = os.fspath(path)
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise RuntimeError("reading TOML rules requires Python 3.11+ or the 'tomli' package")
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _read_browsers(browsers, tokens):
+    """Validate the ``browsers`` mapping against the rule tokens."""
+    if not isinstance(browsers, dict):
+        raise ValueError("'browsers' must map browser tokens to their details")
+    details = {}
+    for token, info in browsers.items():
+        if token not in tokens:
+            raise ValueError(f"browsers: {token!r} has no rules")
+        if not isinstance(info, dict) or not set(info) <= {"family", "engine", "engine_token"}:
+            raise ValueError(
+                f"browsers: {token!r} must be a mapping of 'family', 'engine' and 'engine_token'"
+            )
+        family = info.get("family", token)
+        engine = info.get("engine")
+        engine_token = info.get("engine_token", token if engine is not None else None)
+        for name, value in (("family", family), ("engine", engine)):
+            if (value is not None or name == "family") and (not isinstance(value, str) or not value):
+                raise ValueError(f"browsers: {token!r} {name} must be a non-empty string")
+        if engine_token is not None and engine_token not in tokens:
+            raise ValueError(f"browsers: {token!r} engine_token {engine_token!r} has no rules")
+        details[token] = (family, engine, engine_token)
+    return details
+
+
+def read_rules(source):
+    """Normalize a rule source into ``[(token, {format: min_version}, details)]``.
+
+    ``details`` is ``(family, engine, engine_token)``; see the module
+    docstring.
+
+    Args:
+        source: Path to a ``.json`` or ``.toml`` file, a mapping with a
+            ``rules`` list, or the list of rule mappings itself
+
+    Raises:
+        ValueError: If an entry is malformed
+    """
+    if isinstance(source, (str, os.PathLike)):
+        source = _load_file(source)
+    browsers = {}
+    if isinstance(source, dict):
+        if "rules" not in source:
+            raise ValueError("rule data has no 'rules' list")
+        browsers = source.get("browsers", {})
+        source = source["rules"]
+
+    merged = {}
+    for index, entry in enumerate(source):
+        try:
+            token = entry["browser"]
+            image_format = entry["format"]
+            min_version = entry["min_version"]
+        except (KeyError, TypeError):
+            raise ValueError(
+                f"rule {index} must have 'browser', 'format' and 'min_version'"
+            ) from None
+        if (
+            not isinstance(token, str)
+            or not 0 < len(token) <= MAX_TOKEN_LENGTH
+            or not token.isascii()
+            or not token.isprintable()
+        ):
+            raise ValueError(f"rule {index}: invalid browser token {token!r}")
+        if image_format not in FORMAT_NAMES:
+            raise ValueError(
+                f"rule {index}: unknown format {image_format!r}, expected one of {FORMAT_NAMES}"
+            )
+        if (
+            isinstance(min_version, bool)
+            or not isinstance(min_version, int)
+            or not 1 <= min_version <= MAX_VERSION
+        ):
+            raise ValueError(
+                f"rule {index}: min_version must be an integer from 1 to {MAX_VERSION}"
+            )
+        merged.setdefault(token, {})[image_format] = min_version
+    details = _read_browsers(browsers, merged)
+    return [
+        (token, minimums, details.get(token, (token, None, None)))
+        for token, minimums in merged.items()
+    ]
@@ -0,0 +1,172 @@
+"""Access-log scanning behind ``python -m modern_image_support scan``.
+
+Plain files are memory-mapped and split into shards at byte offsets. Each
+worker process maps the file itself and scans its shard in C, so only the
+per-shard tallies cross a process boundary. Gzip files and standard input
+are decompressed and scanned chunk by chunk in the calling process.
+Without the compiled extension the same scan runs in pure Python.
+"""
+
+import gzip
+import mmap
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from . import backend, load_rules
+from ._formats import FORMAT_NAMES
+
+if backend == "python":
+    from ._python import _scan_log
+else:
+    from .modern_image_support import _scan_log
+
+# Smallest shard worth handing to another process
+MIN_SHARD = 64 << 20
+
+# Bytes read per scan call when streaming
+CHUNK_SIZE = 16 << 20
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class ScanReport:
+    """Merged tallies of one or more log scans.
+
+    Attributes:
+        lines: Non-empty log lines read
+        missing: Lines without a User-Agent, or with ``-``
+        families: Browser family (the first matching rule token) mapped to
+            ``[requests, webp, avif, jxl, heic, animated_avif]`` counts
+        unmatched: ``Counter`` of the User-Agents no rule matched
+        bytes: Bytes of log data read
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.missing = 0
+        self.families = {}
+        self.unmatched = Counter()
+        self.bytes = 0
+
+    def add(self, result):
+        """Merge one ``(lines, missing, families, unmatched)`` scan result."""
+        lines, missing, families, unmatched = result
+        self.lines += lines
+        self.missing += missing
+        for family, counts in families.items():
+            row = self.families.setdefault(family, [0] * len(counts))
+            for i, count in enumerate(counts):
+                row[i] += count
+        self.unmatched.update(unmatched)
+
+    @property
+    def requests(self):
+        """Lines that carried a User-Agent."""
+        return self.lines - self.missing
+
+    def totals(self):
+        """``[requests, webp, avif, ...]`` over every User-Agent seen."""
+        totals = [self.requests] + [0] * len(FORMAT_NAMES)
+        for row in self.families.values():
+            for i in range(1, len(row)):
+                totals[i] += row[i]
+        return totals
+
+
+def detect_format(head):
+    """Guess the log format from its first bytes: JSON lines start with ``{``."""
+    return "json" if head.lstrip()[:1] == b"{" else "combined"
+
+
+def _init_worker(rules):
+    if rules is not None:
+        load_rules(rules)
+
+
+def _scan_shard(path, start, stop, log_format, key):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if hasattr(data, "madvise"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        return _scan_log(data, start, stop, log_format, key)
+
+
+def _scan_stream(stream, report, log_format, key):
+    pending = b""
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        report.bytes += len(chunk)
+        data = pending + chunk if pending else chunk
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            pending = data
+            continue
+        if log_format == "auto":
+            log_format = detect_format(data[:4096])
+        report.add(_scan_log(data, 0, cut, log_format, key))
+        pending = data[cut:]
+    if pending:
+        if log_format == "auto":
+            log_format = detect_format(pending[:4096])
+        report.add(_scan_log(pending, 0, None, log_format, key))
+
+
+def _scan_mapped(path, size, report, log_format, key, workers, rules, shard_size):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if log_format == "auto":
+            log_format = detect_format(data[:4096])
+        shards = max(1, min(workers, -(-size // shard_size)))
+        if shards == 1:
+            report.add(_scan_log(data, 0, size, log_format, key))
+            return
+    step = -(-size // shards)
+    with ProcessPoolExecutor(shards, initializer=_init_worker, initargs=(rules,)) as pool:
+        futures = [pool.submit(_scan_shard, path, start, min(start + step, size), log_format, key)
+                   for start in range(0, size, step)]
+        for future in futures:
+            report.add(future.result())
+
+
+def scan_files(paths, log_format="auto", key="user_agent", workers=None, rules=None,
+               shard_size=MIN_SHARD, report=None):
+    """Scan access logs and merge their tallies into one report.
+
+    Args:
+        paths: Log file paths; ``-`` reads standard input. Gzip input is
+            recognized by its magic bytes.
+        log_format: ``'combined'``, ``'json'`` or ``'auto'`` to guess from
+            the first line
+        key: The User-Agent key of JSON lines
+        workers: Processes to shard plain files across; None uses
+            ``os.cpu_count()``
+        rules: Rule source loaded in each worker process; the calling
+            process is expected to have loaded the same rules already
+        shard_size: Smallest number of bytes per shard
+        report: A ``ScanReport`` to add to, or None for a new one
+
+    Returns:
+        ScanReport: The merged tallies
+    """
+    if report is None:
+        report = ScanReport()
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    for path in paths:
+        if path == "-":
+            stream = sys.stdin.buffer
+            if stream.peek(2)[:2] == GZIP_MAGIC:
+                stream = gzip.GzipFile(fileobj=stream)
+            _scan_stream(stream, report, log_format, key)
+            continue
+        with open(path, "rb") as f:
+            compressed = f.read(2) == GZIP_MAGIC
+            size = os.fstat(f.fileno()).st_size
+        if compressed:
+            with gzip.open(path, "rb") as stream:
+                _scan_stream(stream, report, log_format, key)
+        elif size > 0:
+            report.bytes += size
+            _scan_mapped(path, size, report, log_format, key, workers, rules, shard_size)
+    return report
@@ -0,0 +1,80 @@
+"""ASGI middleware that negotiates the image format once per request.
+
+Usage with Starlette/FastAPI::
+
+    from modern_image_support.asgi import ImageFormatMiddleware
+
+    app.add_middleware(ImageFormatMiddleware)
+
+    @app.get("/image")
+    async def image(request: Request):
+        choice = request.state.image_choice
+        ...
+"""
+
+from ._middleware import DEFAULT_VARY, ChoiceCache, FormatChoice, Variant, vary_headers
+from .variants import VariantResolver
+
+__all__ = ["ImageFormatMiddleware", "FormatChoice", "Variant", "VariantResolver"]
+
+
+class ImageFormatMiddleware:
+    """Resolve the image format from raw request headers.
+
+    The ``user-agent``, ``accept`` and ``sec-ch-ua`` header bytes are read
+    straight from the ASGI scope without decoding, negotiated in one native
+    call (Client Hints naming a known brand take precedence over the
+    User-Agent), and the resulting ``FormatChoice`` is stored as
+    ``scope["state"]["image_choice"]`` (``request.state.image_choice`` in
+    Starlette).
+    Responses with an ``image/*`` content type get ``vary`` merged into
+    their ``Vary`` header; the default names every header the choice
+    depends on. When ``variant_root`` is given, a ``VariantResolver``
+    indexing it is stored as ``scope["state"]["image_variants"]``.
+
+    Args:
+        app: The ASGI application to wrap
+        cache_size: Entries in the per-worker result cache; 0 disables it
+        vary: Header names added to ``Vary`` on image responses
+        variant_root: Directory of image variants, or None
+        poll_interval: Seconds between refreshes of the variant index, or
+            None to refresh only through ``variants.refresh()``
+    """
+
+    def __init__(self, app, cache_size=4096, vary=DEFAULT_VARY, variant_root=None,
+                 poll_interval=None):
+        self.app = app
+        self.cache = ChoiceCache(cache_size)
+        self.vary = tuple(vary)
+        self.variants = (VariantResolver(variant_root, poll_interval=poll_interval)
+                         if variant_root is not None else None)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        user_agent = accept = sec_ch_ua = None
+        for name, value in scope["headers"]:
+            if name == b"user-agent":
+                user_agent = value
+            elif name == b"accept":
+                accept = value
+            elif name == b"sec-ch-ua":
+                sec_ch_ua = value
+        state = scope.setdefault("state", {})
+        state["image_choice"] = self.cache.resolve(user_agent, accept, sec_ch_ua)
+        if self.variants is not None:
+            state["image_variants"] = self.variants
+
+        if not self.vary:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_vary(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = vary_headers(message.get("headers", []), self.vary, raw=True)
+            await send(message)
+
+        await self.app(scope, receive, send_with_vary)
+
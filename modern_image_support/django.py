@@ -0,0 +1,63 @@
+"""Django middleware that negotiates the image format once per request.
+
+Add it to ``MIDDLEWARE`` and optionally configure it in settings::
+
+    MIDDLEWARE = [
+        ...,
+        "modern_image_support.django.ImageFormatMiddleware",
+    ]
+
+    MODERN_IMAGE_SUPPORT = {
+        "CACHE_SIZE": 4096,
+        "VARIANT_ROOT": BASE_DIR / "static",
+        "VARIANT_POLL_INTERVAL": 30,
+        "VARY": ("Accept", "User-Agent", "Sec-CH-UA"),
+    }
+
+Views then read ``request.image_choice`` and, with ``VARIANT_ROOT`` set,
+``request.image_variants.resolve("sample", request.image_choice)``.
+"""
+
+from ._middleware import DEFAULT_VARY, ChoiceCache, FormatChoice, Variant, VariantCache
+from .variants import VariantResolver
+
+__all__ = ["ImageFormatMiddleware", "FormatChoice", "Variant", "VariantResolver", "VariantCache"]
+
+
+class ImageFormatMiddleware:
+    """Attach the negotiated ``FormatChoice`` to each request.
+
+    Detection results are cached and the variant root is indexed per
+    process, so views neither re-detect nor stat files on each hit. Responses with an
+    ``image/*`` content type get the configured headers added to Vary.
+    """
+
+    sync_capable = True
+    async_capable = False
+
+    def __init__(self, get_response):
+        from django.conf import settings
+
+        options = getattr(settings, "MODERN_IMAGE_SUPPORT", {})
+        self.get_response = get_response
+        self.cache = ChoiceCache(options.get("CACHE_SIZE", 4096))
+        variant_root = options.get("VARIANT_ROOT")
+        self.variants = (
+            VariantResolver(variant_root, poll_interval=options.get("VARIANT_POLL_INTERVAL"))
+            if variant_root is not None
+            else None
+        )
+        self.vary = tuple(options.get("VARY", DEFAULT_VARY))
+
+    def __call__(self, request):
+        meta = request.META
+        request.image_choice = self.cache.resolve(
+            meta.get("HTTP_USER_AGENT"), meta.get("HTTP_ACCEPT"), meta.get("HTTP_SEC_CH_UA")
+        )
+        request.image_variants = self.variants
+        response = self.get_response(request)
+        if self.vary and response.get("Content-Type", "")[:6].lower() == "image/":
+            from django.utils.cache import patch_vary_headers
+
+            patch_vary_headers(response, self.vary)
+        return response
@@ -1,2 +1,4 @@
 cpdef bint webp_supported(user_agent)
-cpdef bint avif_supported(user_agent)
\ No newline at end of file
+cpdef bint avif_supported(user_agent)
+cpdef int capabilities(user_agent)
+cpdef str best_format(user_agent)
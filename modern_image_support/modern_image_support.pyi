@@ -1,23 +1,351 @@
-from typing import Union
+from os import PathLike
+from typing import Any, Dict, Iterable, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
 
-def webp_supported(user_agent: Union[str, bytes]) -> bool:
+UserAgent = Union[str, bytes, bytearray, memoryview]
+
+WEBP: int
+AVIF: int
+JXL: int
+HEIC: int
+ANIMATED_AVIF: int
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+def configure_cache(maxsize: int) -> None:
+    """Enable, resize or disable the detection result cache.
+
+    Args:
+        maxsize: Number of entries to keep; rounded up to a power of two.
+            0 disables the cache.
+    """
+    ...
+
+def cache_info() -> CacheInfo:
+    """Report cache statistics, like ``functools.lru_cache``."""
+    ...
+
+def cache_clear() -> None:
+    """Drop all cached results and reset the statistics."""
+    ...
+
+def set_max_scan_length(length: int) -> None:
+    """Bound how many leading bytes of a User-Agent detection reads.
+
+    Args:
+        length: Bytes to read (default 2048); 0 reads the whole User-Agent
+    """
+    ...
+
+def get_max_scan_length() -> int:
+    """Return the current scan bound set by ``set_max_scan_length``."""
+    ...
+
+class SharedCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    slots: int
+    used: int
+    name: str
+
+def open_shared_cache(name: Optional[str] = None, slots: int = 65536) -> str:
+    """Attach a detection cache shared by every process on the host.
+
+    Args:
+        name: Shared memory name; None creates a new segment
+        slots: Table size for a new segment, rounded down to a power of two
+
+    Returns:
+        The name of the segment, for ``open_shared_cache(name)`` elsewhere
+    """
+    ...
+
+def close_shared_cache(unlink: bool = False) -> None:
+    """Detach this process from the shared cache, optionally removing it."""
+    ...
+
+def shared_cache_info() -> Optional[SharedCacheInfo]:
+    """Report the shared cache statistics of this process, or None."""
+    ...
+
+class DetectionStats(NamedTuple):
+    calls: int
+    rules: Dict[str, int]
+    unmatched: int
+    cached: int
+    shared_cached: int
+    latency: Tuple[Tuple[float, int], ...]
+    latency_count: int
+    latency_sum: float
+
+def configure_stats(enabled: bool = True, sample_every: int = 64) -> None:
+    """Turn the detection counters read by ``stats()`` on or off.
+
+    Args:
+        enabled: Whether to count
+        sample_every: Time one detection in this many; 0 counts without
+            timing
+    """
+    ...
+
+def stats() -> DetectionStats:
+    """Report the detection counters of this process."""
+    ...
+
+def reset_stats() -> None:
+    """Zero the detection counters and latency histogram."""
+    ...
+
+def load_rules(
+    source: Union[str, PathLike, Mapping[str, Any], Sequence[Mapping[str, Any]]]
+) -> None:
+    """Replace the browser support table at runtime.
+
+    Args:
+        source: A ``.json``/``.toml`` rules file, or the parsed rule data
+
+    Raises:
+        ValueError: If the rules are malformed
+    """
+    ...
+
+def reset_rules() -> None:
+    """Switch back to the browser support table built into the extension."""
+    ...
+
+def webp_supported(user_agent: UserAgent) -> bool:
     """Check if the browser supports WebP format based on User-Agent string.
 
     Args:
-        user_agent: The User-Agent string (str or bytes)
+        user_agent: The User-Agent string (str, bytes or any contiguous buffer)
 
     Returns:
         True if WebP is supported, False otherwise
     """
     ...
 
-def avif_supported(user_agent: Union[str, bytes]) -> bool:
+def avif_supported(user_agent: UserAgent) -> bool:
     """Check if the browser supports AVIF format based on User-Agent string.
 
     Args:
-        user_agent: The User-Agent string (str or bytes)
+        user_agent: The User-Agent string (str, bytes or any contiguous buffer)
 
     Returns:
         True if AVIF is supported, False otherwise
     """
     ...
+
+def capabilities(user_agent: UserAgent) -> int:
+    """Detect every supported format in a single pass over the User-Agent.
+
+    Args:
+        user_agent: The User-Agent string (str, bytes or any contiguous buffer)
+
+    Returns:
+        Bitmask of ``ImageFormat`` values
+    """
+    ...
+
+def best_format(user_agent: UserAgent) -> Optional[str]:
+    """Return the best image format supported by the browser.
+
+    Args:
+        user_agent: The User-Agent string (str, bytes or any contiguous buffer)
+
+    Returns:
+        ``'avif'``, ``'webp'`` or None if neither is supported
+    """
+    ...
+
+class BrowserInfo:
+    """The browser family, versions and capabilities of one User-Agent."""
+
+    @property
+    def family(self) -> Optional[str]: ...
+    @property
+    def major(self) -> Optional[int]: ...
+    @property
+    def minor(self) -> Optional[int]: ...
+    @property
+    def engine(self) -> Optional[str]: ...
+    @property
+    def engine_version(self) -> Optional[int]: ...
+    @property
+    def capabilities(self) -> int: ...
+    @property
+    def webp(self) -> bool: ...
+    @property
+    def avif(self) -> bool: ...
+    @property
+    def jxl(self) -> bool: ...
+    @property
+    def heic(self) -> bool: ...
+    @property
+    def animated_avif(self) -> bool: ...
+    @property
+    def best_format(self) -> Optional[str]: ...
+    def __init__(
+        self,
+        family: Optional[str],
+        major: Optional[int],
+        minor: Optional[int],
+        engine: Optional[str],
+        engine_version: Optional[int],
+        capabilities: int,
+    ) -> None: ...
+
+def parse(user_agent: UserAgent) -> BrowserInfo:
+    """Parse the browser family, versions and capabilities in one pass.
+
+    Args:
+        user_agent: The User-Agent string (str, bytes or any contiguous buffer)
+
+    Returns:
+        ``family``, ``major``, ``minor``, ``engine``, ``engine_version`` and
+        the ``capabilities`` mask
+    """
+    ...
+
+def negotiate(
+    accept: Optional[UserAgent] = None,
+    user_agent: Optional[UserAgent] = None,
+    sec_ch_ua: Optional[UserAgent] = None,
+) -> Tuple[Optional[str], Optional[str]]:
+    """Choose an image format from the Accept header and User-Agent.
+
+    Explicitly listed formats are decided by their q-value. The rest are
+    decided by the Client Hints when they name a known brand, and
+    otherwise by scanning the User-Agent.
+
+    Args:
+        accept: The Accept header, if sent
+        user_agent: The User-Agent, if sent
+        sec_ch_ua: The ``Sec-CH-UA`` or ``Sec-CH-UA-Full-Version-List``
+            header, if sent
+
+    Returns:
+        ``(format, mime_type)``, such as ``('avif', 'image/avif')``, or
+        ``(None, None)`` if neither AVIF nor WebP can be served
+    """
+    ...
+
+def negotiated_capabilities(
+    accept: Optional[UserAgent] = None,
+    user_agent: Optional[UserAgent] = None,
+    sec_ch_ua: Optional[UserAgent] = None,
+) -> int:
+    """Like ``negotiate``, but return every acceptable format.
+
+    Returns:
+        Bitmask of ``ImageFormat`` values
+    """
+    ...
+
+CLASS_HEADER: str
+
+class CapabilityClass(NamedTuple):
+    """The capability class of a client: the negotiated ``ImageFormat``
+    mask restricted to the served formats, and its cache-key name."""
+
+    id: int
+    key: str
+
+def capability_class(
+    accept: Optional[UserAgent] = None,
+    user_agent: Optional[UserAgent] = None,
+    formats: int = ...,
+    sec_ch_ua: Optional[UserAgent] = None,
+) -> CapabilityClass:
+    """Map a request to a small, stable capability class.
+
+    Clients that would be served the same variants share a class, so an
+    edge cache keyed on it stores a handful of variants per image. Costs
+    one ``negotiated_capabilities`` call.
+
+    Args:
+        accept: The Accept header, if sent
+        user_agent: The User-Agent, if sent
+        formats: ``ImageFormat`` bits of the formats the site serves;
+            ``WEBP | AVIF`` by default
+        sec_ch_ua: The ``Sec-CH-UA`` header, if sent
+
+    Returns:
+        ``(id, key)``, such as ``(3, 'webp+avif')``
+    """
+    ...
+
+def class_header(
+    accept: Optional[UserAgent] = None,
+    user_agent: Optional[UserAgent] = None,
+    formats: int = ...,
+    sec_ch_ua: Optional[UserAgent] = None,
+) -> Tuple[str, str]:
+    """Return the ``('X-Image-Class', key)`` request header to normalize on."""
+    ...
+
+def capabilities_many(
+    user_agents: Iterable[UserAgent], workers: Optional[int] = 1
+) -> bytes:
+    """Detect the capabilities of many User-Agents in one native call.
+
+    Args:
+        user_agents: The User-Agent strings
+        workers: Threads to split large batches across; None uses
+            ``os.cpu_count()``
+
+    Returns:
+        One ``ImageFormat`` bitmask per User-Agent
+    """
+    ...
+
+def webp_supported_many(
+    user_agents: Iterable[UserAgent], workers: Optional[int] = 1
+) -> bytes:
+    """Check WebP support for many User-Agents in one native call.
+
+    Returns:
+        1 where WebP is supported, 0 elsewhere
+    """
+    ...
+
+def avif_supported_many(
+    user_agents: Iterable[UserAgent], workers: Optional[int] = 1
+) -> bytes:
+    """Check AVIF support for many User-Agents in one native call.
+
+    Returns:
+        1 where AVIF is supported, 0 elsewhere
+    """
+    ...
+
+def best_format_many(
+    user_agents: Iterable[UserAgent], workers: Optional[int] = 1
+) -> bytes:
+    """Pick the best format for many User-Agents in one native call.
+
+    Returns:
+        ``AVIF``, ``WEBP`` or 0 per User-Agent
+    """
+    ...
+
+def capabilities_column(column: Any, workers: Optional[int] = 1) -> Any:
+    """Detect the capabilities of a whole column of User-Agents.
+
+    Accepts Arrow string, large string, binary and string view arrays
+    through the Arrow PyCapsule interface (pyarrow, polars, pandas), and
+    one-dimensional NumPy bytes arrays. Nulls give 0.
+
+    Args:
+        column: The User-Agent column
+        workers: Threads to split large columns across; None uses
+            ``os.cpu_count()``
+
+    Returns:
+        One ``ImageFormat`` bitmask per value: a ``pyarrow.UInt8Array`` for
+        Arrow input when pyarrow is installed, else a NumPy ``uint8`` array,
+        or bytes without NumPy
+    """
+    ...
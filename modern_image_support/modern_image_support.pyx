@@ -1,42 +1,1215 @@
 # modern_image_support.pyx
 cimport cython
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython.buffer cimport (PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE, PyBUF_WRITABLE,
+                             PyBUF_FORMAT, PyBUF_C_CONTIGUOUS)
+from cpython.bytearray cimport PyByteArray_FromStringAndSize, PyByteArray_AS_STRING
+from cpython.mem cimport PyMem_Malloc, PyMem_Calloc, PyMem_Free
+from cpython.pycapsule cimport PyCapsule_GetPointer
+from cpython.unicode cimport PyUnicode_Check
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import sysconfig
+import threading
+import time
 
-cdef extern from "modern_image_support_c.h":
-    bint is_webp_supported(const char *user_agent)
-    bint is_avif_supported(const char *user_agent)
+from . import _rules
+from ._formats import FORMAT_NAMES
+
+cdef extern from "Python.h":
+    const char *PyUnicode_AsUTF8AndSize(object unicode, Py_ssize_t *size) except NULL
+    bint PyBytes_CheckExact(object o)
+    Py_ssize_t PyBytes_GET_SIZE(object o)
+
+cdef extern from "modern_image_support_c.h" nogil:
+    enum: FORMAT_COUNT
+    int FORMAT_WEBP
+    int FORMAT_AVIF
+    int FORMAT_JXL
+    int FORMAT_HEIC
+    int FORMAT_ANIMATED_AVIF
+    int FORMAT_ALL
+    void modern_image_support_init()
+    int scan_level
+    int scan_level_select(int level)
+
+    struct browser_version:
+        const char *name
+        size_t name_len
+        int min_versions[FORMAT_COUNT]
+        const char *family
+        const char *engine
+        int engine_rule
+    struct browser_info:
+        int capabilities
+        int family
+        int major
+        int minor
+        int engine_version
+    struct browser_matcher:
+        const browser_version *rules
+        size_t count
+    browser_matcher default_matcher
+    const browser_matcher *active_matcher
+    bint matcher_build(browser_matcher *matcher, const browser_version *rules, size_t count)
+    void matcher_parse(const browser_matcher *matcher, const char *user_agent, size_t length,
+                       browser_info *info)
+    int cached_capabilities(const char *user_agent, size_t length, int wanted)
+    size_t max_scan_length
+    int best_format_of(int capabilities)
+
+    struct result_cache:
+        size_t maxsize
+        size_t currsize
+        unsigned long long hits
+        unsigned long long misses
+    result_cache default_cache
+    bint cache_configure(result_cache *cache, size_t maxsize)
+    void cache_clear_c "cache_clear"(result_cache *cache)
+
+    struct shared_cache:
+        unsigned long long *slots
+        size_t mask
+        unsigned long long seed
+        unsigned long long hits
+        unsigned long long misses
+    shared_cache shared_cache_c "shared_cache"
+    unsigned long long matcher_fingerprint(const browser_matcher *matcher, size_t window)
+    size_t shared_cache_format(void *memory, size_t size)
+    bint shared_cache_attach(shared_cache *cache, void *memory, size_t size)
+    void shared_cache_detach(shared_cache *cache)
+    size_t shared_cache_used(const shared_cache *cache)
+
+    enum batch_mode:
+        BATCH_CAPABILITIES
+        BATCH_WEBP
+        BATCH_AVIF
+        BATCH_BEST
+    void detect_many(const browser_matcher *matcher, const char *const *user_agents,
+                     const size_t *lengths, size_t count, int mode, unsigned char *out)
+
+    struct ArrowSchema:
+        const char *format
+        void (*release)(ArrowSchema *)
+    struct ArrowArray:
+        long long length
+        void (*release)(ArrowArray *)
+    struct ArrowArrayStream:
+        int (*get_schema)(ArrowArrayStream *, ArrowSchema *out)
+        int (*get_next)(ArrowArrayStream *, ArrowArray *out)
+        const char *(*get_last_error)(ArrowArrayStream *)
+    enum column_layout:
+        COLUMN_FIXED
+    struct ua_column:
+        int layout
+        size_t length
+        size_t width
+        const void *values
+    bint column_from_arrow(ua_column *column, const char *format, const ArrowArray *array)
+    void detect_column(const browser_matcher *matcher, const ua_column *column,
+                       size_t start, size_t stop, int mode, unsigned char *out)
+    int negotiate_capabilities_c "negotiate_capabilities"(
+        const char *accept, size_t accept_length, const char *user_agent, size_t ua_length,
+        const char *client_hints, size_t hints_length)
+
+    struct ua_tally_entry:
+        unsigned long long count
+        size_t offset
+        unsigned int length
+        short family
+        unsigned char capabilities
+    struct ua_tally:
+        ua_tally_entry *entries
+        size_t capacity
+        unsigned long long lines
+        unsigned long long missing
+    enum log_format:
+        LOG_COMBINED
+        LOG_JSON
+    enum:
+        STATS_UNMATCHED
+        STATS_CACHED
+        STATS_SHARED_CACHED
+        STATS_SLOTS
+        STATS_LATENCY_BUCKETS
+    struct detection_stats:
+        unsigned long long counts[STATS_SLOTS]
+        unsigned long long latency[STATS_LATENCY_BUCKETS]
+        unsigned long long latency_ticks
+    detection_stats detection_stats_c "detection_stats"
+    bint stats_enabled
+    void stats_configure(bint enabled, unsigned int sample_every)
+    void stats_reset()
+    unsigned long long stats_ticks()
+
+    bint tally_init(ua_tally *tally, size_t capacity)
+    void tally_free(ua_tally *tally)
+    bint log_scan(const browser_matcher *matcher, const char *data, size_t length,
+                  size_t start, size_t stop, int format, const char *key, size_t key_length,
+                  ua_tally *tally)
+
+modern_image_support_init()
+
+# Without the GIL, detection runs concurrently with load_rules() and
+# close_shared_cache(). The rule tables and shared memory those replace are
+# then retired, kept for the life of the process, rather than freed under
+# a running call. The cffi backend, which calls C without the GIL, turns
+# this on as well.
+_retire_replaced = bool(sysconfig.get_config_var('Py_GIL_DISABLED'))
+cdef list _retired = []
+# Serializes the calls that reconfigure the module
+cdef object _config_lock = threading.RLock()
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+SharedCacheInfo = namedtuple('SharedCacheInfo', ['hits', 'misses', 'slots', 'used', 'name'])
+DetectionStats = namedtuple('DetectionStats', ['calls', 'rules', 'unmatched', 'cached', 'shared_cached',
+                                               'latency', 'latency_count', 'latency_sum'])
+
+WEBP = FORMAT_WEBP
+AVIF = FORMAT_AVIF
+JXL = FORMAT_JXL
+HEIC = FORMAT_HEIC
+ANIMATED_AVIF = FORMAT_ANIMATED_AVIF
+
+# (format, MIME type) for each value of best_format_of()
+cdef dict _CHOICES = {
+    FORMAT_AVIF: ('avif', 'image/avif'),
+    FORMAT_WEBP: ('webp', 'image/webp'),
+    0: (None, None),
+}
+
+def configure_cache(size_t maxsize):
+    """Enable, resize or disable the detection result cache.
+
+    The cache is off by default. When enabled, results are keyed by a hash
+    of the User-Agent bytes and evicted least-recently-used first.
+    Resizing drops all cached results and statistics.
+
+    Args:
+        maxsize (int): Number of entries to keep; rounded up to a power of
+            two. 0 disables the cache.
+    """
+    if not cache_configure(&default_cache, maxsize):
+        raise MemoryError()
+
+def cache_info():
+    """Report cache statistics, like ``functools.lru_cache``.
+
+    Returns:
+        CacheInfo: Named tuple of ``hits``, ``misses``, ``maxsize`` and
+        ``currsize``
+    """
+    return CacheInfo(default_cache.hits, default_cache.misses,
+                     default_cache.maxsize, default_cache.currsize)
+
+def cache_clear():
+    """Drop all cached results and reset the statistics."""
+    cache_clear_c(&default_cache)
+
+def set_max_scan_length(size_t length):
+    """Bound how many leading bytes of a User-Agent detection reads.
+
+    Browsers put their product tokens at the start of the User-Agent, so
+    the default of 2048 bytes keeps the cost of oversized or hostile input
+    flat without changing real-world results. The result cache is
+    cleared, since its entries were computed under the old bound.
+
+    Args:
+        length (int): Bytes to read; 0 reads the whole User-Agent
+    """
+    global max_scan_length
+    with _config_lock:
+        max_scan_length = length
+        cache_clear_c(&default_cache)
+        _reseed_shared_cache()
+
+def get_max_scan_length():
+    """Return the current scan bound set by ``set_max_scan_length``."""
+    return max_scan_length
+
+def _scan_level(level=None):
+    """Return the token scanner in use, after switching to ``level``.
+
+    Levels are 0 (scalar), 1 (SSE2 on x86-64, NEON on AArch64) and 2
+    (AVX2), capped at what the CPU supports; the fastest is picked at
+    import. For benchmarks and tests.
+    """
+    if level is not None:
+        scan_level_select(level)
+    return scan_level
+
+# perf_counter_ns() and stats_ticks() when stats were last enabled, which
+# stats() compares against to convert ticks into seconds
+cdef object _stats_clock = None
+
+def configure_stats(bint enabled=True, unsigned int sample_every=64):
+    """Turn the detection counters read by ``stats()`` on or off.
+
+    Every single-call User-Agent detection (``webp_supported``,
+    ``negotiate`` and the like, but not the batch and column calls) is
+    counted under the rule that decided it, or as unmatched or answered by
+    a cache. The deciding rule is the family ``parse()`` reports, the
+    first in table order among the rules matched in the scan window, so
+    it does not depend on which function was called; counting therefore
+    reads the whole window. One in ``sample_every`` is also timed with the
+    CPU cycle counter. Counters are off by default; while off, detection
+    pays for one predictable branch.
+
+    Args:
+        enabled (bool): Whether to count
+        sample_every (int): Time one detection in this many;
+            0 counts without timing
+    """
+    global _stats_clock
+    with _config_lock:
+        if enabled and not stats_enabled:
+            _stats_clock = (time.perf_counter_ns(), stats_ticks())
+        stats_configure(enabled, sample_every)
+
+def stats():
+    """Report the detection counters of this process.
+
+    Counters keep their values while disabled, and start over on
+    ``reset_stats()``, ``load_rules()``, ``reset_rules()`` and in forked
+    children. ``latency`` follows the Prometheus histogram layout.
+
+    Returns:
+        DetectionStats: Named tuple of ``calls``; ``rules``, a dict of
+        detections per browser token of the active table; ``unmatched``,
+        ``cached`` and ``shared_cached`` detections; ``latency``, a tuple
+        of ``(upper_bound, count)`` pairs with cumulative counts and bounds
+        in seconds, the last one ``inf``; and ``latency_count`` and
+        ``latency_sum``, the number of timed detections and their total
+        seconds
+    """
+    cdef size_t i
+    with _config_lock:
+        names = [active_matcher.rules[i].name[:active_matcher.rules[i].name_len].decode('ascii')
+                 for i in range(active_matcher.count)]
+        counts = [detection_stats_c.counts[i] for i in range(active_matcher.count)]
+        outcomes = [detection_stats_c.counts[STATS_UNMATCHED], detection_stats_c.counts[STATS_CACHED],
+                    detection_stats_c.counts[STATS_SHARED_CACHED]]
+        latency = [detection_stats_c.latency[i] for i in range(STATS_LATENCY_BUCKETS)]
+        return _stats_result(names, counts, outcomes, latency, detection_stats_c.latency_ticks)
+
+def _stats_result(names, counts, outcomes, latency, latency_ticks):
+    # Shared with the cffi backend, whose counters are read the same way
+    ticks_per_second = 1e9
+    if _stats_clock is not None:
+        started_ns, started_ticks = _stats_clock
+        elapsed_ns = time.perf_counter_ns() - started_ns
+        if elapsed_ns > 0 and stats_ticks() > started_ticks:
+            ticks_per_second = (stats_ticks() - started_ticks) * 1e9 / elapsed_ns
+    buckets = []
+    total = 0
+    for bucket, count in enumerate(latency):
+        total += count
+        upper = 2 ** (bucket + 1) / ticks_per_second if bucket + 1 < len(latency) else float('inf')
+        buckets.append((upper, total))
+    return DetectionStats(sum(counts) + sum(outcomes), dict(zip(names, counts)), *outcomes,
+                          tuple(buckets), total, latency_ticks / ticks_per_second)
+
+def reset_stats():
+    """Zero the detection counters and latency histogram."""
+    stats_reset()
+
+# Bytes before the slots of a shared cache (struct shared_cache_header)
+cdef Py_ssize_t _SHARED_HEADER = 16
+
+# The SharedMemory behind the attached shared cache, and our view of it
+cdef object _shared_memory = None
+cdef Py_buffer _shared_view
+# Named segments are kept out of the resource tracker
+cdef bint _shared_tracked = False
+
+cdef void _reseed_shared_cache():
+    # Results depend on the rules and the scan window, so a process that
+    # changes either moves to keys no other configuration uses
+    shared_cache_c.seed = matcher_fingerprint(active_matcher, max_scan_length)
+
+def _shared_cache_memory():
+    # The SharedMemory behind the open shared cache, or None
+    return _shared_memory
+
+def _reset_shared_stats():
+    shared_cache_c.hits = 0
+    shared_cache_c.misses = 0
+
+if hasattr(os, 'register_at_fork'):
+    # Forked workers report their own statistics, not the master's
+    os.register_at_fork(after_in_child=_reset_shared_stats)
+    os.register_at_fork(after_in_child=reset_stats)
+
+def _untracked_shared_memory(name, create, size=0):
+    # The resource tracker would unlink the segment when this process
+    # exits, pulling it from under the other workers
+    from multiprocessing import shared_memory
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    memory = shared_memory.SharedMemory(name=name, create=create, size=size)
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory
+
+def open_shared_cache(name=None, size_t slots=65536):
+    """Attach a detection cache shared by every process on the host.
+
+    The cache is an open-addressing table in ``multiprocessing``
+    shared memory that maps User-Agent hashes to capability bits. Reads
+    are lock-free and inserts claim a slot with a compare-and-swap, so
+    prefork workers share one warm table instead of warming one each.
+    It is consulted after the process-local cache, if one is configured.
+
+    Create it in the master process before forking, and the workers
+    inherit it. Alternatively, every worker can open the same ``name``:
+    the first one creates the segment and the others attach to it.
+
+    Args:
+        name (str or None): Shared memory name; None creates a new segment
+            that is removed when this process exits
+        slots (int): Table size for a new segment, rounded down to a power
+            of two; 8 bytes each
+
+    Returns:
+        str: The name of the segment, for ``open_shared_cache(name)``
+        in other processes
+    """
+    global _shared_memory, _shared_tracked
+    from multiprocessing import shared_memory
+    with _config_lock:
+        close_shared_cache()
+        size = _SHARED_HEADER + max(slots, 8) * 8
+        created = True
+        _shared_tracked = name is None
+        if name is None:
+            memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            try:
+                memory = _untracked_shared_memory(name, True, size)
+            except FileExistsError:
+                memory = _untracked_shared_memory(name, False)
+                created = False
+        PyObject_GetBuffer(memory.buf, &_shared_view, PyBUF_WRITABLE)
+        _shared_memory = memory
+        if created:
+            shared_cache_format(_shared_view.buf, <size_t>_shared_view.len)
+        # Another worker may have created the segment and not formatted it yet
+        deadline = time.monotonic() + 1.0
+        while not shared_cache_attach(&shared_cache_c, _shared_view.buf, <size_t>_shared_view.len):
+            if time.monotonic() > deadline:
+                close_shared_cache()
+                raise ValueError(f"shared memory {memory.name!r} does not hold a detection cache")
+            time.sleep(0.001)
+        return memory.name
+
+def close_shared_cache(bint unlink=False):
+    """Detach this process from the shared cache.
+
+    Args:
+        unlink (bool): Also remove the segment, once every process that
+            has it open has closed it
+    """
+    global _shared_memory
+    with _config_lock:
+        shared_cache_detach(&shared_cache_c)
+        if _shared_memory is None:
+            return
+        memory, _shared_memory = _shared_memory, None
+        if _retire_replaced:
+            # A call that loaded the table before the detach may still be
+            # reading it, so the view is never released and the mapping stays
+            _retired.append(memory)
+        else:
+            PyBuffer_Release(&_shared_view)
+            memory.close()
+        if unlink:
+            if not _shared_tracked and os.name == 'posix' and sys.version_info < (3, 13):
+                # unlink() unregisters the segment, so register it first
+                from multiprocessing import resource_tracker
+                resource_tracker.register(memory._name, 'shared_memory')
+            memory.unlink()
+
+def shared_cache_info():
+    """Report the shared cache statistics of this process.
+
+    Returns:
+        SharedCacheInfo or None: ``hits`` and ``misses`` of this process,
+        table ``slots``, ``used`` slots across all processes, and the
+        segment ``name``; None when no shared cache is open
+    """
+    if shared_cache_c.slots == NULL:
+        return None
+    return SharedCacheInfo(shared_cache_c.hits, shared_cache_c.misses, shared_cache_c.mask + 1,
+                           shared_cache_used(&shared_cache_c), _shared_memory.name)
+
+@cython.final
+cdef class _RuleTable:
+    """A browser rule table compiled into a matcher at load time."""
+    cdef browser_version *rules
+    cdef browser_matcher matcher
+    cdef list tokens
+    cdef list names
+    cdef readonly list families
+    cdef readonly list engines
+
+    def __cinit__(self, list rules):
+        cdef Py_ssize_t i, j
+        cdef bytes token
+        cdef dict index = {name: i for i, (name, _, _) in enumerate(rules)}
+        self.tokens = [name.encode('ascii') for name, _, _ in rules]
+        self.families = [details[0] for _, _, details in rules]
+        self.engines = [details[1] for _, _, details in rules]
+        # C copies of the names, kept alive with the table
+        self.names = [(family.encode('utf-8'), None if engine is None else engine.encode('utf-8'))
+                      for family, engine in zip(self.families, self.engines)]
+        self.rules = <browser_version *>PyMem_Malloc(max(len(rules), 1) * sizeof(browser_version))
+        if self.rules == NULL:
+            raise MemoryError()
+        for i, (_, minimums, details) in enumerate(rules):
+            token = self.tokens[i]
+            self.rules[i].name = token
+            self.rules[i].name_len = len(token)
+            for j in range(FORMAT_COUNT):
+                self.rules[i].min_versions[j] = minimums.get(FORMAT_NAMES[j], 0)
+            family, engine = self.names[i]
+            self.rules[i].family = family
+            self.rules[i].engine = NULL if engine is None else <const char *>engine
+            self.rules[i].engine_rule = -1 if details[2] is None else index[details[2]]
+        if not matcher_build(&self.matcher, self.rules, len(rules)):
+            raise ValueError("a rule table can hold at most 256 browser tokens")
+
+    def __dealloc__(self):
+        PyMem_Free(self.rules)
+
+cdef list _builtin_names(bint engines):
+    cdef size_t i
+    cdef const browser_version *rule
+    names = []
+    for i in range(default_matcher.count):
+        rule = &default_matcher.rules[i]
+        name = rule.engine if engines else rule.family
+        names.append(None if name == NULL else name.decode('utf-8'))
+    return names
+
+cdef list _BUILTIN_FAMILIES = _builtin_names(False)
+cdef list _BUILTIN_ENGINES = _builtin_names(True)
+
+# Keeps the loaded table alive while active_matcher points into it; None
+# means the built-in table is active
+cdef _RuleTable _active_table = None
+
+def load_rules(source):
+    """Replace the browser support table at runtime.
+
+    The rules are validated and compiled into the same matcher used by
+    the built-in table, then swapped in atomically; batch calls already
+    running keep the table they started with. The result cache is
+    cleared, since its entries came from the old table, and so are the
+    ``stats()`` counters, which are kept per rule.
+
+    Args:
+        source (str, PathLike, dict or list): A ``.json``/``.toml`` rules
+            file, or the parsed rule data
+
+    Raises:
+        ValueError: If the rules are malformed
+    """
+    _install_rules(_rules.read_rules(source))
+
+def _install_rules(list rules):
+    # Activates rules already normalized by _rules.read_rules(); the cffi
+    # backend reads a source once and installs it in both modules
+    global _active_table, active_matcher
+    cdef _RuleTable table = _RuleTable(rules)
+    with _config_lock:
+        if _retire_replaced and _active_table is not None:
+            _retired.append(_active_table)
+        _active_table = table
+        active_matcher = &table.matcher
+        cache_clear_c(&default_cache)
+        _reseed_shared_cache()
+        stats_reset()
+
+def reset_rules():
+    """Switch back to the browser support table built into the extension."""
+    global _active_table, active_matcher
+    with _config_lock:
+        active_matcher = &default_matcher
+        if _retire_replaced and _active_table is not None:
+            _retired.append(_active_table)
+        _active_table = None
+        cache_clear_c(&default_cache)
+        _reseed_shared_cache()
+        stats_reset()
+
+cdef inline const char *_ua_data(user_agent, Py_ssize_t *length, Py_buffer *view,
+                                 bint *acquired) except NULL:
+    # Borrows the User-Agent bytes without copying: bytes directly, str
+    # through its cached UTF-8 form (the data itself for ASCII strings),
+    # anything else through the buffer protocol. `acquired` is set when a
+    # buffer was acquired and must be released.
+    acquired[0] = False
+    if PyBytes_CheckExact(user_agent):
+        length[0] = PyBytes_GET_SIZE(user_agent)
+        return PyBytes_AS_STRING(user_agent)
+    if PyUnicode_Check(user_agent):
+        return PyUnicode_AsUTF8AndSize(user_agent, length)
+    PyObject_GetBuffer(user_agent, view, PyBUF_SIMPLE)
+    acquired[0] = True
+    length[0] = view.len
+    return <const char *>view.buf
+
+cdef int _detect(user_agent, int wanted) except -1:
+    cdef Py_buffer view
+    cdef Py_ssize_t length
+    cdef bint acquired
+    cdef const char *data = _ua_data(user_agent, &length, &view, &acquired)
+    cdef int result = cached_capabilities(data, <size_t>length, wanted)
+    if acquired:
+        PyBuffer_Release(&view)
+    return result
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cpdef bint webp_supported(user_agent):
     """Check if the browser supports WebP format based on User-Agent string.
-    
+
     Args:
-        user_agent (str or bytes): The User-Agent string
-        
+        user_agent (str, bytes or buffer): The User-Agent string
+
     Returns:
         bool: True if WebP is supported, False otherwise
     """
-    cdef bytes ua_bytes
-    if isinstance(user_agent, str):
-        ua_bytes = user_agent.encode('utf-8')
-    else:
-        ua_bytes = user_agent
-    return is_webp_supported(ua_bytes)
+    return _detect(user_agent, FORMAT_WEBP) != 0
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cpdef bint avif_supported(user_agent):
     """Check if the browser supports AVIF format based on User-Agent string.
-    
+
     Args:
-        user_agent (str or bytes): The User-Agent string
-        
+        user_agent (str, bytes or buffer): The User-Agent string
+
     Returns:
         bool: True if AVIF is supported, False otherwise
     """
-    cdef bytes ua_bytes
-    if isinstance(user_agent, str):
-        ua_bytes = user_agent.encode('utf-8')
-    else:
-        ua_bytes = user_agent
-    return is_avif_supported(ua_bytes)
\ No newline at end of file
+    return _detect(user_agent, FORMAT_AVIF) != 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef int capabilities(user_agent):
+    """Detect every supported format in a single pass over the User-Agent.
+
+    Args:
+        user_agent (str, bytes or buffer): The User-Agent string
+
+    Returns:
+        int: Bitmask of ``ImageFormat`` values (``WEBP``, ``AVIF``, ``JXL``,
+        ``HEIC``, ``ANIMATED_AVIF``)
+    """
+    return _detect(user_agent, FORMAT_ALL)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef str best_format(user_agent):
+    """Return the best image format supported by the browser.
+
+    The User-Agent is scanned once for all formats, so this is cheaper
+    than calling ``avif_supported`` and then ``webp_supported``.
+
+    Args:
+        user_agent (str, bytes or buffer): The User-Agent string
+
+    Returns:
+        str or None: ``'avif'``, ``'webp'`` or None if neither is supported
+    """
+    cdef int best = best_format_of(_detect(user_agent, FORMAT_ALL))
+    if best == FORMAT_AVIF:
+        return 'avif'
+    if best == FORMAT_WEBP:
+        return 'webp'
+    return None
+
+@cython.final
+cdef class BrowserInfo:
+    """The browser family, versions and capabilities of one User-Agent.
+
+    Returned by ``parse()``. Versions are None when the User-Agent does not
+    carry them; ``family`` is None when no rule matched. The format
+    properties read the precomputed ``capabilities`` mask.
+    """
+    cdef readonly object family
+    cdef readonly object major
+    cdef readonly object minor
+    cdef readonly object engine
+    cdef readonly object engine_version
+    cdef readonly int capabilities
+
+    def __init__(self, family, major, minor, engine, engine_version, int capabilities):
+        self.family = family
+        self.major = major
+        self.minor = minor
+        self.engine = engine
+        self.engine_version = engine_version
+        self.capabilities = capabilities
+
+    @property
+    def webp(self):
+        return self.capabilities & FORMAT_WEBP != 0
+
+    @property
+    def avif(self):
+        return self.capabilities & FORMAT_AVIF != 0
+
+    @property
+    def jxl(self):
+        return self.capabilities & FORMAT_JXL != 0
+
+    @property
+    def heic(self):
+        return self.capabilities & FORMAT_HEIC != 0
+
+    @property
+    def animated_avif(self):
+        return self.capabilities & FORMAT_ANIMATED_AVIF != 0
+
+    @property
+    def best_format(self):
+        return _CHOICES[best_format_of(self.capabilities)][0]
+
+    cdef tuple _fields(self):
+        return (self.family, self.major, self.minor, self.engine,
+                self.engine_version, self.capabilities)
+
+    def __eq__(self, other):
+        if not isinstance(other, BrowserInfo):
+            return NotImplemented
+        return self._fields() == (<BrowserInfo>other)._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __reduce__(self):
+        return BrowserInfo, self._fields()
+
+    def __repr__(self):
+        return (f"BrowserInfo(family={self.family!r}, major={self.major!r}, "
+                f"minor={self.minor!r}, engine={self.engine!r}, "
+                f"engine_version={self.engine_version!r}, "
+                f"capabilities={self.capabilities:#x})")
+
+cdef inline object _version(int value):
+    return None if value < 0 else value
+
+def parse(user_agent):
+    """Parse the browser family, versions and capabilities in one pass.
+
+    The family is the first browser token in table order found in the
+    User-Agent, so Edge, Opera and Samsung Internet are told apart from
+    the Chrome token they also carry, and Safari from WebKit.
+
+    Args:
+        user_agent (str, bytes or buffer): The User-Agent string
+
+    Returns:
+        BrowserInfo: ``family``, ``major``, ``minor``, ``engine``,
+        ``engine_version`` and the ``capabilities`` mask
+    """
+    cdef Py_buffer view
+    cdef Py_ssize_t length
+    cdef bint acquired
+    cdef browser_info info
+    cdef _RuleTable table = _active_table
+    cdef const browser_matcher *matcher = &default_matcher if table is None else &table.matcher
+    cdef const char *data = _ua_data(user_agent, &length, &view, &acquired)
+    matcher_parse(matcher, data, <size_t>length, &info)
+    if acquired:
+        PyBuffer_Release(&view)
+    if info.family < 0:
+        return BrowserInfo(None, None, None, None, None, info.capabilities)
+    families = _BUILTIN_FAMILIES if table is None else table.families
+    engines = _BUILTIN_ENGINES if table is None else table.engines
+    return BrowserInfo(families[info.family], _version(info.major), _version(info.minor),
+                       engines[info.family], _version(info.engine_version), info.capabilities)
+
+
+cdef int _negotiate(accept, user_agent, sec_ch_ua) except -1:
+    cdef Py_buffer accept_view, ua_view, hints_view
+    cdef bint accept_acquired = False, ua_acquired = False, hints_acquired = False
+    cdef const char *accept_data = NULL
+    cdef const char *ua_data = NULL
+    cdef const char *hints_data = NULL
+    cdef Py_ssize_t accept_length = 0, ua_length = 0, hints_length = 0
+    try:
+        if accept is not None:
+            accept_data = _ua_data(accept, &accept_length, &accept_view, &accept_acquired)
+        if user_agent is not None:
+            ua_data = _ua_data(user_agent, &ua_length, &ua_view, &ua_acquired)
+        if sec_ch_ua is not None:
+            hints_data = _ua_data(sec_ch_ua, &hints_length, &hints_view, &hints_acquired)
+        return negotiate_capabilities_c(accept_data, <size_t>accept_length,
+                                        ua_data, <size_t>ua_length,
+                                        hints_data, <size_t>hints_length)
+    finally:
+        if accept_acquired:
+            PyBuffer_Release(&accept_view)
+        if ua_acquired:
+            PyBuffer_Release(&ua_view)
+        if hints_acquired:
+            PyBuffer_Release(&hints_view)
+
+def negotiate(accept=None, user_agent=None, sec_ch_ua=None):
+    """Choose an image format from the Accept header and User-Agent.
+
+    Formats that ``accept`` lists explicitly are decided by their q-value,
+    and formats it refuses (``q=0``, or not covered by any range) are never
+    chosen. The rest are decided by the ``Sec-CH-UA`` Client Hints when
+    they name a brand the rule table knows (``Chromium``, ``Google Chrome``,
+    ``Microsoft Edge``, ``Opera`` or ``Samsung Internet``), and otherwise
+    by scanning the User-Agent.
+
+    Args:
+        accept (str, bytes, buffer or None): The Accept header, if sent
+        user_agent (str, bytes, buffer or None): The User-Agent, if sent
+        sec_ch_ua (str, bytes, buffer or None): The ``Sec-CH-UA`` or
+            ``Sec-CH-UA-Full-Version-List`` header, if sent
+
+    Returns:
+        tuple: ``(format, mime_type)``, such as ``('avif', 'image/avif')``,
+        or ``(None, None)`` if neither AVIF nor WebP can be served
+    """
+    return _CHOICES[best_format_of(_negotiate(accept, user_agent, sec_ch_ua))]
+
+def negotiated_capabilities(accept=None, user_agent=None, sec_ch_ua=None):
+    """Like ``negotiate``, but return every acceptable format.
+
+    Args:
+        accept (str, bytes, buffer or None): The Accept header, if sent
+        user_agent (str, bytes, buffer or None): The User-Agent, if sent
+        sec_ch_ua (str, bytes, buffer or None): The ``Sec-CH-UA`` or
+            ``Sec-CH-UA-Full-Version-List`` header, if sent
+
+    Returns:
+        int: Bitmask of ``ImageFormat`` values
+    """
+    return _negotiate(accept, user_agent, sec_ch_ua)
+
+# Request header an edge cache can key on instead of the User-Agent
+CLASS_HEADER = 'X-Image-Class'
+
+class CapabilityClass(namedtuple('CapabilityClass', ['id', 'key'])):
+    """The capability class of a client.
+
+    ``id`` is the negotiated ``ImageFormat`` mask restricted to the formats
+    a site serves, and ``key`` names it for cache keys and headers, such as
+    ``'webp+avif'``, or ``'none'`` for clients with none of the formats.
+    """
+    __slots__ = ()
+
+def _class_key(int capabilities):
+    names = [name for i, name in enumerate(FORMAT_NAMES) if capabilities & (1 << i)]
+    return '+'.join(names) if names else 'none'
+
+# One prebuilt class per mask, so classifying a request allocates nothing
+_CLASSES = tuple(CapabilityClass(i, _class_key(i)) for i in range(FORMAT_ALL + 1))
+
+def capability_class(accept=None, user_agent=None, int formats=FORMAT_WEBP | FORMAT_AVIF,
+                     sec_ch_ua=None):
+    """Map a request to a small, stable capability class.
+
+    Clients that would be served the same variants share a class, so an
+    edge cache keyed on the class stores a handful of variants per image
+    rather than one per User-Agent. Costs one ``negotiated_capabilities``
+    call, cache included.
+
+    Args:
+        accept (str, bytes, buffer or None): The Accept header, if sent
+        user_agent (str, bytes, buffer or None): The User-Agent, if sent
+        formats (int): ``ImageFormat`` bits of the formats the site serves
+        sec_ch_ua (str, bytes, buffer or None): The ``Sec-CH-UA`` header, if sent
+
+    Returns:
+        CapabilityClass: ``(id, key)``, such as ``(3, 'webp+avif')``
+
+    Raises:
+        ValueError: If ``formats`` has bits outside ``ImageFormat``
+    """
+    if formats & ~FORMAT_ALL:
+        raise ValueError(f"unknown format bits in {formats:#x}")
+    return _CLASSES[_negotiate(accept, user_agent, sec_ch_ua) & formats]
+
+def class_header(accept=None, user_agent=None, int formats=FORMAT_WEBP | FORMAT_AVIF,
+                 sec_ch_ua=None):
+    """Return the ``(name, value)`` request header to normalize on.
+
+    An edge or shield adds it to the request before the cache lookup, and
+    image responses send ``Vary: X-Image-Class`` instead of varying on
+    ``User-Agent``. Arguments are those of ``capability_class``.
+
+    Returns:
+        tuple: ``('X-Image-Class', key)``
+    """
+    return (CLASS_HEADER, capability_class(accept, user_agent, formats, sec_ch_ua).key)
+
+# Smallest share of a batch worth handing to another thread
+cdef Py_ssize_t _MIN_CHUNK = 16384
+
+@cython.final
+cdef class _Batch:
+    """User-Agent pointers and the output buffer of one batch call."""
+    cdef const char **user_agents
+    cdef size_t *lengths
+    cdef Py_buffer *views
+    cdef bint *acquired
+    cdef Py_ssize_t count
+    cdef int mode
+    cdef list items
+    cdef bytes result
+    cdef _RuleTable table
+    cdef const browser_matcher *matcher
+
+    def __cinit__(self, user_agents, int mode):
+        cdef Py_ssize_t i
+        cdef Py_ssize_t length
+        self.items = list(user_agents)
+        self.count = len(self.items)
+        self.mode = mode
+        # Pin the active table so a concurrent load_rules() cannot free it
+        self.table = _active_table
+        self.matcher = &default_matcher if self.table is None else &self.table.matcher
+        self.result = PyBytes_FromStringAndSize(NULL, self.count)
+        self.user_agents = <const char **>PyMem_Malloc(max(self.count, 1) * sizeof(char *))
+        self.lengths = <size_t *>PyMem_Malloc(max(self.count, 1) * sizeof(size_t))
+        self.views = <Py_buffer *>PyMem_Malloc(max(self.count, 1) * sizeof(Py_buffer))
+        self.acquired = <bint *>PyMem_Calloc(max(self.count, 1), sizeof(bint))
+        if (self.user_agents == NULL or self.lengths == NULL
+                or self.views == NULL or self.acquired == NULL):
+            raise MemoryError()
+        for i in range(self.count):
+            self.user_agents[i] = _ua_data(self.items[i], &length, &self.views[i],
+                                           &self.acquired[i])
+            self.lengths[i] = length
+
+    def __dealloc__(self):
+        cdef Py_ssize_t i
+        if self.acquired != NULL:
+            for i in range(self.count):
+                if self.acquired[i]:
+                    PyBuffer_Release(&self.views[i])
+        PyMem_Free(self.user_agents)
+        PyMem_Free(self.lengths)
+        PyMem_Free(self.views)
+        PyMem_Free(self.acquired)
+
+    def run(self, Py_ssize_t start, Py_ssize_t stop):
+        cdef const char **user_agents = self.user_agents + start
+        cdef size_t *lengths = self.lengths + start
+        cdef unsigned char *out = <unsigned char *>PyBytes_AS_STRING(self.result) + start
+        cdef int mode = self.mode
+        cdef const browser_matcher *matcher = self.matcher
+        with nogil:
+            detect_many(matcher, user_agents, lengths, stop - start, mode, out)
+
+cdef bytes _run_many(user_agents, int mode, workers):
+    cdef _Batch batch = _Batch(user_agents, mode)
+    cdef Py_ssize_t count = batch.count
+    cdef Py_ssize_t threads = (os.cpu_count() or 1) if workers is None else workers
+    cdef Py_ssize_t step
+    threads = min(threads, count // _MIN_CHUNK)
+    if threads <= 1:
+        batch.run(0, count)
+        return batch.result
+    step = (count + threads - 1) // threads
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(batch.run, start, min(start + step, count))
+                   for start in range(0, count, step)]
+        for future in futures:
+            future.result()
+    return batch.result
+
+def capabilities_many(user_agents, workers=1):
+    """Detect the capabilities of many User-Agents in one native call.
+
+    The detection loop runs without the GIL and bypasses the result cache.
+
+    Args:
+        user_agents (iterable of str, bytes or buffers): The User-Agent strings
+        workers (int or None): Threads to split large batches across;
+            None uses ``os.cpu_count()``
+
+    Returns:
+        bytes: One ``ImageFormat`` bitmask per User-Agent
+    """
+    return _run_many(user_agents, BATCH_CAPABILITIES, workers)
+
+def webp_supported_many(user_agents, workers=1):
+    """Check WebP support for many User-Agents in one native call.
+
+    Args:
+        user_agents (iterable of str, bytes or buffers): The User-Agent strings
+        workers (int or None): Threads to split large batches across;
+            None uses ``os.cpu_count()``
+
+    Returns:
+        bytes: 1 where WebP is supported, 0 elsewhere
+    """
+    return _run_many(user_agents, BATCH_WEBP, workers)
+
+def avif_supported_many(user_agents, workers=1):
+    """Check AVIF support for many User-Agents in one native call.
+
+    Args:
+        user_agents (iterable of str, bytes or buffers): The User-Agent strings
+        workers (int or None): Threads to split large batches across;
+            None uses ``os.cpu_count()``
+
+    Returns:
+        bytes: 1 where AVIF is supported, 0 elsewhere
+    """
+    return _run_many(user_agents, BATCH_AVIF, workers)
+
+def best_format_many(user_agents, workers=1):
+    """Pick the best format for many User-Agents in one native call.
+
+    Args:
+        user_agents (iterable of str, bytes or buffers): The User-Agent strings
+        workers (int or None): Threads to split large batches across;
+            None uses ``os.cpu_count()``
+
+    Returns:
+        bytes: ``AVIF``, ``WEBP`` or 0 per User-Agent
+    """
+    return _run_many(user_agents, BATCH_BEST, workers)
+
+@cython.final
+cdef class _Column:
+    """One Arrow array or NumPy bytes array, read in place, and its results."""
+    cdef ua_column column
+    cdef ArrowArray chunk
+    cdef Py_buffer view
+    cdef bint acquired
+    cdef object owner
+    cdef bytearray result
+    cdef int mode
+    cdef _RuleTable table
+    cdef const browser_matcher *matcher
+
+    def __cinit__(self, int mode, _RuleTable table):
+        self.mode = mode
+        # Pinned by the caller, so every chunk of a stream sees the same rules
+        self.table = table
+        self.matcher = &default_matcher if table is None else &table.matcher
+
+    def __dealloc__(self):
+        if self.acquired:
+            PyBuffer_Release(&self.view)
+        if self.chunk.release != NULL:
+            self.chunk.release(&self.chunk)
+
+    cdef int read_arrow(self, const char *format, ArrowArray *array, owner) except -1:
+        if not column_from_arrow(&self.column, format, array):
+            raise TypeError(f"expected an Arrow string, binary or view array, "
+                            f"got format {format.decode('ascii', 'replace')!r}")
+        # The capsule whose array this is, or None for a stream chunk
+        self.owner = owner
+        self.result = PyByteArray_FromStringAndSize(NULL, self.column.length)
+        return 0
+
+    cdef int read_buffer(self, column) except -1:
+        try:
+            PyObject_GetBuffer(column, &self.view, PyBUF_FORMAT | PyBUF_C_CONTIGUOUS)
+        except (BufferError, TypeError):
+            raise TypeError(f"expected an Arrow array or a NumPy bytes array, "
+                            f"got {type(column).__name__}") from None
+        self.acquired = True
+        format = (self.view.format or b'B').decode('ascii')
+        if self.view.ndim != 1 or not format.endswith('s'):
+            raise TypeError(f"expected a one-dimensional bytes array (NumPy dtype 'S'), "
+                            f"got buffer format {format!r}")
+        self.column.layout = COLUMN_FIXED
+        self.column.length = self.view.shape[0]
+        self.column.width = self.view.itemsize
+        self.column.values = self.view.buf
+        self.result = PyByteArray_FromStringAndSize(NULL, self.column.length)
+        return 0
+
+    def run(self, Py_ssize_t start, Py_ssize_t stop):
+        cdef unsigned char *out = <unsigned char *>PyByteArray_AS_STRING(self.result) + start
+        cdef int mode = self.mode
+        cdef const browser_matcher *matcher = self.matcher
+        with nogil:
+            detect_column(matcher, &self.column, start, stop, mode, out)
+
+cdef bytearray _run_column(_Column column, workers):
+    cdef Py_ssize_t count = column.column.length
+    cdef Py_ssize_t threads = (os.cpu_count() or 1) if workers is None else workers
+    cdef Py_ssize_t step
+    threads = min(threads, count // _MIN_CHUNK)
+    if threads <= 1:
+        column.run(0, count)
+        return column.result
+    step = (count + threads - 1) // threads
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(column.run, start, min(start + step, count))
+                   for start in range(0, count, step)]
+        for future in futures:
+            future.result()
+    return column.result
+
+cdef bytearray _run_stream(capsule, int mode, _RuleTable table, workers):
+    cdef ArrowArrayStream *stream = <ArrowArrayStream *>PyCapsule_GetPointer(
+        capsule, 'arrow_array_stream')
+    cdef ArrowSchema schema
+    cdef _Column column
+    cdef list parts = []
+    if stream.get_schema(stream, &schema) != 0:
+        raise ValueError(_stream_error(stream))
+    try:
+        while True:
+            column = _Column(mode, table)
+            if stream.get_next(stream, &column.chunk) != 0:
+                raise ValueError(_stream_error(stream))
+            if column.chunk.release == NULL:
+                break
+            column.read_arrow(schema.format, &column.chunk, None)
+            parts.append(_run_column(column, workers))
+    finally:
+        schema.release(&schema)
+    return parts[0] if len(parts) == 1 else bytearray().join(parts)
+
+cdef str _stream_error(ArrowArrayStream *stream):
+    cdef const char *error = stream.get_last_error(stream)
+    return 'Arrow stream error' if error == NULL else error.decode('utf-8', 'replace')
+
+cdef object _capability_column(bytearray result, bint arrow):
+    # pyarrow and NumPy are optional; both wrap the result without a copy
+    if arrow:
+        try:
+            import pyarrow
+        except ImportError:
+            pass
+        else:
+            return pyarrow.Array.from_buffers(pyarrow.uint8(), len(result),
+                                              [None, pyarrow.py_buffer(result)])
+    try:
+        import numpy
+    except ImportError:
+        return bytes(result)
+    return numpy.frombuffer(result, dtype=numpy.uint8)
+
+def capabilities_column(column, workers=1):
+    """Detect the capabilities of a whole column of User-Agents.
+
+    Reads the column where it lies, without creating a Python object per
+    value, and runs detection without the GIL. Accepts anything that
+    exports the Arrow PyCapsule interface with string, large string,
+    binary or string view values (pyarrow arrays and chunked arrays,
+    polars and Arrow-backed pandas Series), and one-dimensional NumPy
+    bytes arrays (dtype ``'S'``). Null values give 0. Like
+    ``capabilities_many``, this bypasses the result cache.
+
+    Args:
+        column: The User-Agent column
+        workers (int or None): Threads to split large columns across;
+            None uses ``os.cpu_count()``
+
+    Returns:
+        One ``ImageFormat`` bitmask per value, as a ``pyarrow.UInt8Array``
+        for Arrow input when pyarrow is installed, else as a NumPy ``uint8``
+        array, or as bytes when NumPy is missing too
+    """
+    cdef _RuleTable table = _active_table
+    cdef _Column single
+    cdef ArrowSchema *schema
+    if hasattr(column, '__arrow_c_array__'):
+        schema_capsule, array_capsule = column.__arrow_c_array__()
+        schema = <ArrowSchema *>PyCapsule_GetPointer(schema_capsule, 'arrow_schema')
+        single = _Column(BATCH_CAPABILITIES, table)
+        single.read_arrow(schema.format,
+                          <ArrowArray *>PyCapsule_GetPointer(array_capsule, 'arrow_array'),
+                          array_capsule)
+        return _capability_column(_run_column(single, workers), True)
+    if hasattr(column, '__arrow_c_stream__'):
+        result = _run_stream(column.__arrow_c_stream__(), BATCH_CAPABILITIES, table, workers)
+        return _capability_column(result, True)
+    single = _Column(BATCH_CAPABILITIES, table)
+    single.read_buffer(column)
+    return _capability_column(_run_column(single, workers), False)
+
+cdef dict _LOG_FORMATS = {'combined': LOG_COMBINED, 'json': LOG_JSON}
+
+def _scan_log(data, Py_ssize_t start=0, stop=None, str format='combined', str key='user_agent'):
+    """Tally the User-Agents of the log lines that start in ``data[start:stop]``.
+
+    Backs ``python -m modern_image_support scan``. The User-Agent field is
+    located and each distinct value classified in C without the GIL.
+
+    Args:
+        data (buffer): The log contents, such as an ``mmap``
+        start (int): Offset of the shard; a partial first line is skipped
+        stop (int or None): End of the shard; the last line may run past it
+        format (str): ``'combined'`` for the last quoted field, or
+            ``'json'`` for the string value of ``key``
+        key (str): The User-Agent key of JSON lines
+
+    Returns:
+        tuple: ``(lines, missing, families, unmatched)``; ``families`` maps
+        the browser family, as reported by ``parse()``, to a list of request
+        counts (all requests, then one per ``FORMAT_NAMES`` entry), and ``unmatched``
+        maps each User-Agent no rule matched to its count
+    """
+    cdef int log_format = _LOG_FORMATS[format]
+    cdef bytes key_bytes = key.encode('utf-8')
+    cdef const char *key_data = key_bytes
+    cdef size_t key_length = len(key_bytes)
+    cdef _RuleTable table = _active_table
+    cdef const browser_matcher *matcher = &default_matcher if table is None else &table.matcher
+    cdef Py_buffer view
+    cdef ua_tally tally
+    cdef ua_tally_entry *entry
+    cdef const char *buf
+    cdef size_t length, end, i
+    cdef bint ok
+    cdef int j
+    cdef list row
+    cdef dict families = {}
+    cdef dict unmatched = {}
+
+    PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+    try:
+        buf = <const char *>view.buf
+        length = <size_t>view.len
+        end = length if stop is None else min(<size_t>stop, length)
+        if <size_t>start >= end:
+            return 0, 0, families, unmatched
+        if not tally_init(&tally, 4096):
+            raise MemoryError()
+        try:
+            with nogil:
+                ok = log_scan(matcher, buf, length, start, end, log_format,
+                              key_data, key_length, &tally)
+            if not ok:
+                raise MemoryError()
+            names = _BUILTIN_FAMILIES if table is None else table.families
+            for i in range(tally.capacity):
+                entry = &tally.entries[i]
+                if entry.count == 0:
+                    continue
+                if entry.family < 0:
+                    unmatched[buf[entry.offset:entry.offset + entry.length]] = entry.count
+                    continue
+                row = families.get(names[entry.family])
+                if row is None:
+                    row = families[names[entry.family]] = [0] * (FORMAT_COUNT + 1)
+                row[0] += entry.count
+                for j in range(FORMAT_COUNT):
+                    if entry.capabilities & (1 << j):
+                        row[j + 1] += entry.count
+            return tally.lines, tally.missing, families, unmatched
+        finally:
+            tally_free(&tally)
+    finally:
+        PyBuffer_Release(&view)
@@ -3,85 +3,2099 @@
 
 #include <string.h>
 #include <stdlib.h>
-#include <ctype.h>
 #include <stdio.h>
+#include <stdint.h>
 #include <stdbool.h>
 
-// Function declarations
-bool is_webp_supported(const char *user_agent);
-bool is_avif_supported(const char *user_agent);
+#if defined(_MSC_VER)
+#include <intrin.h>
+#endif
+#if defined(_WIN32)
+#ifndef WIN32_LEAN_AND_MEAN
+#define WIN32_LEAN_AND_MEAN
+#endif
+#include <windows.h>
+#else
+#include <sched.h>
+#include <time.h>
+#endif
+
+// Vector candidate scanning: SSE2 is part of x86-64, and AVX2 is picked at
+// runtime; NEON is part of AArch64. Other targets use the scalar loop.
+#if defined(__x86_64__) || defined(_M_X64)
+#define SCAN_X86_64 1
+#include <immintrin.h>
+#if defined(_MSC_VER) && !defined(__clang__)
+#define SCAN_TARGET_AVX2
+#else
+#define SCAN_TARGET_AVX2 __attribute__((target("avx2")))
+#endif
+#elif defined(__aarch64__) || defined(_M_ARM64)
+#define SCAN_NEON 1
+#include <arm_neon.h>
+#endif
+
+// Capability bits; bit i corresponds to min_versions[i] of a rule
+#define FORMAT_COUNT 5
+#define FORMAT_WEBP 0x01
+#define FORMAT_AVIF 0x02
+#define FORMAT_JXL 0x04
+#define FORMAT_HEIC 0x08
+#define FORMAT_ANIMATED_AVIF 0x10
+#define FORMAT_ALL ((1 << FORMAT_COUNT) - 1)
 
+// Upper bound on the number of rules a matcher can hold
+#define MATCHER_MAX_RULES 256
+
+// Latency bounds for hostile input. Only the first max_scan_length bytes of
+// a User-Agent are read (0 reads all of it); browsers put their product
+// tokens well inside the default. A version must start within
+// MAX_VERSION_GAP bytes of its token and is read up to MAX_VERSION_DIGITS
+// digits, so each token costs O(1) however the rest of the string looks.
+#define DEFAULT_MAX_SCAN_LENGTH 2048
+#define MAX_VERSION_GAP 8
+#define MAX_VERSION_DIGITS 9
+
+// One row of the browser-to-format matrix. A min_version of 0 means the
+// browser never gets that format.
 struct browser_version {
     const char *name;
-    int min_version;
     size_t name_len;
+    int min_versions[FORMAT_COUNT];
+    const char *family;  // browser family reported by parsing, such as "Safari"
+    const char *engine;  // rendering engine, or NULL if unknown
+    int engine_rule;     // rule whose version is the engine version, or -1
+};
+
+// What a full scan found, for parsing and log scans
+#define SCAN_RECORD_MAX 16
+
+struct scan_record {
+    int family;  // lowest index of the rules whose token occurs, or -1
+    int count;   // matched rules recorded below, at most SCAN_RECORD_MAX
+    uint16_t rule[SCAN_RECORD_MAX];
+    int major[SCAN_RECORD_MAX];  // -1 when the token has no version
+    int minor[SCAN_RECORD_MAX];  // -1 when the version has no minor part
+};
+
+// One parsed User-Agent; versions are -1 when absent
+struct browser_info {
+    int capabilities;
+    int family;  // rule index, -1 when no rule matched
+    int major;
+    int minor;
+    int engine_version;
+};
+
+// Rules bucketed by the first byte of their token, so a scan only has to
+// compare the rules whose token starts with the current byte
+//
+// The vector scanners find the bytes that start some token 16 or 32 at a
+// time and only run the bucket loop there. AVX2 and NEON classify a byte
+// with two 16-entry table lookups: bit k of nibble_hi[b >> 4] is set for
+// the k-th distinct high nibble among first bytes, and nibble_lo[b & 15]
+// has the bits of the high nibbles it is paired with, so the AND is
+// non-zero exactly for first bytes. SSE2 lacks the table lookup and
+// compares against each distinct first byte instead.
+#define MATCHER_MAX_FIRST_BYTES 16
+
+// Client Hints brands that map onto a rule token (client_hint_brands)
+#define CLIENT_HINT_BRANDS 5
+// Longest Client Hints header read through the quote bitmap
+#define CLIENT_HINT_FAST_LENGTH 256
+
+struct browser_matcher {
+    const struct browser_version *rules;
+    size_t count;
+    uint16_t bucket_start[257];
+    uint16_t order[MATCHER_MAX_RULES];
+    uint8_t nibble_lo[16];
+    uint8_t nibble_hi[16];
+    bool nibbles_exact;  // at most 8 distinct high nibbles among first bytes
+    uint8_t first_bytes[MATCHER_MAX_FIRST_BYTES];
+    uint16_t first_byte_count;  // above MATCHER_MAX_FIRST_BYTES if they did not fit
+    int16_t hint_rule[CLIENT_HINT_BRANDS];  // rule of each Client Hints brand, or -1
+};
+
+// Result cache: set-associative, LRU within each set of CACHE_WAYS entries,
+// keyed by a 64-bit hash and the length of the User-Agent
+#define CACHE_WAYS 8
+
+struct cache_entry {
+    uint64_t hash;
+    uint64_t stamp;  // 0 marks an empty slot
+    uint32_t length;
+    int capabilities;
+};
+
+struct result_cache {
+    uint64_t lock;  // spinlock; detection runs without the GIL on free-threaded builds
+    struct cache_entry *entries;
+    size_t maxsize;
+    size_t set_mask;
+    size_t currsize;
+    uint64_t clock;
+    uint64_t hits;
+    uint64_t misses;
+};
+
+// Distinct User-Agents seen by log_scan, in an open-addressing table keyed
+// by a 64-bit hash and the length. `offset` locates the first occurrence
+// in the scanned data.
+struct ua_tally_entry {
+    uint64_t hash;
+    uint64_t count;  // 0 marks an empty slot
+    size_t offset;
+    uint32_t length;
+    int16_t family;  // rule index, -1 when no rule matched
+    uint8_t capabilities;
+};
+
+struct ua_tally {
+    struct ua_tally_entry *entries;
+    size_t capacity;  // a power of two
+    size_t size;
+    uint64_t lines;
+    uint64_t missing;  // lines without a User-Agent
+};
+
+// Where log_scan finds the User-Agent of a line
+enum log_format {
+    LOG_COMBINED = 0,  // the last quoted field, as in the combined log format
+    LOG_JSON = 1       // the string value of a given key
+};
+
+// Cross-process cache living in memory the caller maps into every worker:
+// a header followed by a power-of-two array of 64-bit slots. A slot packs
+// the upper 56 bits of the key with the capability bits and a valid bit,
+// so it is read and written with single atomic operations and is never
+// seen half-written. Keys are seeded with a fingerprint of the rule table
+// and scan window, so processes running other rules never share entries.
+#define SHARED_CACHE_MAGIC 0x3143534d49444f4dULL  // "MODIMSC1"
+#define SHARED_CACHE_PROBES 8
+#define SHARED_CACHE_TAG_MASK (~(uint64_t)0xff)
+
+struct shared_cache_header {
+    uint64_t magic;
+    uint64_t slots;
+};
+
+struct shared_cache {
+    uint64_t *slots;  // NULL when no shared cache is attached
+    size_t mask;
+    uint64_t seed;
+    uint64_t hits;  // statistics of this process only
+    uint64_t misses;
+};
+
+// Opt-in counters of single detections (stats_configure). Each detection
+// counts once: under the rule that decided it (the first in table order
+// among the rules matched anywhere in the scan window, as parse() reports),
+// or under an outcome when no rule did.
+// One in `stats_sample_every` detections is also timed into a histogram of
+// power-of-two tick counts, ticks being those of stats_ticks().
+enum stats_slot {
+    STATS_UNMATCHED = MATCHER_MAX_RULES,  // scanned, no rule matched
+    STATS_CACHED,                         // answered by the result cache
+    STATS_SHARED_CACHED,                  // answered by the shared cache
+    STATS_SLOTS
+};
+
+#define STATS_LATENCY_BUCKETS 32
+
+struct detection_stats {
+    uint64_t counts[STATS_SLOTS];  // by rule index, then by stats_slot
+    uint64_t latency[STATS_LATENCY_BUCKETS];  // bucket k: [2^k, 2^(k+1)) ticks; 0 goes to 0
+    uint64_t latency_ticks;  // sum over the timed detections
+};
+
+// What detect_many writes for each User-Agent
+enum batch_mode {
+    BATCH_CAPABILITIES = 0,
+    BATCH_WEBP = 1,
+    BATCH_AVIF = 2,
+    BATCH_BEST = 3
+};
+
+// Arrow C data and stream interfaces, as specified by Apache Arrow
+#ifndef ARROW_C_DATA_INTERFACE
+#define ARROW_C_DATA_INTERFACE
+
+struct ArrowSchema {
+    const char *format;
+    const char *name;
+    const char *metadata;
+    int64_t flags;
+    int64_t n_children;
+    struct ArrowSchema **children;
+    struct ArrowSchema *dictionary;
+    void (*release)(struct ArrowSchema *);
+    void *private_data;
+};
+
+struct ArrowArray {
+    int64_t length;
+    int64_t null_count;
+    int64_t offset;
+    int64_t n_buffers;
+    int64_t n_children;
+    const void **buffers;
+    struct ArrowArray **children;
+    struct ArrowArray *dictionary;
+    void (*release)(struct ArrowArray *);
+    void *private_data;
+};
+#endif
+
+#ifndef ARROW_C_STREAM_INTERFACE
+#define ARROW_C_STREAM_INTERFACE
+
+struct ArrowArrayStream {
+    int (*get_schema)(struct ArrowArrayStream *, struct ArrowSchema *out);
+    int (*get_next)(struct ArrowArrayStream *, struct ArrowArray *out);
+    const char *(*get_last_error)(struct ArrowArrayStream *);
+    void (*release)(struct ArrowArrayStream *);
+    void *private_data;
+};
+#endif
+
+// A column of User-Agents read where it lies, without per-value objects
+enum column_layout {
+    COLUMN_FIXED = 0,      // NumPy 'S' array: items of `width` bytes, NUL-padded
+    COLUMN_OFFSETS32 = 1,  // Arrow string or binary
+    COLUMN_OFFSETS64 = 2,  // Arrow large_string or large_binary
+    COLUMN_VIEWS = 3       // Arrow string_view or binary_view
+};
+
+struct ua_column {
+    int layout;
+    size_t length;
+    size_t offset;             // Arrow array offset into validity, offsets and views
+    size_t width;              // item size of COLUMN_FIXED
+    const uint8_t *validity;   // Arrow validity bitmap, NULL when nothing is null
+    const void *values;        // items, offsets or 16-byte views
+    const char *data;          // value bytes of the offset layouts
+    const char *const *data_buffers;  // variadic data buffers of the view layout
+    size_t data_buffer_count;
+};
+
+// Function declarations
+bool matcher_build(struct browser_matcher *matcher, const struct browser_version *rules, size_t count);
+int matcher_scan(const struct browser_matcher *matcher, const char *user_agent, size_t length, int wanted);
+void matcher_parse(const struct browser_matcher *matcher, const char *user_agent, size_t length, struct browser_info *info);
+void modern_image_support_init(void);
+int scan_level_select(int level);
+bool is_webp_supported(const char *user_agent, size_t length);
+bool is_avif_supported(const char *user_agent, size_t length);
+int detect_capabilities(const char *user_agent, size_t length);
+int best_format_of(int capabilities);
+uint64_t ua_hash(const char *data, size_t length);
+bool cache_configure(struct result_cache *cache, size_t maxsize);
+void cache_clear(struct result_cache *cache);
+int cache_lookup(struct result_cache *cache, uint64_t hash, size_t length);
+void cache_store(struct result_cache *cache, uint64_t hash, size_t length, int capabilities);
+uint64_t matcher_fingerprint(const struct browser_matcher *matcher, size_t window);
+size_t shared_cache_format(void *memory, size_t size);
+bool shared_cache_attach(struct shared_cache *cache, void *memory, size_t size);
+void shared_cache_detach(struct shared_cache *cache);
+int shared_cache_lookup(struct shared_cache *cache, uint64_t hash);
+void shared_cache_store(struct shared_cache *cache, uint64_t hash, int capabilities);
+size_t shared_cache_used(const struct shared_cache *cache);
+void detect_many(const struct browser_matcher *matcher, const char *const *user_agents, const size_t *lengths, size_t count, int mode, unsigned char *out);
+bool column_from_arrow(struct ua_column *column, const char *format, const struct ArrowArray *array);
+void detect_column(const struct browser_matcher *matcher, const struct ua_column *column, size_t start, size_t stop, int mode, unsigned char *out);
+bool accept_scan(const char *accept, size_t length, int *accepted, int *refused);
+int client_hint_capabilities(const struct browser_matcher *matcher, const char *header, size_t length, int wanted);
+int negotiate_capabilities(const char *accept, size_t accept_length, const char *user_agent, size_t ua_length, const char *client_hints, size_t hints_length);
+void stats_configure(bool enabled, uint32_t sample_every);
+void stats_reset(void);
+uint64_t stats_ticks(void);
+bool tally_init(struct ua_tally *tally, size_t capacity);
+void tally_free(struct ua_tally *tally);
+bool log_scan(const struct browser_matcher *matcher, const char *data, size_t length, size_t start, size_t stop, int format, const char *key, size_t key_length, struct ua_tally *tally);
+
+// Indexes of the rules other rules take their engine version from
+#define RULE_EDGE 4
+#define RULE_FIREFOX 6
+#define RULE_CHROME 7
+#define RULE_APPLEWEBKIT 9
+
+// Minimum versions per browser token:  WebP  AVIF  JXL  HEIC  animated AVIF
+// Capabilities are combined over every token found, so order does not
+// change detection; it picks the browser family when parsing, where the
+// first token found in table order wins. Browsers that add their own token
+// on top of Chrome's or Safari's therefore come first.
+static const struct browser_version browser_versions[] = {
+    {"OPR", 3, {19, 71, 0, 0, 80}, "Opera", "Blink", RULE_CHROME},
+    {"SamsungBrowser", 14, {4, 14, 0, 0, 17}, "Samsung Internet", "Blink", RULE_CHROME},
+    {"UCBrowser", 9, {12, 0, 0, 0, 0}, "UC Browser", "Blink", RULE_CHROME},
+    {"QQBrowser", 9, {10, 0, 0, 0, 0}, "QQ Browser", "Blink", RULE_CHROME},
+    {"Edge", 4, {18, 85, 0, 0, 121}, "Edge", "EdgeHTML", RULE_EDGE},    // EdgeHTML; also matched by "Edg"
+    {"Edg", 3, {79, 121, 0, 0, 121}, "Edge", "Blink", RULE_CHROME},      // Chromium Edge: Edg/, EdgA/, EdgiOS/
+    {"Firefox", 7, {65, 93, 0, 0, 113}, "Firefox", "Gecko", RULE_FIREFOX},
+    {"Chrome", 6, {32, 85, 0, 0, 94}, "Chrome", "Blink", RULE_CHROME},
+    {"Version", 7, {14, 16, 17, 17, 17}, "Safari", "WebKit", RULE_APPLEWEBKIT},  // Safari's own version; WebKit's is frozen at 605
+    {"AppleWebKit", 11, {605, 612, 0, 0, 0}, "WebKit", "WebKit", RULE_APPLEWEBKIT}  // Safari 14 / Safari 16+ (macOS 12.3+, iOS 15.4+)
+};
+
+#define BROWSER_VERSION_COUNT (sizeof(browser_versions) / sizeof(browser_versions[0]))
+
+struct client_hint_brand {
+    const char *brand;
+    size_t brand_len;
+    const char *token;  // rule whose minimum versions apply
+    size_t token_len;
 };
 
-// WebP support versions
-static const struct browser_version webp_browser_versions[] = {
-    {"Firefox", 65, 7},
-    {"Chrome", 32, 6},
-    {"Edge", 18, 4},
-    {"AppleWebKit", 605, 11},  // Safari 14
-    {"OPR", 19, 3},
-    {"UCBrowser", 12, 9},
-    {"SamsungBrowser", 4, 14},
-    {"QQBrowser", 10, 9}
+// Brands of Sec-CH-UA, whose version is that of the matching UA token.
+// Chromium-based browsers list "Chromium" besides their own brand, plus a
+// GREASE brand that matches nothing.
+static const struct client_hint_brand client_hint_brands[CLIENT_HINT_BRANDS] = {
+    {"Chromium", 8, "Chrome", 6},
+    {"Google Chrome", 13, "Chrome", 6},
+    {"Microsoft Edge", 14, "Edg", 3},
+    {"Opera", 5, "OPR", 3},
+    {"Samsung Internet", 16, "SamsungBrowser", 14}
 };
 
-// AVIF support versions
-static const struct browser_version avif_browser_versions[] = {
-    {"Firefox", 93, 7},        // Firefox 93+
-    {"Chrome", 85, 6},         // Chrome 85+
-    {"Edge", 85, 4},           // Edge 85+
-    {"AppleWebKit", 612, 11},  // Safari 16+ (macOS 12.3+, iOS 15.4+)
-    {"OPR", 71, 3},           // Opera 71+
-    {"SamsungBrowser", 14, 14} // Samsung Internet 14+
+static struct browser_matcher default_matcher;
+static struct result_cache default_cache;
+static struct shared_cache shared_cache;
+static struct detection_stats detection_stats;
+static bool stats_enabled = false;
+static uint32_t stats_sample_every = 0;
+
+// The matcher used by single calls; points at default_matcher unless a rule
+// table has been loaded at runtime
+static const struct browser_matcher *active_matcher = &default_matcher;
+
+static size_t max_scan_length = DEFAULT_MAX_SCAN_LENGTH;
+
+// Scanner used by matcher_scan_rules; the vector levels exist only on the
+// targets above
+enum scan_level {
+    SCAN_SCALAR = 0,
+    SCAN_VECTOR = 1,  // SSE2 on x86-64, NEON on AArch64
+    SCAN_AVX2 = 2
 };
 
-#define WEBP_BROWSER_VERSION_COUNT (sizeof(webp_browser_versions) / sizeof(webp_browser_versions[0]))
-#define AVIF_BROWSER_VERSION_COUNT (sizeof(avif_browser_versions) / sizeof(avif_browser_versions[0]))
+static int scan_level = SCAN_SCALAR;
+static int scan_level_max = SCAN_SCALAR;
 
-static bool check_browser_support(const char *user_agent, const struct browser_version *versions, size_t count)
+// The part of a User-Agent that detection reads
+static inline size_t scan_window(size_t length)
 {
-    if (user_agent == NULL)
+    return (max_scan_length != 0 && length > max_scan_length) ? max_scan_length : length;
+}
+
+static inline int version_capabilities(const struct browser_version *browser, int version_number)
+{
+    int capabilities = 0;
+    for (int i = 0; i < FORMAT_COUNT; i++)
+    {
+        int min_version = browser->min_versions[i];
+        if (min_version != 0 && version_number >= min_version)
+        {
+            capabilities |= 1 << i;
+        }
+    }
+    return capabilities;
+}
+
+// Reads the run of digits starting within MAX_VERSION_GAP bytes of `p`;
+// returns -1 if there is none. With `minor`, also reads the digits after a
+// following '.', storing -1 when there are none.
+static inline int parse_version(const char *p, const char *end, int *minor)
+{
+    const char *gap_end = (end - p > MAX_VERSION_GAP) ? p + MAX_VERSION_GAP : end;
+    while (p < gap_end && (*p < '0' || *p > '9'))
+    {
+        p++;
+    }
+    if (p == gap_end)
+    {
+        return -1;
+    }
+    const char *digits_end = (end - p > MAX_VERSION_DIGITS) ? p + MAX_VERSION_DIGITS : end;
+    int version_number = 0;
+    while (p < digits_end && *p >= '0' && *p <= '9')
+    {
+        version_number = version_number * 10 + (*p - '0');
+        p++;
+    }
+    if (minor != NULL)
+    {
+        *minor = -1;
+        if (end - p >= 2 && *p == '.' && p[1] >= '0' && p[1] <= '9')
+        {
+            p++;
+            digits_end = (end - p > MAX_VERSION_DIGITS) ? p + MAX_VERSION_DIGITS : end;
+            *minor = 0;
+            while (p < digits_end && *p >= '0' && *p <= '9')
+            {
+                *minor = *minor * 10 + (*p - '0');
+                p++;
+            }
+        }
+    }
+    return version_number;
+}
+
+bool matcher_build(struct browser_matcher *matcher, const struct browser_version *rules, size_t count)
+{
+    if (count > MATCHER_MAX_RULES)
     {
         return false;
     }
-    
     for (size_t i = 0; i < count; i++)
     {
-        const struct browser_version *current_browser = &versions[i];
-        const char *found = strstr(user_agent, current_browser->name);
-        if (found != NULL)
+        if (rules[i].name_len == 0)
+        {
+            return false;
+        }
+    }
+
+    // Counting sort of the rule indexes by first byte
+    uint16_t counts[256] = {0};
+    for (size_t i = 0; i < count; i++)
+    {
+        counts[(unsigned char)rules[i].name[0]]++;
+    }
+    matcher->bucket_start[0] = 0;
+    for (int c = 0; c < 256; c++)
+    {
+        matcher->bucket_start[c + 1] = (uint16_t)(matcher->bucket_start[c] + counts[c]);
+    }
+    uint16_t fill[256];
+    memcpy(fill, matcher->bucket_start, sizeof(fill));
+    for (size_t i = 0; i < count; i++)
+    {
+        matcher->order[fill[(unsigned char)rules[i].name[0]]++] = (uint16_t)i;
+    }
+
+    // Candidate tables for the vector scanners
+    uint8_t nibble_class[16] = {0};
+    int classes = 0;
+    memset(matcher->nibble_lo, 0, sizeof(matcher->nibble_lo));
+    memset(matcher->nibble_hi, 0, sizeof(matcher->nibble_hi));
+    matcher->nibbles_exact = true;
+    matcher->first_byte_count = 0;
+    for (int c = 0; c < 256; c++)
+    {
+        if (counts[c] == 0)
+        {
+            continue;
+        }
+        if (matcher->first_byte_count < MATCHER_MAX_FIRST_BYTES)
+        {
+            matcher->first_bytes[matcher->first_byte_count] = (uint8_t)c;
+        }
+        matcher->first_byte_count++;
+        if (nibble_class[c >> 4] == 0)
         {
-            const char *version = found + current_browser->name_len;
-            while (!isdigit(*version) && *version != '\0')
+            if (classes == 8)
             {
-                version++;
+                matcher->nibbles_exact = false;
+                continue;
             }
-            if (*version != '\0')
+            nibble_class[c >> 4] = (uint8_t)(1 << classes++);
+        }
+        matcher->nibble_hi[c >> 4] = nibble_class[c >> 4];
+        matcher->nibble_lo[c & 15] |= nibble_class[c >> 4];
+    }
+
+    for (int i = 0; i < CLIENT_HINT_BRANDS; i++)
+    {
+        matcher->hint_rule[i] = -1;
+        for (size_t k = 0; k < count; k++)
+        {
+            if (rules[k].name_len == client_hint_brands[i].token_len && memcmp(rules[k].name, client_hint_brands[i].token, rules[k].name_len) == 0)
             {
-                int version_number = atoi(version);
-                if (version_number >= current_browser->min_version)
-                {
-                    return true;
-                }
+                matcher->hint_rule[i] = (int16_t)k;
+                break;
+            }
+        }
+    }
+    matcher->rules = rules;
+    matcher->count = count;
+    return true;
+}
+
+static inline int lowest_bit32(uint32_t mask)
+{
+#if defined(_MSC_VER) && !defined(__clang__)
+    unsigned long index;
+    _BitScanForward(&index, mask);
+    return (int)index;
+#else
+    return __builtin_ctz(mask);
+#endif
+}
+
+static inline int lowest_bit64(uint64_t mask)
+{
+#if defined(_MSC_VER) && !defined(__clang__)
+    unsigned long index;
+    _BitScanForward64(&index, mask);
+    return (int)index;
+#else
+    return __builtin_ctzll(mask);
+#endif
+}
+
+static inline int highest_bit64(uint64_t mask)
+{
+#if defined(_MSC_VER) && !defined(__clang__)
+    unsigned long index;
+    _BitScanReverse64(&index, mask);
+    return (int)index;
+#else
+    return 63 - __builtin_clzll(mask);
+#endif
+}
+
+// What a scan has found so far
+struct scan_state {
+    uint64_t seen[MATCHER_MAX_RULES / 64];
+    int capabilities;
+    int first_rule;
+};
+
+// Tries every rule whose token starts with the byte at `p`. Returns true
+// when an early-exit scan (no `record`) has found everything it wants.
+static inline bool scan_position(const struct browser_matcher *matcher, const char *p, const char *end, int wanted, struct scan_record *record, struct scan_state *state)
+{
+    unsigned char c = (unsigned char)*p;
+    uint16_t first = matcher->bucket_start[c];
+    uint16_t last = matcher->bucket_start[c + 1];
+    for (uint16_t k = first; k < last; k++)
+    {
+        uint16_t index = matcher->order[k];
+        const struct browser_version *rule = &matcher->rules[index];
+        if ((state->seen[index >> 6] >> (index & 63)) & 1)
+        {
+            continue;
+        }
+        if ((size_t)(end - p) < rule->name_len || memcmp(p + 1, rule->name + 1, rule->name_len - 1) != 0)
+        {
+            continue;
+        }
+        state->seen[index >> 6] |= (uint64_t)1 << (index & 63);
+        if (index < state->first_rule)
+        {
+            state->first_rule = index;
+        }
+        int minor = -1;
+        int version_number = parse_version(p + rule->name_len, end, record != NULL ? &minor : NULL);
+        if (record != NULL && record->count < SCAN_RECORD_MAX)
+        {
+            record->rule[record->count] = index;
+            record->major[record->count] = version_number;
+            record->minor[record->count] = version_number >= 0 ? minor : -1;
+            record->count++;
+        }
+        if (version_number >= 0)
+        {
+            state->capabilities |= version_capabilities(rule, version_number);
+            if (record == NULL && (state->capabilities & wanted) == wanted)
+            {
+                return true;
+            }
+        }
+    }
+    return false;
+}
+
+// The vector scanners cover whole blocks, visiting candidates left to
+// right, and leave the start of the remaining tail in *cursor
+#if defined(SCAN_X86_64)
+static bool scan_blocks_sse2(const struct browser_matcher *matcher, const char **cursor, const char *end, int wanted, struct scan_record *record, struct scan_state *state)
+{
+    __m128i needles[MATCHER_MAX_FIRST_BYTES];
+    int needle_count = matcher->first_byte_count;
+    for (int i = 0; i < needle_count; i++)
+    {
+        needles[i] = _mm_set1_epi8((char)matcher->first_bytes[i]);
+    }
+    const char *p = *cursor;
+    for (; end - p >= 16; p += 16)
+    {
+        __m128i block = _mm_loadu_si128((const __m128i *)p);
+        __m128i hits = _mm_setzero_si128();
+        for (int i = 0; i < needle_count; i++)
+        {
+            hits = _mm_or_si128(hits, _mm_cmpeq_epi8(block, needles[i]));
+        }
+        for (uint32_t mask = (uint32_t)_mm_movemask_epi8(hits); mask != 0; mask &= mask - 1)
+        {
+            if (scan_position(matcher, p + lowest_bit32(mask), end, wanted, record, state))
+            {
+                return true;
             }
         }
     }
+    *cursor = p;
+    return false;
+}
 
+SCAN_TARGET_AVX2
+static bool scan_blocks_avx2(const struct browser_matcher *matcher, const char **cursor, const char *end, int wanted, struct scan_record *record, struct scan_state *state)
+{
+    const __m256i lo_table = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i *)matcher->nibble_lo));
+    const __m256i hi_table = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i *)matcher->nibble_hi));
+    const __m256i low_nibble = _mm256_set1_epi8(0x0f);
+    const char *p = *cursor;
+    for (; end - p >= 32; p += 32)
+    {
+        __m256i block = _mm256_loadu_si256((const __m256i *)p);
+        __m256i lo = _mm256_shuffle_epi8(lo_table, _mm256_and_si256(block, low_nibble));
+        __m256i hi = _mm256_shuffle_epi8(hi_table, _mm256_and_si256(_mm256_srli_epi16(block, 4), low_nibble));
+        __m256i misses = _mm256_cmpeq_epi8(_mm256_and_si256(lo, hi), _mm256_setzero_si256());
+        for (uint32_t mask = ~(uint32_t)_mm256_movemask_epi8(misses); mask != 0; mask &= mask - 1)
+        {
+            if (scan_position(matcher, p + lowest_bit32(mask), end, wanted, record, state))
+            {
+                return true;
+            }
+        }
+    }
+    *cursor = p;
+    return false;
+}
+#elif defined(SCAN_NEON)
+static bool scan_blocks_neon(const struct browser_matcher *matcher, const char **cursor, const char *end, int wanted, struct scan_record *record, struct scan_state *state)
+{
+    const uint8x16_t lo_table = vld1q_u8(matcher->nibble_lo);
+    const uint8x16_t hi_table = vld1q_u8(matcher->nibble_hi);
+    const uint8x16_t low_nibble = vdupq_n_u8(0x0f);
+    const char *p = *cursor;
+    for (; end - p >= 16; p += 16)
+    {
+        uint8x16_t block = vld1q_u8((const uint8_t *)p);
+        uint8x16_t lo = vqtbl1q_u8(lo_table, vandq_u8(block, low_nibble));
+        uint8x16_t hi = vqtbl1q_u8(hi_table, vshrq_n_u8(block, 4));
+        uint8x16_t hits = vtstq_u8(lo, hi);
+        // NEON has no movemask: narrow each byte to a nibble and keep one bit of it
+        uint64_t mask = vget_lane_u64(vreinterpret_u64_u8(vshrn_n_u16(vreinterpretq_u16_u8(hits), 4)), 0);
+        for (mask &= 0x8888888888888888ULL; mask != 0; mask &= mask - 1)
+        {
+            if (scan_position(matcher, p + (lowest_bit64(mask) >> 2), end, wanted, record, state))
+            {
+                return true;
+            }
+        }
+    }
+    *cursor = p;
     return false;
 }
+#endif
+
+// Matches every rule in one left-to-right pass. Like strstr, only the first
+// occurrence of each token is considered. Without `record`, stops once
+// every bit in `wanted` has been found; with it, reads the whole window
+// and records the family and the versions of the matched rules.
+//
+// With `decided`, reads the whole window whatever `wanted` is, and stores
+// the lowest index of the matched rules, or STATS_UNMATCHED: the family
+// parse() reports, so a detection is credited to the same rule whichever
+// API made it.
+static inline int matcher_scan_rules(const struct browser_matcher *matcher, const char *user_agent, size_t length, int wanted, struct scan_record *record, int *decided)
+{
+    if (record != NULL)
+    {
+        record->family = -1;
+        record->count = 0;
+    }
+    if (user_agent == NULL)
+    {
+        if (decided != NULL)
+        {
+            *decided = STATS_UNMATCHED;
+        }
+        return 0;
+    }
+
+    struct scan_state state = {{0}, 0, MATCHER_MAX_RULES};
+    const char *p = user_agent;
+    const char *end = user_agent + scan_window(length);
+    bool done = false;
+    // A bit no rule grants, so the scan never finishes early
+    int until = decided != NULL ? FORMAT_ALL + 1 : wanted;
+
+#if defined(SCAN_X86_64)
+    if (scan_level == SCAN_AVX2 && matcher->nibbles_exact)
+    {
+        done = scan_blocks_avx2(matcher, &p, end, until, record, &state);
+    }
+    else if (scan_level != SCAN_SCALAR && matcher->first_byte_count <= MATCHER_MAX_FIRST_BYTES)
+    {
+        done = scan_blocks_sse2(matcher, &p, end, until, record, &state);
+    }
+#elif defined(SCAN_NEON)
+    if (scan_level != SCAN_SCALAR && matcher->nibbles_exact)
+    {
+        done = scan_blocks_neon(matcher, &p, end, until, record, &state);
+    }
+#endif
+    for (; !done && p < end; p++)
+    {
+        done = scan_position(matcher, p, end, until, record, &state);
+    }
+    if (decided != NULL)
+    {
+        // MATCHER_MAX_RULES, the initial first_rule, is STATS_UNMATCHED
+        *decided = state.first_rule;
+    }
+    if (done)
+    {
+        return wanted;
+    }
+
+    if (record != NULL && state.first_rule != MATCHER_MAX_RULES)
+    {
+        record->family = state.first_rule;
+    }
+    return state.capabilities & wanted;
+}
+
+int matcher_scan(const struct browser_matcher *matcher, const char *user_agent, size_t length, int wanted)
+{
+    return matcher_scan_rules(matcher, user_agent, length, wanted, NULL, NULL);
+}
+
+// One full scan yields the capabilities, the family (the first rule in
+// table order whose token occurs), its version and the engine version
+void matcher_parse(const struct browser_matcher *matcher, const char *user_agent, size_t length, struct browser_info *info)
+{
+    struct scan_record record;
+    info->capabilities = matcher_scan_rules(matcher, user_agent, length, FORMAT_ALL, &record, NULL);
+    info->family = record.family;
+    info->major = -1;
+    info->minor = -1;
+    info->engine_version = -1;
+    if (record.family < 0)
+    {
+        return;
+    }
+    int engine_rule = matcher->rules[record.family].engine_rule;
+    for (int i = 0; i < record.count; i++)
+    {
+        if (record.rule[i] == record.family)
+        {
+            info->major = record.major[i];
+            info->minor = record.minor[i];
+        }
+        if (record.rule[i] == engine_rule)
+        {
+            info->engine_version = record.major[i];
+        }
+    }
+}
+
+static inline uint64_t rotl64(uint64_t x, int r)
+{
+    return (x << r) | (x >> (64 - r));
+}
+
+static inline uint64_t fmix64(uint64_t k)
+{
+    k ^= k >> 33;
+    k *= 0xff51afd7ed558ccdULL;
+    k ^= k >> 33;
+    k *= 0xc4ceb9fe1a85ec53ULL;
+    k ^= k >> 33;
+    return k;
+}
+
+// Word-at-a-time hash (MurmurHash3 mixing), so hashing a User-Agent costs
+// much less than scanning it
+uint64_t ua_hash(const char *data, size_t length)
+{
+    uint64_t h = 0x9E3779B97F4A7C15ULL ^ (uint64_t)length;
+    while (length >= 8)
+    {
+        uint64_t k;
+        memcpy(&k, data, 8);
+        k *= 0x87c37b91114253d5ULL;
+        k = rotl64(k, 31);
+        k *= 0x4cf5ad432745937fULL;
+        h ^= k;
+        h = rotl64(h, 27) * 5 + 0x52dce729;
+        data += 8;
+        length -= 8;
+    }
+    uint64_t tail = 0;
+    memcpy(&tail, data, length);
+    h ^= fmix64(tail ^ 0x87c37b91114253d5ULL);
+    return fmix64(h);
+}
+
+#if defined(_MSC_VER)
+// Aligned 64-bit loads are atomic on the 64-bit targets MSVC builds for
+static inline uint64_t atomic_load_u64(const uint64_t *p)
+{
+    return *(const volatile uint64_t *)p;
+}
+
+static inline bool atomic_cas_u64(uint64_t *p, uint64_t expected, uint64_t desired)
+{
+    return (uint64_t)_InterlockedCompareExchange64((volatile long long *)p, (long long)desired, (long long)expected) == expected;
+}
+
+static inline void atomic_store_u64(uint64_t *p, uint64_t value)
+{
+    _InterlockedExchange64((volatile long long *)p, (long long)value);
+}
+
+static inline void *atomic_load_ptr(void *const *p)
+{
+    return *(void *const volatile *)p;
+}
 
-bool is_webp_supported(const char *user_agent)
+static inline void atomic_add_relaxed_u64(uint64_t *p, uint64_t value)
 {
-    return check_browser_support(user_agent, webp_browser_versions, WEBP_BROWSER_VERSION_COUNT);
+    _InterlockedExchangeAdd64((volatile long long *)p, (long long)value);
 }
 
-bool is_avif_supported(const char *user_agent)
+static inline uint32_t atomic_load_relaxed_u32(const uint32_t *p)
+{
+    return *(const volatile uint32_t *)p;
+}
+
+static inline void atomic_store_relaxed_u32(uint32_t *p, uint32_t value)
+{
+    *(volatile uint32_t *)p = value;
+}
+
+static inline void atomic_store_ptr(void **p, void *value)
+{
+    _InterlockedExchangePointer((void *volatile *)p, value);
+}
+#else
+static inline uint64_t atomic_load_u64(const uint64_t *p)
 {
-    return check_browser_support(user_agent, avif_browser_versions, AVIF_BROWSER_VERSION_COUNT);
+    return __atomic_load_n(p, __ATOMIC_ACQUIRE);
+}
+
+static inline bool atomic_cas_u64(uint64_t *p, uint64_t expected, uint64_t desired)
+{
+    return __atomic_compare_exchange_n(p, &expected, desired, false, __ATOMIC_ACQ_REL, __ATOMIC_RELAXED);
+}
+
+static inline void atomic_store_u64(uint64_t *p, uint64_t value)
+{
+    __atomic_store_n(p, value, __ATOMIC_RELEASE);
+}
+
+static inline void *atomic_load_ptr(void *const *p)
+{
+    return __atomic_load_n(p, __ATOMIC_ACQUIRE);
+}
+
+static inline void atomic_add_relaxed_u64(uint64_t *p, uint64_t value)
+{
+    __atomic_fetch_add(p, value, __ATOMIC_RELAXED);
+}
+
+static inline uint32_t atomic_load_relaxed_u32(const uint32_t *p)
+{
+    return __atomic_load_n(p, __ATOMIC_RELAXED);
+}
+
+static inline void atomic_store_relaxed_u32(uint32_t *p, uint32_t value)
+{
+    __atomic_store_n(p, value, __ATOMIC_RELAXED);
+}
+
+static inline void atomic_store_ptr(void **p, void *value)
+{
+    __atomic_store_n(p, value, __ATOMIC_RELEASE);
+}
+#endif
+
+static inline void cpu_relax(void)
+{
+#if defined(_MSC_VER) && (defined(_M_X64) || defined(_M_IX86))
+    _mm_pause();
+#elif defined(_MSC_VER) && defined(_M_ARM64)
+    __yield();
+#elif defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#elif defined(__aarch64__)
+    __asm__ __volatile__("yield");
+#endif
+}
+
+// The result cache is held for a few dozen nanoseconds and never while
+// scanning or calling into Python, so waiters spin, yielding the CPU only
+// if the holder was preempted
+static inline void spin_lock(uint64_t *lock)
+{
+    unsigned spins = 0;
+    while (atomic_load_u64(lock) != 0 || !atomic_cas_u64(lock, 0, 1))
+    {
+        if (++spins < 128)
+        {
+            cpu_relax();
+        }
+        else
+        {
+#if defined(_WIN32)
+            SwitchToThread();
+#else
+            sched_yield();
+#endif
+        }
+    }
+}
+
+static inline void spin_unlock(uint64_t *lock)
+{
+    atomic_store_u64(lock, 0);
+}
+
+// A maxsize of 0 disables the cache; other sizes are rounded up to a power
+// of two no smaller than CACHE_WAYS
+bool cache_configure(struct result_cache *cache, size_t maxsize)
+{
+    struct cache_entry *entries = NULL;
+    size_t capacity = 0;
+    if (maxsize > 0)
+    {
+        capacity = CACHE_WAYS;
+        while (capacity < maxsize)
+        {
+            if (capacity > SIZE_MAX / 2 / sizeof(struct cache_entry))
+            {
+                return false;
+            }
+            capacity <<= 1;
+        }
+        entries = (struct cache_entry *)calloc(capacity, sizeof(struct cache_entry));
+        if (entries == NULL)
+        {
+            return false;
+        }
+    }
+    spin_lock(&cache->lock);
+    free(cache->entries);
+    cache->entries = entries;
+    cache->maxsize = capacity;
+    cache->set_mask = capacity / CACHE_WAYS - 1;
+    cache->currsize = 0;
+    cache->clock = 0;
+    cache->hits = 0;
+    cache->misses = 0;
+    spin_unlock(&cache->lock);
+    return true;
+}
+
+void cache_clear(struct result_cache *cache)
+{
+    spin_lock(&cache->lock);
+    if (cache->entries != NULL)
+    {
+        memset(cache->entries, 0, cache->maxsize * sizeof(struct cache_entry));
+    }
+    cache->currsize = 0;
+    cache->clock = 0;
+    cache->hits = 0;
+    cache->misses = 0;
+    spin_unlock(&cache->lock);
+}
+
+// Returns the cached capabilities, or -1 on a miss or a disabled cache
+int cache_lookup(struct result_cache *cache, uint64_t hash, size_t length)
+{
+    int capabilities = -1;
+    spin_lock(&cache->lock);
+    if (cache->entries != NULL)
+    {
+        struct cache_entry *set = &cache->entries[(hash & cache->set_mask) * CACHE_WAYS];
+        for (int way = 0; way < CACHE_WAYS; way++)
+        {
+            if (set[way].stamp != 0 && set[way].hash == hash && set[way].length == (uint32_t)length)
+            {
+                set[way].stamp = ++cache->clock;
+                capabilities = set[way].capabilities;
+                break;
+            }
+        }
+        if (capabilities >= 0)
+        {
+            cache->hits++;
+        }
+        else
+        {
+            cache->misses++;
+        }
+    }
+    spin_unlock(&cache->lock);
+    return capabilities;
+}
+
+// Fills an empty way of the set, or evicts its least recently used entry
+void cache_store(struct result_cache *cache, uint64_t hash, size_t length, int capabilities)
+{
+    spin_lock(&cache->lock);
+    if (cache->entries == NULL)
+    {
+        spin_unlock(&cache->lock);
+        return;
+    }
+    struct cache_entry *set = &cache->entries[(hash & cache->set_mask) * CACHE_WAYS];
+    struct cache_entry *victim = &set[0];
+    for (int way = 0; way < CACHE_WAYS; way++)
+    {
+        if (set[way].stamp < victim->stamp)
+        {
+            victim = &set[way];
+        }
+    }
+    if (victim->stamp == 0)
+    {
+        cache->currsize++;
+    }
+    victim->hash = hash;
+    victim->length = (uint32_t)length;
+    victim->capabilities = capabilities;
+    victim->stamp = ++cache->clock;
+    spin_unlock(&cache->lock);
+}
+
+
+// Identifies what a cached result depends on: every rule and the window
+uint64_t matcher_fingerprint(const struct browser_matcher *matcher, size_t window)
+{
+    uint64_t h = fmix64(0x9E3779B97F4A7C15ULL ^ (uint64_t)window ^ ((uint64_t)matcher->count << 40));
+    for (size_t i = 0; i < matcher->count; i++)
+    {
+        const struct browser_version *rule = &matcher->rules[i];
+        h = fmix64(h ^ ua_hash(rule->name, rule->name_len));
+        for (int j = 0; j < FORMAT_COUNT; j++)
+        {
+            h = fmix64(h ^ ((uint64_t)(uint32_t)rule->min_versions[j] << 8) ^ (uint64_t)j);
+        }
+    }
+    return h;
+}
+
+// Writes the header for the largest power-of-two slot count that fits in
+// `size` bytes of zeroed memory; returns the slot count, or 0 if too small
+size_t shared_cache_format(void *memory, size_t size)
+{
+    if (size < sizeof(struct shared_cache_header) + SHARED_CACHE_PROBES * sizeof(uint64_t))
+    {
+        return 0;
+    }
+    size_t available = (size - sizeof(struct shared_cache_header)) / sizeof(uint64_t);
+    size_t slots = SHARED_CACHE_PROBES;
+    while (slots * 2 <= available)
+    {
+        slots <<= 1;
+    }
+    struct shared_cache_header *header = (struct shared_cache_header *)memory;
+    header->slots = slots;
+    atomic_store_u64(&header->magic, SHARED_CACHE_MAGIC);
+    return slots;
+}
+
+// Returns false if the memory does not hold a formatted cache
+bool shared_cache_attach(struct shared_cache *cache, void *memory, size_t size)
+{
+    const struct shared_cache_header *header = (const struct shared_cache_header *)memory;
+    if (size < sizeof(struct shared_cache_header) || atomic_load_u64(&header->magic) != SHARED_CACHE_MAGIC)
+    {
+        return false;
+    }
+    uint64_t slots = header->slots;
+    if (slots < SHARED_CACHE_PROBES || (slots & (slots - 1)) != 0 ||
+        slots > (size - sizeof(struct shared_cache_header)) / sizeof(uint64_t))
+    {
+        return false;
+    }
+    cache->mask = (size_t)slots - 1;
+    cache->seed = matcher_fingerprint(active_matcher, max_scan_length);
+    cache->hits = 0;
+    cache->misses = 0;
+    atomic_store_ptr((void **)&cache->slots, (char *)memory + sizeof(struct shared_cache_header));
+    return true;
+}
+
+// Only clears the pointer: calls that already loaded it finish on the old
+// table, so the caller must keep the memory mapped
+void shared_cache_detach(struct shared_cache *cache)
+{
+    atomic_store_ptr((void **)&cache->slots, NULL);
+}
+
+// Loads the attached table once, with the mask from its own header, so a
+// call racing with detach and attach never pairs one table with the
+// size of another
+static inline uint64_t *shared_cache_table(const struct shared_cache *cache, size_t *mask)
+{
+    uint64_t *slots = (uint64_t *)atomic_load_ptr((void *const *)&cache->slots);
+    if (slots != NULL)
+    {
+        *mask = (size_t)((const struct shared_cache_header *)slots - 1)->slots - 1;
+    }
+    return slots;
+}
+
+static inline uint64_t shared_cache_key(const struct shared_cache *cache, uint64_t hash)
+{
+    return fmix64(hash ^ cache->seed);
+}
+
+// Lock-free: probes up to SHARED_CACHE_PROBES slots and stops at the first
+// empty one, since slots are never emptied. Returns -1 on a miss.
+int shared_cache_lookup(struct shared_cache *cache, uint64_t hash)
+{
+    size_t mask;
+    uint64_t *slots = shared_cache_table(cache, &mask);
+    if (slots == NULL)
+    {
+        return -1;
+    }
+    uint64_t key = shared_cache_key(cache, hash);
+    for (size_t i = 0; i < SHARED_CACHE_PROBES; i++)
+    {
+        uint64_t slot = atomic_load_u64(&slots[(key + i) & mask]);
+        if (slot == 0)
+        {
+            break;
+        }
+        if ((slot & SHARED_CACHE_TAG_MASK) == (key & SHARED_CACHE_TAG_MASK))
+        {
+            cache->hits++;
+            return (int)((slot >> 1) & FORMAT_ALL);
+        }
+    }
+    cache->misses++;
+    return -1;
+}
+
+// Claims the first empty probe slot with a compare-and-swap; when all of
+// them are taken, the home slot is overwritten. Concurrent writers of the
+// same key store the same value, so losing a race is harmless.
+void shared_cache_store(struct shared_cache *cache, uint64_t hash, int capabilities)
+{
+    size_t mask;
+    uint64_t *slots = shared_cache_table(cache, &mask);
+    if (slots == NULL)
+    {
+        return;
+    }
+    uint64_t key = shared_cache_key(cache, hash);
+    uint64_t value = (key & SHARED_CACHE_TAG_MASK) | ((uint64_t)capabilities << 1) | 1;
+    for (size_t i = 0; i < SHARED_CACHE_PROBES; i++)
+    {
+        uint64_t *slot = &slots[(key + i) & mask];
+        uint64_t current = atomic_load_u64(slot);
+        if (current == 0 && atomic_cas_u64(slot, 0, value))
+        {
+            return;
+        }
+        current = atomic_load_u64(slot);
+        if ((current & SHARED_CACHE_TAG_MASK) == (key & SHARED_CACHE_TAG_MASK))
+        {
+            return;
+        }
+    }
+    atomic_store_u64(&slots[key & mask], value);
+}
+
+size_t shared_cache_used(const struct shared_cache *cache)
+{
+    size_t used = 0;
+    size_t mask;
+    const uint64_t *slots = shared_cache_table(cache, &mask);
+    if (slots != NULL)
+    {
+        for (size_t i = 0; i <= mask; i++)
+        {
+            used += atomic_load_u64(&slots[i]) != 0;
+        }
+    }
+    return used;
+}
+
+// Checks the process-local cache, then the shared one, then scans. The
+// unlocked checks below only skip work: both caches recheck under their
+// own synchronization, so a cache that is resized or detached meanwhile
+// is safe to race with. With `decided`, also stores the stats slot of the
+// detection.
+static inline int lookup_capabilities(const char *user_agent, size_t length, int wanted, int *decided)
+{
+    if (user_agent == NULL || (default_cache.entries == NULL && shared_cache.slots == NULL))
+    {
+        return matcher_scan_rules(active_matcher, user_agent, length, wanted, NULL, decided);
+    }
+    // Bytes past the window cannot change the result, so they are not hashed
+    length = scan_window(length);
+    uint64_t hash = ua_hash(user_agent, length);
+    int capabilities = -1;
+    if (default_cache.entries != NULL)
+    {
+        capabilities = cache_lookup(&default_cache, hash, length);
+        if (capabilities >= 0)
+        {
+            if (decided != NULL)
+            {
+                *decided = STATS_CACHED;
+            }
+            return capabilities & wanted;
+        }
+    }
+    if (shared_cache.slots != NULL)
+    {
+        capabilities = shared_cache_lookup(&shared_cache, hash);
+        if (capabilities >= 0 && decided != NULL)
+        {
+            *decided = STATS_SHARED_CACHED;
+        }
+    }
+    if (capabilities < 0)
+    {
+        capabilities = matcher_scan_rules(active_matcher, user_agent, length, FORMAT_ALL, NULL, decided);
+        if (shared_cache.slots != NULL)
+        {
+            shared_cache_store(&shared_cache, hash, capabilities);
+        }
+    }
+    if (default_cache.entries != NULL)
+    {
+        cache_store(&default_cache, hash, length, capabilities);
+    }
+    return capabilities & wanted;
+}
+
+// A cheap, monotonic tick count: the time-stamp counter on x86-64, the
+// virtual counter on AArch64, nanoseconds elsewhere
+uint64_t stats_ticks(void)
+{
+#if defined(SCAN_X86_64)
+    return __rdtsc();
+#elif defined(__aarch64__) && !defined(_MSC_VER)
+    uint64_t ticks;
+    __asm__ __volatile__("mrs %0, cntvct_el0" : "=r"(ticks));
+    return ticks;
+#elif defined(_WIN32)
+    LARGE_INTEGER counter;
+    QueryPerformanceCounter(&counter);
+    return (uint64_t)counter.QuadPart;
+#else
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t)now.tv_sec * 1000000000u + (uint64_t)now.tv_nsec;
+#endif
+}
+
+// Detections left until the next timed one. Updated with plain relaxed
+// loads and stores: concurrent detections may skip or repeat a sample,
+// which only makes the sampling approximate
+static uint32_t stats_countdown;
+
+// Kept out of line, so that the disabled path in cached_capabilities is a
+// single predictable branch
+#if defined(_MSC_VER)
+__declspec(noinline)
+#else
+__attribute__((noinline))
+#endif
+static int counted_capabilities(const char *user_agent, size_t length, int wanted)
+{
+    int decided = STATS_UNMATCHED;
+    uint32_t sample_every = stats_sample_every;
+    uint32_t countdown = atomic_load_relaxed_u32(&stats_countdown);
+    if (sample_every == 0 || countdown != 0)
+    {
+        atomic_store_relaxed_u32(&stats_countdown, countdown - (sample_every != 0));
+        int capabilities = lookup_capabilities(user_agent, length, wanted, &decided);
+        atomic_add_relaxed_u64(&detection_stats.counts[decided], 1);
+        return capabilities;
+    }
+    atomic_store_relaxed_u32(&stats_countdown, sample_every - 1);
+    uint64_t start = stats_ticks();
+    int capabilities = lookup_capabilities(user_agent, length, wanted, &decided);
+    uint64_t ticks = stats_ticks() - start;
+    atomic_add_relaxed_u64(&detection_stats.counts[decided], 1);
+    int bucket = ticks == 0 ? 0 : highest_bit64(ticks);
+    atomic_add_relaxed_u64(&detection_stats.latency[bucket < STATS_LATENCY_BUCKETS ? bucket : STATS_LATENCY_BUCKETS - 1], 1);
+    atomic_add_relaxed_u64(&detection_stats.latency_ticks, ticks);
+    return capabilities;
+}
+
+static inline int cached_capabilities(const char *user_agent, size_t length, int wanted)
+{
+    if (stats_enabled)
+    {
+        return counted_capabilities(user_agent, length, wanted);
+    }
+    return lookup_capabilities(user_agent, length, wanted, NULL);
+}
+
+// A sample_every of 0 counts without timing
+void stats_configure(bool enabled, uint32_t sample_every)
+{
+    stats_sample_every = sample_every;
+    stats_enabled = enabled;
+}
+
+void stats_reset(void)
+{
+    for (size_t i = 0; i < STATS_SLOTS; i++)
+    {
+        atomic_store_u64(&detection_stats.counts[i], 0);
+    }
+    for (size_t i = 0; i < STATS_LATENCY_BUCKETS; i++)
+    {
+        atomic_store_u64(&detection_stats.latency[i], 0);
+    }
+    atomic_store_u64(&detection_stats.latency_ticks, 0);
+}
+
+static int detect_scan_level(void)
+{
+#if defined(SCAN_X86_64)
+#if defined(_MSC_VER) && !defined(__clang__)
+    // AVX2 needs the CPU flag and the OS saving the YMM registers
+    int info[4];
+    __cpuid(info, 0);
+    if (info[0] >= 7)
+    {
+        __cpuid(info, 1);
+        bool osxsave = (info[2] & (1 << 27)) != 0 && (info[2] & (1 << 28)) != 0;
+        __cpuidex(info, 7, 0);
+        if (osxsave && (info[1] & (1 << 5)) != 0 && (_xgetbv(0) & 6) == 6)
+        {
+            return SCAN_AVX2;
+        }
+    }
+#else
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2"))
+    {
+        return SCAN_AVX2;
+    }
+#endif
+    return SCAN_VECTOR;
+#elif defined(SCAN_NEON)
+    return SCAN_VECTOR;
+#else
+    return SCAN_SCALAR;
+#endif
+}
+
+// Picks the scanner, capped at what this CPU supports, and returns the
+// level in effect; for benchmarks and tests
+int scan_level_select(int level)
+{
+    scan_level = level < SCAN_SCALAR ? SCAN_SCALAR : (level > scan_level_max ? scan_level_max : level);
+    return scan_level;
+}
+
+void modern_image_support_init(void)
+{
+    scan_level_max = detect_scan_level();
+    scan_level = scan_level_max;
+    matcher_build(&default_matcher, browser_versions, BROWSER_VERSION_COUNT);
+}
+
+int detect_capabilities(const char *user_agent, size_t length)
+{
+    return cached_capabilities(user_agent, length, FORMAT_ALL);
+}
+
+int best_format_of(int capabilities)
+{
+    if (capabilities & FORMAT_AVIF)
+    {
+        return FORMAT_AVIF;
+    }
+    if (capabilities & FORMAT_WEBP)
+    {
+        return FORMAT_WEBP;
+    }
+    return 0;
+}
+
+bool is_webp_supported(const char *user_agent, size_t length)
+{
+    return cached_capabilities(user_agent, length, FORMAT_WEBP) != 0;
+}
+
+bool is_avif_supported(const char *user_agent, size_t length)
+{
+    return cached_capabilities(user_agent, length, FORMAT_AVIF) != 0;
+}
+
+// Batch detection; does not touch the result cache, so it is safe to run
+// on several threads at once without holding the GIL. The caller keeps
+// `matcher` alive for the duration of the call.
+// What a batch mode stores for one User-Agent
+static inline unsigned char batch_value(const struct browser_matcher *matcher, const char *user_agent, size_t length, int mode)
+{
+    int wanted = mode == BATCH_WEBP ? FORMAT_WEBP : mode == BATCH_AVIF ? FORMAT_AVIF : FORMAT_ALL;
+    int capabilities = matcher_scan(matcher, user_agent, length, wanted);
+    if (mode == BATCH_BEST)
+    {
+        capabilities = best_format_of(capabilities);
+    }
+    else if (mode != BATCH_CAPABILITIES)
+    {
+        capabilities = capabilities != 0;
+    }
+    return (unsigned char)capabilities;
+}
+
+void detect_many(const struct browser_matcher *matcher, const char *const *user_agents, const size_t *lengths, size_t count, int mode, unsigned char *out)
+{
+    for (size_t i = 0; i < count; i++)
+    {
+        out[i] = batch_value(matcher, user_agents[i], lengths[i], mode);
+    }
+}
+
+// Reads the buffers of an Arrow string or binary array (utf8 "u", binary
+// "z", their large variants "U" and "Z", and the views "vu" and "vz").
+// Returns false for other types or a malformed array.
+bool column_from_arrow(struct ua_column *column, const char *format, const struct ArrowArray *array)
+{
+    if (array->length < 0 || array->offset < 0 || array->n_buffers < 2 || array->buffers == NULL)
+    {
+        return false;
+    }
+    memset(column, 0, sizeof(*column));
+    column->length = (size_t)array->length;
+    column->offset = (size_t)array->offset;
+    column->validity = array->null_count != 0 ? (const uint8_t *)array->buffers[0] : NULL;
+    column->values = array->buffers[1];
+    if ((strcmp(format, "u") == 0 || strcmp(format, "z") == 0 || strcmp(format, "U") == 0 || strcmp(format, "Z") == 0))
+    {
+        if (array->n_buffers != 3)
+        {
+            return false;
+        }
+        column->layout = (format[0] == 'u' || format[0] == 'z') ? COLUMN_OFFSETS32 : COLUMN_OFFSETS64;
+        column->data = (const char *)array->buffers[2];
+    }
+    else if (strcmp(format, "vu") == 0 || strcmp(format, "vz") == 0)
+    {
+        // Views, then the variadic data buffers, then their sizes
+        if (array->n_buffers < 3)
+        {
+            return false;
+        }
+        column->layout = COLUMN_VIEWS;
+        column->data_buffers = (const char *const *)&array->buffers[2];
+        column->data_buffer_count = (size_t)(array->n_buffers - 3);
+    }
+    else
+    {
+        return false;
+    }
+    return column->length == 0 || column->values != NULL;
+}
+
+// Locates value i of a column; returns false for a null
+static inline bool column_value(const struct ua_column *column, size_t i, const char **value, size_t *length)
+{
+    size_t index = column->offset + i;
+    if (column->validity != NULL && !((column->validity[index >> 3] >> (index & 7)) & 1))
+    {
+        return false;
+    }
+    switch (column->layout)
+    {
+    case COLUMN_FIXED:
+    {
+        const char *item = (const char *)column->values + i * column->width;
+        // Detection stops at the scan bound, so the padding past it is not searched
+        size_t window = scan_window(column->width);
+        const char *nul = (const char *)memchr(item, 0, window);
+        *value = item;
+        *length = nul != NULL ? (size_t)(nul - item) : window;
+        return true;
+    }
+    case COLUMN_OFFSETS32:
+    {
+        const int32_t *offsets = (const int32_t *)column->values + index;
+        *value = column->data + offsets[0];
+        *length = (size_t)(offsets[1] - offsets[0]);
+        return true;
+    }
+    case COLUMN_OFFSETS64:
+    {
+        const int64_t *offsets = (const int64_t *)column->values + index;
+        *value = column->data + offsets[0];
+        *length = (size_t)(offsets[1] - offsets[0]);
+        return true;
+    }
+    default:
+    {
+        // 16-byte view: length, then the value inline up to 12 bytes, or
+        // a 4-byte prefix, the data buffer index and the offset in it
+        const char *view = (const char *)column->values + index * 16;
+        int32_t view_length, buffer, offset;
+        memcpy(&view_length, view, 4);
+        if (view_length <= 12)
+        {
+            *value = view + 4;
+        }
+        else
+        {
+            memcpy(&buffer, view + 8, 4);
+            memcpy(&offset, view + 12, 4);
+            if (buffer < 0 || (size_t)buffer >= column->data_buffer_count)
+            {
+                return false;
+            }
+            *value = column->data_buffers[buffer] + offset;
+        }
+        *length = view_length > 0 ? (size_t)view_length : 0;
+        return true;
+    }
+    }
+}
+
+// Like detect_many over values [start, stop) of a column; nulls give 0
+void detect_column(const struct browser_matcher *matcher, const struct ua_column *column, size_t start, size_t stop, int mode, unsigned char *out)
+{
+    for (size_t i = start; i < stop; i++)
+    {
+        const char *value;
+        size_t length;
+        out[i - start] = column_value(column, i, &value, &length) ? batch_value(matcher, value, length, mode) : 0;
+    }
+}
+
+static inline char ascii_lower(char c)
+{
+    return (c >= 'A' && c <= 'Z') ? (char)(c - 'A' + 'a') : c;
+}
+
+static inline bool media_range_is(const char *start, size_t length, const char *lowercase, size_t expected)
+{
+    if (length != expected)
+    {
+        return false;
+    }
+    for (size_t i = 0; i < length; i++)
+    {
+        if (ascii_lower(start[i]) != lowercase[i])
+        {
+            return false;
+        }
+    }
+    return true;
+}
+
+struct format_mime {
+    const char *mime;
+    size_t length;
+    int format;
+};
+
+// Formats an Accept header can name; animated AVIF shares image/avif, so
+// the header can only refuse it (together with AVIF)
+static const struct format_mime format_mime_types[] = {
+    {"image/webp", 10, FORMAT_WEBP},
+    {"image/avif", 10, FORMAT_AVIF},
+    {"image/jxl", 9, FORMAT_JXL},
+    {"image/heic", 10, FORMAT_HEIC}
+};
+
+#define FORMAT_MIME_COUNT (sizeof(format_mime_types) / sizeof(format_mime_types[0]))
+#define FORMAT_WITH_MIME (FORMAT_WEBP | FORMAT_AVIF | FORMAT_JXL | FORMAT_HEIC)
+
+static inline bool is_ows(char c)
+{
+    return c == ' ' || c == '\t';
+}
+
+// Parses an Accept header. A format listed explicitly is accepted or
+// refused according to its q-value; a format only covered by image/* or
+// */* is refused when that wildcard has q=0 and left undecided otherwise,
+// since browsers send wildcards whatever they can decode. A format that is
+// neither listed nor covered by a wildcard is refused. Returns false for a
+// blank header, which decides nothing.
+bool accept_scan(const char *accept, size_t length, int *accepted, int *refused)
+{
+    const char *p = accept;
+    const char *end = accept + length;
+    int explicit_ok = 0, explicit_zero = 0;
+    int image_wildcard = 0, any_wildcard = 0;  // 0 absent, 1 q>0, 2 q=0
+    bool any_range = false;
+
+    while (p < end)
+    {
+        while (p < end && (is_ows(*p) || *p == ','))
+        {
+            p++;
+        }
+        const char *range = p;
+        while (p < end && *p != ',' && *p != ';' && !is_ows(*p))
+        {
+            p++;
+        }
+        size_t range_length = (size_t)(p - range);
+
+        // Parameters: only q matters; a q-value is zero when all its digits are
+        bool zero = false;
+        while (p < end && *p != ',')
+        {
+            if (*p == ';')
+            {
+                p++;
+                while (p < end && is_ows(*p))
+                {
+                    p++;
+                }
+                if (end - p >= 2 && ascii_lower(p[0]) == 'q' && p[1] == '=')
+                {
+                    p += 2;
+                    zero = true;
+                    while (p < end && ((*p >= '0' && *p <= '9') || *p == '.'))
+                    {
+                        if (*p >= '1' && *p <= '9')
+                        {
+                            zero = false;
+                        }
+                        p++;
+                    }
+                }
+                continue;
+            }
+            p++;
+        }
+        if (range_length == 0)
+        {
+            continue;
+        }
+        any_range = true;
+
+        if (media_range_is(range, range_length, "image/*", 7))
+        {
+            image_wildcard = zero ? 2 : 1;
+            continue;
+        }
+        if (media_range_is(range, range_length, "*/*", 3))
+        {
+            any_wildcard = zero ? 2 : 1;
+            continue;
+        }
+        for (size_t i = 0; i < FORMAT_MIME_COUNT; i++)
+        {
+            if (media_range_is(range, range_length, format_mime_types[i].mime, format_mime_types[i].length))
+            {
+                if (zero)
+                {
+                    explicit_zero |= format_mime_types[i].format;
+                }
+                else
+                {
+                    explicit_ok |= format_mime_types[i].format;
+                }
+                break;
+            }
+        }
+    }
+
+    if (!any_range)
+    {
+        return false;
+    }
+    int wildcard = image_wildcard != 0 ? image_wildcard : any_wildcard;
+    int listed = explicit_ok | explicit_zero;
+    *accepted = explicit_ok;
+    *refused = explicit_zero & ~explicit_ok;
+    if (wildcard != 1)
+    {
+        *refused |= FORMAT_WITH_MIME & ~listed;
+    }
+    if (*refused & FORMAT_AVIF)
+    {
+        *refused |= FORMAT_ANIMATED_AVIF;
+    }
+    return true;
+}
+
+// Handles one string of a Client Hints header, between the quotes at
+// `open` and `close`. A string after "=" is a parameter value, any other
+// starts a list member: a brand, which selects the rule its "v" parameter
+// is checked against.
+static inline void client_hint_string(const struct browser_matcher *matcher, const char *header, const char *open, const char *close, int *rule, int *capabilities)
+{
+    if (open == header || open[-1] != '=')
+    {
+        size_t brand_length = (size_t)(close - open - 1);
+        *rule = -1;
+        for (int i = 0; i < CLIENT_HINT_BRANDS; i++)
+        {
+            if (brand_length == client_hint_brands[i].brand_len && memcmp(open + 1, client_hint_brands[i].brand, brand_length) == 0)
+            {
+                *rule = matcher->hint_rule[i];
+                break;
+            }
+        }
+        return;
+    }
+    // Only the first v parameter of a known brand counts
+    if (*rule < 0 || open - header < 3 || open[-2] != 'v' || (open[-3] != ';' && open[-3] != ' '))
+    {
+        return;
+    }
+    const char *d = open + 1;
+    const char *digits_end = (close - d > MAX_VERSION_DIGITS) ? d + MAX_VERSION_DIGITS : close;
+    if (d < digits_end && *d >= '0' && *d <= '9')
+    {
+        int version_number = 0;
+        for (; d < digits_end && *d >= '0' && *d <= '9'; d++)
+        {
+            version_number = version_number * 10 + (*d - '0');
+        }
+        *capabilities = (*capabilities < 0 ? 0 : *capabilities) | version_capabilities(&matcher->rules[*rule], version_number);
+    }
+    *rule = -1;
+}
+
+// Walks the strings of a header one by one, escapes included
+static int client_hint_walk(const struct browser_matcher *matcher, const char *header, size_t length)
+{
+    const char *p = header;
+    const char *end = header + length;
+    int capabilities = -1;
+    int rule = -1;
+    const char *open;
+    while (p < end && (open = (const char *)memchr(p, '"', (size_t)(end - p))) != NULL)
+    {
+        const char *close = open + 1;
+        for (; close < end && *close != '"'; close++)
+        {
+            if (*close == '\\')
+            {
+                close++;
+            }
+        }
+        if (close >= end)
+        {
+            break;
+        }
+        client_hint_string(matcher, header, open, close, &rule, &capabilities);
+        p = close + 1;
+    }
+    return capabilities;
+}
+
+// Marks the quotes and backslashes among 16 bytes
+static inline uint32_t client_hint_block(const char *block, uint32_t *escapes)
+{
+#if defined(SCAN_X86_64)
+    __m128i bytes = _mm_loadu_si128((const __m128i *)block);
+    *escapes |= (uint32_t)_mm_movemask_epi8(_mm_cmpeq_epi8(bytes, _mm_set1_epi8('\\')));
+    return (uint32_t)_mm_movemask_epi8(_mm_cmpeq_epi8(bytes, _mm_set1_epi8('"')));
+#else
+    uint32_t quotes = 0;
+    for (int i = 0; i < 16; i++)
+    {
+        quotes |= (uint32_t)(block[i] == '"') << i;
+        *escapes |= (uint32_t)(block[i] == '\\');
+    }
+    return quotes;
+#endif
+}
+
+// Reads a Sec-CH-UA or Sec-CH-UA-Full-Version-List header, a structured
+// field list of brand strings with a "v" parameter, such as
+//     "Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"
+// Returns the capabilities of the brands the rule table has a token for,
+// or -1 when it names none of them, so the User-Agent has to decide.
+// Headers of up to CLIENT_HINT_FAST_LENGTH bytes without escapes, which
+// is all that browsers send, are read from a bitmap of their quotes.
+int client_hint_capabilities(const struct browser_matcher *matcher, const char *header, size_t length, int wanted)
+{
+    int capabilities = -1;
+    uint64_t quotes[CLIENT_HINT_FAST_LENGTH / 64] = {0};
+    uint32_t escapes = 0;
+    if (length <= CLIENT_HINT_FAST_LENGTH)
+    {
+        size_t i = 0;
+        for (; i + 16 <= length; i += 16)
+        {
+            quotes[i / 64] |= (uint64_t)client_hint_block(header + i, &escapes) << (i % 64);
+        }
+        if (i < length)
+        {
+            // The last block ends at the end of the header, or is copied
+            // when the header is shorter than one
+            size_t rest = length - i;
+            uint32_t bits;
+            uint32_t tail_escapes = 0;
+            if (length >= 16)
+            {
+                bits = client_hint_block(header + length - 16, &tail_escapes) >> (16 - rest);
+                tail_escapes >>= 16 - rest;
+            }
+            else
+            {
+                char block[16] = {0};
+                memcpy(block, header, length);
+                bits = client_hint_block(block, &tail_escapes);
+            }
+            quotes[i / 64] |= (uint64_t)bits << (i % 64);
+            escapes |= tail_escapes;
+        }
+    }
+    if (length > CLIENT_HINT_FAST_LENGTH || escapes != 0)
+    {
+        capabilities = client_hint_walk(matcher, header, length);
+    }
+    else
+    {
+        // Quotes pair up as the opening and closing ones of each string
+        int rule = -1;
+        const char *open = NULL;
+        for (size_t c = 0; c < CLIENT_HINT_FAST_LENGTH / 64; c++)
+        {
+            for (uint64_t bits = quotes[c]; bits != 0; bits &= bits - 1)
+            {
+                const char *quote = header + 64 * c + lowest_bit64(bits);
+                if (open == NULL)
+                {
+                    open = quote;
+                    continue;
+                }
+                client_hint_string(matcher, header, open, quote, &rule, &capabilities);
+                open = NULL;
+            }
+        }
+    }
+    return capabilities < 0 ? -1 : capabilities & wanted;
+}
+
+// Accept decides what it can, then Client Hints when they name a known
+// brand; the User-Agent is only scanned for formats still undecided. A
+// NULL header or User-Agent means it was not sent.
+int negotiate_capabilities(const char *accept, size_t accept_length, const char *user_agent, size_t ua_length, const char *client_hints, size_t hints_length)
+{
+    int accepted = 0;
+    int refused = 0;
+    if (accept != NULL)
+    {
+        accept_scan(accept, accept_length, &accepted, &refused);
+    }
+    int undecided = FORMAT_ALL & ~(accepted | refused);
+    if (undecided != 0 && client_hints != NULL)
+    {
+        int hinted = client_hint_capabilities(active_matcher, client_hints, hints_length, undecided);
+        if (hinted >= 0)
+        {
+            accepted |= hinted;
+            undecided = 0;
+        }
+    }
+    if (undecided != 0 && user_agent != NULL)
+    {
+        accepted |= cached_capabilities(user_agent, ua_length, undecided);
+    }
+    return accepted;
+}
+
+bool tally_init(struct ua_tally *tally, size_t capacity)
+{
+    size_t rounded = 16;
+    while (rounded < capacity)
+    {
+        rounded <<= 1;
+    }
+    tally->entries = (struct ua_tally_entry *)calloc(rounded, sizeof(struct ua_tally_entry));
+    tally->capacity = tally->entries != NULL ? rounded : 0;
+    tally->size = 0;
+    tally->lines = 0;
+    tally->missing = 0;
+    return tally->entries != NULL;
+}
+
+void tally_free(struct ua_tally *tally)
+{
+    free(tally->entries);
+    tally->entries = NULL;
+    tally->capacity = 0;
+    tally->size = 0;
+}
+
+// Doubles the table, keeping it at most half full
+static bool tally_grow(struct ua_tally *tally)
+{
+    size_t capacity = tally->capacity * 2;
+    struct ua_tally_entry *entries = (struct ua_tally_entry *)calloc(capacity, sizeof(struct ua_tally_entry));
+    if (entries == NULL)
+    {
+        return false;
+    }
+    for (size_t i = 0; i < tally->capacity; i++)
+    {
+        if (tally->entries[i].count != 0)
+        {
+            size_t slot = tally->entries[i].hash & (capacity - 1);
+            while (entries[slot].count != 0)
+            {
+                slot = (slot + 1) & (capacity - 1);
+            }
+            entries[slot] = tally->entries[i];
+        }
+    }
+    free(tally->entries);
+    tally->entries = entries;
+    tally->capacity = capacity;
+    return true;
+}
+
+// Combined log format: the User-Agent is the last quoted field of the line
+static inline bool combined_user_agent(const char *line, const char *end, const char **user_agent, size_t *length)
+{
+    while (end > line && (is_ows(end[-1]) || end[-1] == '\r'))
+    {
+        end--;
+    }
+    if (end == line || end[-1] != '"')
+    {
+        return false;
+    }
+    const char *close = end - 1;
+    for (const char *p = close; p > line;)
+    {
+        p--;
+        if (*p == '"' && (p == line || p[-1] != '\\'))
+        {
+            *user_agent = p + 1;
+            *length = (size_t)(close - (p + 1));
+            return true;
+        }
+    }
+    return false;
+}
+
+static inline const char *skip_ows(const char *p, const char *end)
+{
+    while (p < end && is_ows(*p))
+    {
+        p++;
+    }
+    return p;
+}
+
+// JSON lines: the raw string value of `"key":`; escapes are left as they
+// are, which does not affect token matching
+static inline bool json_user_agent(const char *line, const char *end, const char *key, size_t key_length, const char **user_agent, size_t *length)
+{
+    const char *p = line;
+    while (p < end && (p = (const char *)memchr(p, '"', (size_t)(end - p))) != NULL)
+    {
+        p++;
+        if ((size_t)(end - p) <= key_length || memcmp(p, key, key_length) != 0 || p[key_length] != '"')
+        {
+            continue;
+        }
+        const char *q = skip_ows(p + key_length + 1, end);
+        if (q == end || *q != ':')
+        {
+            continue;
+        }
+        q = skip_ows(q + 1, end);
+        if (q == end || *q != '"')
+        {
+            return false;
+        }
+        const char *value = ++q;
+        while (q < end && *q != '"')
+        {
+            q += *q == '\\' ? 2 : 1;
+        }
+        if (q >= end)
+        {
+            return false;
+        }
+        *user_agent = value;
+        *length = (size_t)(q - value);
+        return true;
+    }
+    return false;
+}
+
+// Tallies the User-Agents of the lines that start in data[start:stop];
+// a line may run past `stop`, up to `length`. Each distinct User-Agent is
+// classified once. Does not touch the result cache and holds no global
+// state, so shards can be scanned concurrently. Returns false when the
+// table cannot grow.
+bool log_scan(const struct browser_matcher *matcher, const char *data, size_t length, size_t start, size_t stop, int format, const char *key, size_t key_length, struct ua_tally *tally)
+{
+    const char *end = data + length;
+    const char *line = data + start;
+    if (start > 0 && data[start - 1] != '\n')
+    {
+        const char *newline = (const char *)memchr(line, '\n', (size_t)(end - line));
+        line = newline != NULL ? newline + 1 : end;
+    }
+
+    while (line < data + stop)
+    {
+        const char *newline = (const char *)memchr(line, '\n', (size_t)(end - line));
+        const char *line_end = newline != NULL ? newline : end;
+        const char *next = newline != NULL ? newline + 1 : end;
+        if (line_end == line || (line_end == line + 1 && *line == '\r'))
+        {
+            line = next;
+            continue;
+        }
+        tally->lines++;
+
+        const char *user_agent = NULL;
+        size_t ua_length = 0;
+        bool found = format == LOG_JSON
+                         ? json_user_agent(line, line_end, key, key_length, &user_agent, &ua_length)
+                         : combined_user_agent(line, line_end, &user_agent, &ua_length);
+        if (!found || ua_length == 0 || (ua_length == 1 && *user_agent == '-'))
+        {
+            tally->missing++;
+            line = next;
+            continue;
+        }
+
+        uint64_t hash = ua_hash(user_agent, ua_length);
+        size_t slot = hash & (tally->capacity - 1);
+        struct ua_tally_entry *entry;
+        for (;;)
+        {
+            entry = &tally->entries[slot];
+            if (entry->count == 0 || (entry->hash == hash && entry->length == (uint32_t)ua_length))
+            {
+                break;
+            }
+            slot = (slot + 1) & (tally->capacity - 1);
+        }
+        if (entry->count == 0)
+        {
+            struct scan_record record;
+            entry->capabilities = (uint8_t)matcher_scan_rules(matcher, user_agent, ua_length, FORMAT_ALL, &record, NULL);
+            entry->family = (int16_t)record.family;
+            entry->hash = hash;
+            entry->length = (uint32_t)ua_length;
+            entry->offset = (size_t)(user_agent - data);
+            entry->count = 1;
+            if (++tally->size * 2 > tally->capacity && !tally_grow(tally))
+            {
+                return false;
+            }
+        }
+        else
+        {
+            entry->count++;
+        }
+        line = next;
+    }
+    return true;
 }
 
 #endif
@@ -0,0 +1,215 @@
+"""In-memory index of the image variants under a static root.
+
+``VariantResolver`` lists the root once and keeps, per base name, which
+``.avif``, ``.webp``, ``.jxl`` and fallback files exist along with their
+sizes and modification times. Resolving a request is then a dict lookup
+and a tuple index, with no filesystem access, which matters most when
+the static files live on a network mount.
+
+Usage::
+
+    from modern_image_support.variants import VariantResolver
+
+    variants = VariantResolver("static", poll_interval=30)
+    variant = variants.resolve("photos/cat", choice)
+    if variant is not None:
+        serve(variant.path, variant.mime_type, variant.size)
+"""
+
+import os
+import threading
+import time
+from typing import NamedTuple, Optional, Tuple
+
+from ._middleware import _FORMAT_BITS, FALLBACK_VARIANTS, FormatChoice, Variant
+
+__all__ = ["VariantResolver", "Variant"]
+
+# Directory mtimes this recent may still change within the same tick, so
+# such directories are listed again on the next refresh
+_SETTLE_NS = 2_000_000_000
+
+_MIME_TYPES = dict(FALLBACK_VARIANTS)
+_MIME_TYPES.update((image_format, f"image/{image_format}") for image_format in _FORMAT_BITS)
+
+# Kept current in forked children, so resolve() can tell that the poller
+# thread of the parent did not survive the fork without a system call
+_pid = os.getpid()
+
+
+def _after_fork():
+    global _pid
+    _pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class _Directory(NamedTuple):
+    """What the last listing of one directory found."""
+
+    mtime_ns: Optional[int]
+    subdirs: Tuple[str, ...]
+    names: Tuple[str, ...]
+
+
+class VariantResolver:
+    """Resolve ``(name, capabilities)`` to an existing image variant.
+
+    ``resolve("photos/cat", choice)`` returns the ``Variant`` of
+    ``photos/cat.avif``, ``photos/cat.webp`` and so on under ``root``, in
+    the order of ``formats`` restricted to what the client accepts, then
+    of the ``FALLBACK_VARIANTS``, or None when the name has no variant.
+    Names are relative to ``root``, ``/``-separated and without extension.
+
+    The index is built on construction. ``refresh()`` brings it up to date
+    incrementally: a directory is only listed again when its mtime has
+    changed, which adding, removing or renaming a file does. A file
+    rewritten in place keeps the directory mtime, so its size and mtime
+    are only picked up once the directory changes; deploy by renaming, or
+    call ``refresh(full=True)``. With ``poll_interval`` set, a daemon
+    thread in each process calls ``refresh()`` that often.
+
+    Args:
+        root: Directory the variant names are relative to
+        formats: Preferred formats, best first
+        poll_interval: Seconds between background refreshes, or None to
+            refresh only on demand
+    """
+
+    def __init__(self, root, formats=("avif", "webp", "jxl"), poll_interval=None):
+        for image_format in formats:
+            if image_format not in _FORMAT_BITS:
+                raise ValueError(f"unknown image format {image_format!r}")
+        self.root = os.path.abspath(root)
+        self.formats = tuple(formats)
+        self.poll_interval = poll_interval
+        self._mask = 0
+        for image_format in self.formats:
+            self._mask |= _FORMAT_BITS[image_format]
+        self._extensions = set(self.formats) | {extension for extension, _ in FALLBACK_VARIANTS}
+        # name -> Variant or None for each value of capabilities & mask
+        self._index = {}
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._poller_pid = None
+        self.refresh(full=True)
+
+    def resolve(self, name, choice):
+        """Return the best existing ``Variant`` for ``name``, or None.
+
+        Args:
+            name: Path relative to ``root``, without extension
+            choice: A ``FormatChoice`` or a capability bitmask
+        """
+        if self.poll_interval is not None and self._poller_pid != _pid:
+            self._start_polling()
+        table = self._index.get(name)
+        if table is None:
+            return None
+        capabilities = choice.capabilities if isinstance(choice, FormatChoice) else choice
+        return table[capabilities & self._mask]
+
+    def refresh(self, full=False):
+        """Bring the index up to date with the files under ``root``.
+
+        Args:
+            full: List every directory, even those whose mtime is unchanged
+        """
+        with self._lock:
+            seen = set()
+            pending = [""]
+            while pending:
+                directory = pending.pop()
+                known = self._dirs.get(directory)
+                try:
+                    mtime_ns = os.stat(os.path.join(self.root, directory)).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(directory)
+                if not full and known is not None and known.mtime_ns == mtime_ns:
+                    pending.extend(known.subdirs)
+                    continue
+                listed = self._list(directory, mtime_ns)
+                for name in set(known.names if known is not None else ()) - set(listed.names):
+                    self._index.pop(name, None)
+                self._dirs[directory] = listed
+                pending.extend(listed.subdirs)
+            for directory in set(self._dirs) - seen:
+                for name in self._dirs.pop(directory).names:
+                    self._index.pop(name, None)
+
+    def close(self):
+        """Stop background polling, in this process and its future children."""
+        self.poll_interval = None
+        self._stopped.set()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def _list(self, directory, mtime_ns):
+        path = os.path.join(self.root, directory)
+        prefix = f"{directory}/" if directory else ""
+        subdirs = []
+        found = {}
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(prefix + entry.name)
+                        continue
+                    base, dot, extension = entry.name.rpartition(".")
+                    extension = extension.lower()
+                    if not dot or not base or extension not in self._extensions:
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    mime_type = _MIME_TYPES[extension]
+                    found.setdefault(prefix + base, {})[extension] = Variant(
+                        entry.path, extension, mime_type, stat.st_size, stat.st_mtime)
+        except OSError:
+            return _Directory(None, (), ())
+        for name, variants in found.items():
+            self._index[name] = self._table(variants)
+        if time.time_ns() - mtime_ns < _SETTLE_NS:
+            mtime_ns = None
+        return _Directory(mtime_ns, tuple(subdirs), tuple(found))
+
+    def _table(self, variants):
+        fallback = None
+        for extension, _ in FALLBACK_VARIANTS:
+            if extension in variants:
+                fallback = variants[extension]
+                break
+        table = []
+        for capabilities in range(self._mask + 1):
+            variant = fallback
+            for image_format in self.formats:
+                if capabilities & _FORMAT_BITS[image_format] and image_format in variants:
+                    variant = variants[image_format]
+                    break
+            table.append(variant)
+        return tuple(table)
+
+    def _start_polling(self):
+        with self._lock:
+            if self._poller_pid == _pid:
+                return
+            self._poller_pid = _pid
+            self._stopped = threading.Event()
+        thread = threading.Thread(target=self._poll, args=(self._stopped,),
+                                  name="VariantResolver", daemon=True)
+        thread.start()
+
+    def _poll(self, stopped):
+        while not stopped.wait(self.poll_interval):
+            self.refresh()
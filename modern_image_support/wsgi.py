@@ -0,0 +1,69 @@
+"""WSGI middleware that negotiates the image format once per request.
+
+Usage with Flask::
+
+    from modern_image_support.wsgi import ImageFormatMiddleware
+
+    app.wsgi_app = ImageFormatMiddleware(app.wsgi_app, variant_root="static")
+
+    @app.route("/image")
+    def image():
+        choice = request.environ["modern_image_support.choice"]
+        variant = request.environ["modern_image_support.variants"].resolve("sample", choice)
+        ...
+"""
+
+from ._middleware import DEFAULT_VARY, ChoiceCache, FormatChoice, Variant, VariantCache, vary_headers
+from .variants import VariantResolver
+
+__all__ = ["ImageFormatMiddleware", "FormatChoice", "Variant", "VariantResolver", "VariantCache"]
+
+CHOICE_KEY = "modern_image_support.choice"
+VARIANTS_KEY = "modern_image_support.variants"
+
+
+class ImageFormatMiddleware:
+    """Resolve the image format from ``HTTP_USER_AGENT``/``HTTP_ACCEPT``.
+
+    ``HTTP_SEC_CH_UA`` Client Hints take precedence over the User-Agent
+    when they name a known brand.
+
+    The negotiated ``FormatChoice`` is stored in
+    ``environ["modern_image_support.choice"]``. Results are cached per
+    process, keyed by the raw header values. When ``variant_root`` is
+    given, a ``VariantResolver`` indexing it is stored in
+    ``environ["modern_image_support.variants"]`` so views can map a name
+    to an existing file without touching the filesystem. Responses with an
+    ``image/*`` content type get ``vary`` merged into their Vary header.
+
+    Args:
+        app: The WSGI application to wrap
+        cache_size: Entries in the per-process result cache; 0 disables it
+        variant_root: Directory of image variants, or None
+        vary: Header names added to ``Vary`` on image responses
+        poll_interval: Seconds between refreshes of the variant index, or
+            None to refresh only through ``variants.refresh()``
+    """
+
+    def __init__(self, app, cache_size=4096, variant_root=None, vary=DEFAULT_VARY,
+                 poll_interval=None):
+        self.app = app
+        self.cache = ChoiceCache(cache_size)
+        self.variants = (VariantResolver(variant_root, poll_interval=poll_interval)
+                         if variant_root is not None else None)
+        self.vary = tuple(vary)
+
+    def __call__(self, environ, start_response):
+        # WSGI header values are latin-1 str; ASCII ones are read in place
+        environ[CHOICE_KEY] = self.cache.resolve(
+            environ.get("HTTP_USER_AGENT"), environ.get("HTTP_ACCEPT"), environ.get("HTTP_SEC_CH_UA")
+        )
+        if self.variants is not None:
+            environ[VARIANTS_KEY] = self.variants
+        if not self.vary:
+            return self.app(environ, start_response)
+
+        def start_response_with_vary(status, headers, exc_info=None):
+            return start_response(status, vary_headers(headers, self.vary), exc_info)
+
+        return self.app(environ, start_response_with_vary)
@@ -1,3 +1,5 @@
+import platform
+
 from setuptools import setup, Extension
 from Cython.Build import cythonize
 
@@ -16,16 +18,31 @@ ext_modules = [
     ),
 ]
 
+ext_modules = cythonize(
+    ext_modules,
+    language_level=3,
+    compiler_directives={
+        "language_level": 3,
+        "boundscheck": False,
+        "wraparound": False,
+        # Sets Py_mod_gil, so free-threaded builds keep the GIL off
+        "freethreading_compatible": True,
+    },
+)
+# Without a compiler the package still installs, and imports the
+# pure-Python backend; see modern_image_support/_python.py. Set after
+# cythonize(), which does not carry `optional` over.
+for ext in ext_modules:
+    ext.optional = True
+
+# PyPy also gets the cffi build of the C code, optional as well; see
+# modern_image_support/_cffi.py
+extra_options = {}
+if platform.python_implementation() == "PyPy":
+    extra_options["cffi_modules"] = ["modern_image_support/_cffi_build.py:ffi"]
+
 setup(
-    ext_modules=cythonize(
-        ext_modules,
-        language_level=3,
-        compiler_directives={
-            "language_level": 3,
-            "boundscheck": False,
-            "wraparound": False,
-        },
-    ),
+    ext_modules=ext_modules,
     package_data={
         "modern_image_support": [
             "*.pyi",
@@ -36,4 +53,5 @@ setup(
     },
     include_package_data=True,
     packages=["modern_image_support"],
+    **extra_options,
 )